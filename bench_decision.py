@@ -0,0 +1,64 @@
+import logging
+logging.basicConfig(level=logging.WARNING)
+
+"""
+
+Checks the decision table against the rules it was built from and times it
+
+Runs random scenarios (demand, valve switches, timeout, circuit states)
+through decision.lookup() and decision.evaluate_rules() and fails if they
+ever disagree, then times both and the full decide() on snapshots.
+
+    uv run bench_decision.py [number_of_scenarios]
+
+"""
+
+import random
+import sys
+import time
+
+import decision
+from valves_and_temps import ValveTempSnapshot
+
+
+class FakeServerState:
+    # just the fields decision.demand() reads
+    def __init__(self,heating_currently_on:bool,hot_water_currently_on:bool,hot_water_temperature:float):
+        self.heating_currently_on=heating_currently_on
+        self.hot_water_currently_on=hot_water_currently_on
+        self.hot_water_temperature=hot_water_temperature
+
+
+def random_scenarios(count:int,seed:int=1):
+    rng=random.Random(seed)
+    states=decision.CIRCUIT_STATES
+    return [(rng.random()<0.5,rng.random()<0.5,rng.random()<0.5,rng.random()<0.5,rng.random()<0.1,
+             rng.choice(states),rng.choice(states)) for _ in range(count)]
+
+
+def timed(fn,scenarios):
+    start=time.perf_counter()
+    for scenario in scenarios:
+        fn(*scenario)
+    return time.perf_counter()-start
+
+
+if __name__=="__main__":
+    count=int(sys.argv[1]) if len(sys.argv)>1 else 1000000
+    scenarios=random_scenarios(count)
+
+    mismatches=sum(1 for scenario in scenarios if decision.lookup(*scenario)!=decision.evaluate_rules(*scenario))
+    if mismatches:
+        raise SystemExit(f"{mismatches} scenarios where the table and the rules disagree")
+
+    table_s=timed(decision.lookup,scenarios)
+    rules_s=timed(decision.evaluate_rules,scenarios[:count//10])*10
+    print(f"{count} scenarios, table matches the rules")
+    print(f"  evaluate_rules: {rules_s*1e6/count:6.2f}us/scenario")
+    print(f"  lookup:         {table_s*1e6/count:6.2f}us/scenario ({count/table_s*60/1e6:.0f} million/minute)")
+
+    now=time.time()
+    full=[(FakeServerState(s[1],s[0],40.0),ValveTempSnapshot(50,40,60,45,s[2],s[3],True,now,True),s[5],s[6],now-(600 if s[4] else 0),now)
+          for s in scenarios[:count//10]]
+    decide_s=timed(decision.decide,full)*10
+    print(f"  decide:         {decide_s*1e6/count:6.2f}us/scenario")
@@ -0,0 +1,73 @@
+import logging
+logging.basicConfig(level=logging.WARNING) # keeps the valve edge logging out of the timings
+
+"""
+
+Benchmarks FrameDecoder against the old json.loads + setattr path
+
+Pass a file of frames recorded from the board (one line per frame, eg
+captured with `cat /dev/ttyACM0 > frames.txt`) or it uses a built in
+sample of typical output.
+
+    uv run bench_frame_decoder.py [frames.txt]
+
+"""
+
+import json
+import sys
+import time
+
+from frame_decoder import FrameDecoder
+from valves_and_temps import ValveTempState
+
+SAMPLE_FRAMES=['{"OutHW":52.31,"RetHW":44.12,"OutRad":61.5,"RetRad":49.75,"hw_valve_open":true,"rad_valve_open":false,"oil_flowing":true}',
+               '{"OutHW":52.25,"RetHW":44.19,"OutRad":61.44,"RetRad":49.81,"hw_valve_open":1,"rad_valve_open":0,"oil_flowing":1}',
+               '{"OutHW":-127,"RetHW":44.25,"OutRad":61.38,"RetRad":49.88,"hw_valve_open":true,"rad_valve_open":true,"oil_flowing":false}',
+               'Debug: valve switch read 1023',
+               '{"OutHW":52.19,"RetHW":44.25',
+               '{"OutHW":52.19,"RetHW":44.25,"OutRad":61.38,"RetRad":49.88,"hw_valve_open":true,"rad_valve_open":true,"oil_flowing":true}']
+
+
+def old_path(lines,state):
+    failures=0
+    for nl in lines:
+        if nl.startswith("{"):
+            try:
+                state.update(**json.loads(nl))
+            except ValueError:
+                failures+=1 # this used to kill the serial thread
+    return failures
+
+
+def new_path(lines,state):
+    decoder=FrameDecoder()
+    for nl in lines:
+        frame=decoder.decode(nl)
+        if frame is not None:
+            state.apply_frame(frame)
+    return decoder
+
+
+def timed(fn,*args,repeats=5):
+    best=None
+    for _ in range(repeats):
+        start=time.perf_counter()
+        result=fn(*args)
+        elapsed=time.perf_counter()-start
+        best=elapsed if best is None else min(best,elapsed)
+    return best,result
+
+
+if __name__=="__main__":
+    if len(sys.argv)>1:
+        with open(sys.argv[1],encoding="ascii",errors="replace") as f:
+            frames=[line.strip() for line in f if line.strip()]
+    else:
+        frames=SAMPLE_FRAMES
+    lines=(frames*(100000//len(frames)+1))[:100000]
+
+    old_s,failures=timed(old_path,lines,ValveTempState.new_blank())
+    new_s,decoder=timed(new_path,lines,ValveTempState.new_blank())
+    print(f"{len(lines)} lines")
+    print(f"  json.loads+setattr: {old_s*1e6/len(lines):6.2f}us/line ({failures} lines would have raised)")
+    print(f"  FrameDecoder:       {new_s*1e6/len(lines):6.2f}us/line ({decoder})")
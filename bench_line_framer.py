@@ -0,0 +1,101 @@
+import logging
+logging.basicConfig(level=logging.INFO)
+
+"""
+
+Throughput benchmark for the serial line framing
+
+Opens a pty pair, points a real serial.Serial at the slave end (so it's
+the same pyserial code path as /dev/ttyACM0) and has a writer thread
+pump fake sensor board output into the master end as fast as it can.
+
+Compares the old byte-at-a-time reader with the chunked LineFramer.
+
+    uv run bench_line_framer.py [number_of_lines]
+
+"""
+
+import os
+import pty
+import sys
+import threading
+import time
+import tty
+
+import serial
+
+from line_framer import LineFramer, read_lines, READ_CHUNK_SIZE
+
+SAMPLE_LINES=[b'{"OutHW":52.31,"RetHW":44.12,"OutRad":61.5,"RetRad":49.75,"hw_valve_open":true,"rad_valve_open":false,"oil_flowing":true}\r\n',
+              b'Debug: valve switch read 1023\n',
+              b'{"OutHW":52.25,"RetHW":44.19,"OutRad":61.44,"RetRad":49.81,"hw_valve_open":true,"rad_valve_open":false,"oil_flowing":true}\r',
+              b'\n',
+              b'{"OutHW":52.19,"RetHW":44.25,"OutRad":61.38,"RetRad":49.88,"hw_valve_open":true,"rad_valve_open":true,"oil_flowing":true}\n']
+
+
+def make_payload(line_count:int)->bytes:
+    return b"".join(SAMPLE_LINES[i%len(SAMPLE_LINES)] for i in range(line_count))
+
+
+def writer(master_fd:int,payload:bytes):
+    view=memoryview(payload)
+    while view:
+        written=os.write(master_fd,view[:4096])
+        view=view[written:]
+
+
+def read_bytewise(ser,expected_lines:int)->int:
+    # The original ValvesTemps.run approach
+    seen=0
+    nl:str=""
+    while seen<expected_lines:
+        x=ser.read(1)
+        if not x:
+            break
+        if x==b'\r' or x==b'\n':
+            if nl:
+                seen+=1
+            nl=""
+        else:
+            nl+=x.decode("ascii")
+    return seen
+
+
+def read_chunked(ser,expected_lines:int)->int:
+    framer=LineFramer()
+    read_buffer=bytearray(READ_CHUNK_SIZE)
+    seen=0
+    idle_since=time.perf_counter()
+    while seen<expected_lines:
+        got=len(read_lines(ser,framer,read_buffer))
+        seen+=got
+        if got:
+            idle_since=time.perf_counter()
+        elif time.perf_counter()-idle_since>2:
+            break
+    return seen
+
+
+def run_case(name:str,reader,line_count:int):
+    master_fd,slave_fd=pty.openpty()
+    tty.setraw(slave_fd)
+    payload=make_payload(line_count)
+    expected=sum(1 for line in payload.replace(b"\r",b"\n").split(b"\n") if line)
+    with serial.Serial(os.ttyname(slave_fd),115200,timeout=1) as ser:
+        feeder=threading.Thread(target=writer,args=(master_fd,payload),daemon=True)
+        started=time.perf_counter()
+        cpu_started=time.process_time()
+        feeder.start()
+        seen=reader(ser,expected)
+        elapsed=time.perf_counter()-started
+        cpu=time.process_time()-cpu_started
+        feeder.join(timeout=5)
+    os.close(master_fd)
+    os.close(slave_fd)
+    print(f"{name:>10}: {seen}/{expected} lines, {len(payload)/elapsed/1e6:7.2f} MB/s, {seen/elapsed:9.0f} lines/s, cpu {cpu:.2f}s")
+
+
+if __name__=="__main__":
+    line_count=int(sys.argv[1]) if len(sys.argv)>1 else 20000
+    run_case("bytewise",read_bytewise,line_count)
+    run_case("chunked",read_chunked,line_count)
@@ -0,0 +1,75 @@
+import logging
+logging.basicConfig(level=logging.WARNING)
+
+"""
+
+Checks the system state encodings round trip and times parsing them
+
+Makes random states, checks each comes back the same through both the
+JSON and the compact encoding, then times protocol.parse() on each
+against the way it used to be done (json.loads, then fromisoformat on
+each of the times).
+
+    uv run bench_protocol.py [number_of_states]
+
+"""
+
+import datetime
+import json
+import random
+import sys
+import time
+
+import protocol
+from protocol import SysHeatState
+
+
+def random_states(count:int,seed:int=1)->list[SysHeatState]:
+    rng=random.Random(seed)
+    base=datetime.datetime(2024,11,2,18,0)
+    # Like a real server, the boost times only change now and then
+    boosts=[base+datetime.timedelta(minutes=rng.randrange(-600,600)) for _ in range(8)]
+    return [SysHeatState(rng.random()<0.5,rng.random()<0.5,
+                         rng.choice(boosts),
+                         round(rng.uniform(20,65),1),
+                         base+datetime.timedelta(seconds=rng.randrange(0,86400)),
+                         rng.choice(boosts)) for _ in range(count)]
+
+
+def old_parse(body:bytes)->SysHeatState:
+    # How it was done before protocol.py
+    jsondict=json.loads(body)
+    return SysHeatState(jsondict["heating_currently_on"],
+                        jsondict["hot_water_currently_on"],
+                        datetime.datetime.fromisoformat(jsondict["heating_boost_timeout"]),
+                        jsondict["hot_water_temperature"],
+                        datetime.datetime.fromisoformat(jsondict["hot_water_last_temp_dt"]),
+                        datetime.datetime.fromisoformat(jsondict["hot_water_boost_requested"]))
+
+
+def timed(fn,bodies,*args):
+    start=time.perf_counter()
+    for body in bodies:
+        fn(body,*args)
+    return time.perf_counter()-start
+
+
+if __name__=="__main__":
+    count=int(sys.argv[1]) if len(sys.argv)>1 else 100000
+    states=random_states(count)
+    json_bodies=[json.dumps(state.to_JSON()).encode() for state in states]
+    compact_bodies=[state.to_compact() for state in states]
+
+    mismatches=sum(1 for state,json_body,compact_body in zip(states,json_bodies,compact_bodies)
+                   if protocol.parse(json_body,protocol.JSON_TYPE)!=state or protocol.parse(compact_body,protocol.COMPACT_TYPE)!=state)
+    if mismatches:
+        raise SystemExit(f"{mismatches} states that didn't come back the same")
+
+    old_s=timed(old_parse,json_bodies)
+    json_s=timed(protocol.parse,json_bodies,protocol.JSON_TYPE)
+    compact_s=timed(protocol.parse,compact_bodies,protocol.COMPACT_TYPE)
+    json_bytes=sum(len(body) for body in json_bodies)/count
+    print(f"{count} states, both encodings round trip")
+    print(f"  old JSON parse: {old_s*1e6/count:6.2f}us/state, {json_bytes:.0f} bytes")
+    print(f"  JSON:           {json_s*1e6/count:6.2f}us/state, {json_bytes:.0f} bytes")
+    print(f"  compact:        {compact_s*1e6/count:6.2f}us/state, {protocol.COMPACT.size} bytes")
@@ -0,0 +1,144 @@
+import logging
+if __name__=="__main__":
+    logging.basicConfig(level=logging.DEBUG)
+
+"""
+
+Where everything gets the time from, and how it waits
+
+The state machines, MainState, the Wakeup and the server fetcher all take
+a clock rather than calling time.time()/time.sleep() directly. Normally
+that's real_clock, but tests, replays and the simulator can use a
+ManualClock instead. That only moves when it's told to, so a 3 minute
+valve timeout or a 10 minute staleness window can be skipped with
+clock.advance(180) instead of waiting for it.
+
+Threads waiting on a ManualClock's wait_condition() or sleep() are woken
+by advance() and set(), so an idle one (eg a TimerService with nothing to
+do) doesn't wake at all. A wait() on an Event can only be woken by the
+event, so that one still looks at the manual time every poll_s while it
+has a timeout.
+
+"""
+
+from abc import ABC, abstractmethod
+import datetime
+import threading
+import time
+import weakref
+
+
+class Clock(ABC):
+    # A clock missing any of the abstract methods fails when it's made, not part way through the control loop
+    @abstractmethod
+    def time(self)->float:
+        # seconds since the epoch, as time.time()
+        ...
+
+    def now(self)->datetime.datetime:
+        return datetime.datetime.fromtimestamp(self.time())
+
+    @abstractmethod
+    def sleep(self,seconds:float):
+        ...
+
+    @abstractmethod
+    def wait(self,event:threading.Event,timeout_s:float|None=None)->bool:
+        """
+            As event.wait(timeout_s), timed on this clock
+        """
+
+    @abstractmethod
+    def wait_condition(self,condition:threading.Condition,timeout_s:float|None=None)->bool:
+        """
+            As condition.wait(timeout_s), called with the condition held
+            It may return early, so callers loop and check their deadline with time()
+        """
+
+
+class RealClock(Clock):
+    def time(self)->float:
+        return time.time()
+
+    def now(self)->datetime.datetime:
+        return datetime.datetime.now()
+
+    def sleep(self,seconds:float):
+        time.sleep(seconds)
+
+    def wait(self,event:threading.Event,timeout_s:float|None=None)->bool:
+        return event.wait(timeout_s)
+
+    def wait_condition(self,condition:threading.Condition,timeout_s:float|None=None)->bool:
+        return condition.wait(timeout_s)
+
+
+class ManualClock(Clock):
+    def __init__(self,start:float|None=None,poll_s:float=0.005):
+        """
+            start is the time.time() to start at, defaults to the real time now
+            poll_s is how often (in real seconds) waiting threads look at the time again
+        """
+        self.lock=threading.Lock()
+        self._time=time.time() if start is None else start
+        self.poll_s=poll_s
+        self.waiting:weakref.WeakSet[threading.Condition]=weakref.WeakSet() # conditions to notify when the time moves
+
+    def __str__(self):
+        return f"Manual clock at {self.now().isoformat(sep=' ',timespec='seconds')}"
+
+    def time(self)->float:
+        return self._time
+
+    def advance(self,seconds:float)->float:
+        if seconds<0:
+            raise ValueError(f"Clocks don't go backwards, can't advance by {seconds}")
+        with self.lock:
+            self._time+=seconds
+            now=self._time
+        self.notify_waiting()
+        return now
+
+    def set(self,timestamp:float):
+        with self.lock:
+            if timestamp<self._time:
+                raise ValueError(f"Clocks don't go backwards, can't set {timestamp} which is before {self._time}")
+            self._time=timestamp
+        self.notify_waiting()
+
+    def notify_waiting(self):
+        with self.lock:
+            conditions=list(self.waiting)
+        for condition in conditions:
+            with condition:
+                condition.notify_all()
+
+    def sleep(self,seconds:float):
+        deadline=self._time+seconds
+        condition=threading.Condition()
+        with condition:
+            while self._time<deadline:
+                self.wait_condition(condition,deadline-self._time)
+
+    def wait(self,event:threading.Event,timeout_s:float|None=None)->bool:
+        if timeout_s is None:
+            return event.wait()
+        deadline=self._time+timeout_s
+        while not event.wait(self.poll_s):
+            if self._time>=deadline:
+                return False
+        return True
+
+    def wait_condition(self,condition:threading.Condition,timeout_s:float|None=None)->bool:
+        with self.lock:
+            self.waiting.add(condition)
+        if timeout_s is None:
+            return condition.wait()
+        if timeout_s<=0:
+            return False
+        # advance() notifies us, the real time limit is only a backstop for an advance that
+        # came between the caller reading the time and us adding the condition above
+        return condition.wait(1.0)
+
+
+real_clock=RealClock()
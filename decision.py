@@ -0,0 +1,186 @@
+import logging
+if __name__=="__main__":
+    logging.basicConfig(level=logging.DEBUG)
+
+"""
+
+What the heating and hot water circuits should be doing, with no side effects
+
+decide() takes the demand from the server, a sensor snapshot and the
+current circuit states and returns a Decision: the next circuit states and
+what every relay should be set to. It doesn't touch the hardware, log or
+read the clock, so it can be run offline against as many scenarios as you
+like, and MainState just applies what it returns.
+
+The rules are written out readably in next_hot_water(), next_heating()
+and relays_for(), but everything they depend on comes down to a handful
+of booleans and the two circuit states, so they are run over every
+combination once at import and decide() is then just a table lookup.
+
+"""
+
+from dataclasses import dataclass
+import itertools
+
+from machine_definition import MachineDefinition
+import settings
+
+CIRCUIT_STATES=("OFF","OPENING_VALVE","HEATING")
+
+# What each circuit may change to, the table below is checked against it at import
+CIRCUIT_MACHINE=MachineDefinition("CircuitState",
+                                  initial="OFF",
+                                  states=list(CIRCUIT_STATES),
+                                  transitions={"OFF":["OPENING_VALVE"],
+                                               "OPENING_VALVE":["HEATING","OFF"],
+                                               "HEATING":["OFF"]})
+
+# Order the relays are given to RelayBank.apply, the boiler last so it comes on after the pumps
+RELAY_NAMES=("hot_water_valve","heating_valve","hot_water_pump","heating_pump","boiler_heat_req")
+
+
+@dataclass(frozen=True,slots=True)
+class Decision:
+    hot_water:str
+    heating:str
+    relays:tuple[tuple[str,bool],...] # (relay name, on) in RELAY_NAMES order
+    heating_valve_timed_out:bool # the heating pump was started without the valve reporting open
+    notes:tuple[str,...] # what changed and why, for the log
+
+    def relay_states(self)->dict[str,bool]:
+        return dict(self.relays)
+
+
+def demand(server_state,hot_water_off_temperature:float=settings.HOT_WATER_OFF_TEMPERATURE)->tuple[bool,bool]:
+    """
+        (heat water, heat radiators) wanted by the server state
+    """
+    heat_water=server_state.hot_water_temperature<hot_water_off_temperature and server_state.hot_water_currently_on
+    return bool(heat_water),bool(server_state.heating_currently_on)
+
+
+def next_hot_water(state:str,heat_water:bool,hw_valve_open:bool)->tuple[str,str|None]:
+    if heat_water:
+        match state:
+            case "OFF":
+                return "OPENING_VALVE","Hotter water demanded, starting to open valve"
+            case "OPENING_VALVE":
+                if hw_valve_open:
+                    return "HEATING","Hot water valve open, heating water"
+    else:
+        match state:
+            case "HEATING":
+                return "OFF","Hot water stopped"
+            case "OPENING_VALVE":
+                return "OFF","Hot water stopped early"
+    return state,None
+
+
+def next_heating(state:str,heat_radiators:bool,rad_valve_open:bool,valve_timed_out:bool)->tuple[str,str|None,bool]:
+    # (next state, note, whether the valve timeout forced it)
+    if heat_radiators:
+        match state:
+            case "OFF":
+                return "OPENING_VALVE","Heating demanded, started opening heating valve",False
+            case "OPENING_VALVE":
+                if rad_valve_open:
+                    return "HEATING","Heating valve open, heating radiators",False
+                if valve_timed_out:
+                    # Been opening too long, something is wrong with the valve switch but better warm than cold
+                    return "HEATING",f"Heating valve failed to open in {settings.HEATING_VALVE_TIMEOUT_S/60:.0f} minutes, turning pump on anyway!",True
+    else:
+        match state:
+            case "HEATING":
+                return "OFF","Heating stopped",False
+            case "OPENING_VALVE":
+                return "OFF","Heating stopped early",False
+    return state,None,False
+
+
+def relays_for(hot_water:str,heating:str,heat_water:bool,heat_radiators:bool)->tuple[tuple[str,bool],...]:
+    # The valves are open unless a circuit is off, its pump only runs once it's heating
+    boiler_required=(heat_water and hot_water=="HEATING") or (heat_radiators and heating=="HEATING")
+    return (("hot_water_valve",hot_water!="OFF"),
+            ("heating_valve",heating!="OFF"),
+            ("hot_water_pump",hot_water=="HEATING"),
+            ("heating_pump",heating=="HEATING"),
+            ("boiler_heat_req",boiler_required))
+
+
+def evaluate_rules(heat_water:bool,heat_radiators:bool,hw_valve_open:bool,rad_valve_open:bool,
+                   heating_valve_timed_out:bool,hot_water:str,heating:str)->Decision:
+    """
+        The rules run directly, used to build the table and handy for checking it
+    """
+    next_hw,hw_note=next_hot_water(hot_water,heat_water,hw_valve_open)
+    next_rad,rad_note,timed_out=next_heating(heating,heat_radiators,rad_valve_open,heating_valve_timed_out)
+    return Decision(next_hw,next_rad,
+                    relays_for(next_hw,next_rad,heat_water,heat_radiators),
+                    timed_out,
+                    tuple(note for note in (hw_note,rad_note) if note))
+
+
+def table_index(heat_water:bool,heat_radiators:bool,hw_valve_open:bool,rad_valve_open:bool,
+                heating_valve_timed_out:bool,hot_water:str,heating:str)->int:
+    flags=(heat_water<<4)|(heat_radiators<<3)|(hw_valve_open<<2)|(rad_valve_open<<1)|heating_valve_timed_out
+    return (flags*len(CIRCUIT_STATES)+_STATE_INDEX[hot_water])*len(CIRCUIT_STATES)+_STATE_INDEX[heating]
+
+
+_STATE_INDEX={state:i for i,state in enumerate(CIRCUIT_STATES)}
+
+
+def _build_table()->tuple[Decision,...]:
+    table:list[Decision|None]=[None]*(32*len(CIRCUIT_STATES)**2)
+    for flags in itertools.product((False,True),repeat=5):
+        for hot_water in CIRCUIT_STATES:
+            for heating in CIRCUIT_STATES:
+                decision=evaluate_rules(*flags,hot_water,heating)
+                # Every state the rules can produce must be a transition the circuits allow,
+                # stored as the enum members so SimpleState doesn't have to look them up again
+                for from_state,to_state in ((hot_water,decision.hot_water),(heating,decision.heating)):
+                    if to_state!=from_state:
+                        CIRCUIT_MACHINE.check(CIRCUIT_MACHINE.state(from_state),CIRCUIT_MACHINE.state(to_state),"of the decision rules")
+                table[table_index(*flags,hot_water,heating)]=Decision(CIRCUIT_MACHINE.state(decision.hot_water),
+                                                                      CIRCUIT_MACHINE.state(decision.heating),
+                                                                      decision.relays,
+                                                                      decision.heating_valve_timed_out,
+                                                                      decision.notes)
+    return tuple(table)
+
+
+TABLE=_build_table()
+
+
+def lookup(heat_water:bool,heat_radiators:bool,hw_valve_open:bool,rad_valve_open:bool,
+           heating_valve_timed_out:bool,hot_water:str,heating:str)->Decision:
+    # The precomputed equivalent of evaluate_rules()
+    return TABLE[table_index(heat_water,heat_radiators,hw_valve_open,rad_valve_open,heating_valve_timed_out,hot_water,heating)]
+
+
+def decide(server_state,sensors,hot_water:str,heating:str,heating_since:float,now:float,
+           heating_valve_timeout_s:float=settings.HEATING_VALVE_TIMEOUT_S)->Decision:
+    """
+        server_state is a SysHeatState, sensors a ValveTempSnapshot
+        heating_since is the time.time() the heating circuit last changed state
+
+        If the sensors are stale (the board's gone, or its last frame is older than
+        SENSOR_STALE_AFTER_S at now) the valves are taken to be shut, so nothing
+        starts a pump on an old reading. A circuit that's already heating carries
+        on, and the heating valve timeout still gets the radiators going.
+    """
+    heat_water,heat_radiators=demand(server_state)
+    valves_known=not sensors.is_stale(now=now)
+    return lookup(heat_water,heat_radiators,
+                  valves_known and bool(sensors.hw_valve_open),valves_known and bool(sensors.rad_valve_open),
+                  now-heating_since>=heating_valve_timeout_s,str(hot_water),str(heating))
+
+
+if __name__=="__main__":
+    # Print the whole table
+    for flags in itertools.product((False,True),repeat=5):
+        for hot_water in CIRCUIT_STATES:
+            for heating in CIRCUIT_STATES:
+                decision=lookup(*flags,hot_water,heating)
+                on=[name for name,is_on in decision.relays if is_on]
+                print(f"water {flags[0]:d} rads {flags[1]:d} hw open {flags[2]:d} rad open {flags[3]:d} timed out {flags[4]:d} "
+                      f"{hot_water:>13}/{heating:<13} -> {decision.hot_water:>13}/{decision.heating:<13} on: {', '.join(on) or '-'}")
@@ -0,0 +1,201 @@
+import logging
+if __name__=="__main__":
+    logging.basicConfig(level=logging.DEBUG)
+
+"""
+
+Delivers state machine events to their subscribers from a thread of its own
+
+Normally StateMachine.set_state calls every subscriber itself, in the
+middle of the transition, so a slow subscriber holds the machine up and
+one that raises breaks the transition. Given an EventDispatcher, the
+machine just posts the event here and carries on.
+
+Each machine gets its own queue, so its events are always delivered in
+the order they happened, and the dispatcher takes one event from each
+machine in turn so a busy machine can't starve the others. Queues are
+bounded at max_depth; when one is full the OverflowPolicy says whether to
+drop the oldest event, drop the new one, or make the poster wait. A
+subscriber that posts while we're delivering to it is on our own thread,
+so it can't wait for room that only it could make; its event is dropped
+instead.
+
+How long each subscriber takes, and how long events waited in the queue,
+is kept in SubscriberStats for display, one for each subscriber (so two
+lambdas, or the same method of two machines, are counted separately).
+They're kept as long as the dispatcher is, which suits the machines'
+fixed subscriber lists rather than a new lambda for every post.
+
+"""
+
+from collections import deque
+from dataclasses import dataclass
+from enum import Enum
+import threading
+import time
+from typing import Callable
+
+
+class OverflowPolicy(Enum):
+    DROP_OLDEST = 0 # subscribers see the latest events, which is what matters when they just look at the current state
+    DROP_NEWEST = 1
+    BLOCK = 2 # the poster waits for room, so nothing is lost but set_state can be held up (except on our own thread, where it's dropped)
+
+
+@dataclass(slots=True)
+class SubscriberStats:
+    name:str
+    calls:int=0
+    errors:int=0
+    total_s:float=0.0
+    max_s:float=0.0
+    max_queued_s:float=0.0 # longest an event waited before this subscriber got it
+
+    @property
+    def mean_s(self)->float:
+        return self.total_s/self.calls if self.calls else 0.0
+
+    def __str__(self):
+        return (f"{self.calls} calls, {self.errors} errors, mean {self.mean_s*1000:.2f}ms, "
+                f"max {self.max_s*1000:.2f}ms, max queued {self.max_queued_s*1000:.2f}ms")
+
+
+@dataclass(slots=True)
+class Event:
+    source:str
+    subscribers:tuple[Callable,...]
+    kwargs:dict
+    posted_at:float
+
+
+class EventDispatcher(threading.Thread):
+    def __init__(self,*,max_depth:int=64,overflow:OverflowPolicy=OverflowPolicy.DROP_OLDEST,name:str="EventDispatcher"):
+        super().__init__(daemon=True)
+        self.name=name
+        self.max_depth=max_depth
+        self.overflow=overflow
+        self.condition=threading.Condition()
+        self.queues:dict[str,deque[Event]]={}
+        self.ready:deque[str]=deque() # sources with events waiting, in turn
+        self.stop_requested=False
+        self.busy=False # delivering an event right now
+
+        self.stats:dict[Callable,SubscriberStats]={} # by the subscriber itself, bound methods of the same object are equal
+        self.posted:int=0
+        self.delivered:int=0
+        self.dropped:int=0
+
+    def __str__(self):
+        lines=[f"{self.name}: {self.posted} posted, {self.delivered} delivered, {self.dropped} dropped, {self.pending()} waiting"]
+        lines+=[f"    {stats.name}: {stats}" for stats in list(self.stats.values())]
+        return "\n".join(lines)
+
+    def pending(self)->int:
+        with self.condition:
+            return sum(len(queue) for queue in self.queues.values())
+
+    def post(self,source:str,subscribers:list[Callable],**kwargs)->bool:
+        """
+            Queues subscriber(**kwargs) for each of the subscribers, in source's order
+            returns False if the event was dropped because source's queue was full
+            (with BLOCK that's only when it's posted from a subscriber, on our own thread)
+        """
+        event=Event(source,tuple(subscribers),kwargs,time.perf_counter())
+        with self.condition:
+            if not self.is_alive() and not self.stop_requested:
+                self.start()
+            queue=self.queues.setdefault(source,deque())
+            if len(queue)>=self.max_depth:
+                match self.overflow:
+                    case OverflowPolicy.DROP_NEWEST:
+                        self.dropped+=1
+                        logging.warning(f"Dropped an event from {source}, its queue is full")
+                        return False
+                    case OverflowPolicy.DROP_OLDEST:
+                        queue.popleft()
+                        self.dropped+=1
+                        logging.warning(f"Dropped the oldest event from {source}, its queue is full")
+                    case OverflowPolicy.BLOCK if threading.current_thread() is self:
+                        # Only we make room, so waiting here would never end
+                        self.dropped+=1
+                        logging.error(f"Dropped an event from {source} posted by one of its subscribers, its queue is full")
+                        return False
+                    case OverflowPolicy.BLOCK:
+                        while len(queue)>=self.max_depth and not self.stop_requested:
+                            self.condition.wait()
+            if not queue:
+                self.ready.append(source)
+            queue.append(event)
+            self.posted+=1
+            self.condition.notify_all()
+        return True
+
+    def deliver(self,event:Event):
+        for subscriber in event.subscribers:
+            stats=self.stats.get(subscriber)
+            if stats is None:
+                stats=self.stats.setdefault(subscriber,SubscriberStats(_subscriber_name(subscriber)))
+            call_start=time.perf_counter()
+            stats.max_queued_s=max(stats.max_queued_s,call_start-event.posted_at)
+            try:
+                subscriber(**event.kwargs)
+            except Exception:
+                stats.errors+=1
+                logging.exception(f"Subscriber {stats.name} failed handling {event.kwargs.get('type')} from {event.source}")
+            elapsed=time.perf_counter()-call_start
+            stats.calls+=1
+            stats.total_s+=elapsed
+            stats.max_s=max(stats.max_s,elapsed)
+        self.delivered+=1
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.ready and not self.stop_requested:
+                    self.condition.wait()
+                if not self.ready:
+                    return # stopped with nothing left to deliver
+                source=self.ready.popleft()
+                queue=self.queues[source]
+                event=queue.popleft()
+                if queue:
+                    self.ready.append(source) # back of the line for its next one
+                self.busy=True
+                self.condition.notify_all() # room for a blocked poster
+            try:
+                self.deliver(event)
+            finally:
+                with self.condition:
+                    self.busy=False
+                    self.condition.notify_all()
+
+    def flush(self,timeout_s:float|None=None)->bool:
+        """
+            Waits until everything posted so far has been delivered
+        """
+        deadline=None if timeout_s is None else time.monotonic()+timeout_s
+        with self.condition:
+            while self.ready or self.busy:
+                remaining=None if deadline is None else deadline-time.monotonic()
+                if remaining is not None and remaining<=0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def stop(self,block_timeout_s:float=2):
+        """
+            Delivers whatever is already queued, then stops
+        """
+        with self.condition:
+            self.stop_requested=True
+            self.condition.notify_all()
+        if self.is_alive():
+            self.join(block_timeout_s)
+
+
+def _subscriber_name(subscriber:Callable)->str:
+    # eg "StateMachine.step of heating", so the same method of two machines can be told apart
+    name=getattr(subscriber,"__qualname__",repr(subscriber))
+    owner=getattr(subscriber,"__self__",None)
+    owner_name=getattr(owner,"name",None)
+    return f"{name} of {owner_name}" if isinstance(owner_name,str) else name
@@ -0,0 +1,182 @@
+import logging
+if __name__=="__main__":
+    logging.basicConfig(level=logging.DEBUG)
+
+"""
+
+Pushes state changes to any number of Server-Sent Events clients
+
+    hub=EventHub(initial=main_state.status)
+    hub.publish("relay",{"relay":"heating_pump","on":True})
+    ...
+    subscription=hub.subscribe()
+    return Response(subscription.stream(),mimetype="text/event-stream")
+
+The controller's threads call publish(), which formats the event once and
+appends the same string to every client's buffer, it never waits on a
+client. That's done under a small lock of its own, so events from
+different threads reach every client in the order of their ids. Each
+client's buffer holds EVENTS_CLIENT_BUFFER events; a client that falls
+that far behind is dropped (it's sent a "closed" event if it's still
+there, and EventSource will reconnect and start again from a fresh
+"status" event) rather than slowing down whoever is publishing.
+close_all() ends every stream the same way when we shut down.
+
+Temperatures go out through reading(), as json.dumps would write a NaN
+from a bad sensor as NaN, which isn't JSON and breaks the client's parse.
+
+Hooks for the things we send, all safe to call from any thread:
+    state_changed   SimpleState listener, "state" events
+    state_machine_event  StateMachine subscriber, "state" events
+    relay_switched  Relay.transition_listeners, "relay" events
+    record          a sensor feed recorder, "sample" events at most every EVENTS_SAMPLE_INTERVAL_S
+
+"""
+
+from collections import deque
+import itertools
+import json
+import math
+import threading
+import time
+from typing import Callable, Iterator
+
+import settings
+
+
+def reading(temperature:float)->float|None:
+    # A temperature for an event or the status, None (null) if the sensor board sent something that isn't a number
+    return temperature if math.isfinite(temperature) else None
+
+
+class Subscription:
+    def __init__(self,hub:"EventHub",max_buffered:int):
+        self.hub=hub
+        self.max_buffered=max_buffered
+        self.buffer:deque[str]=deque()
+        self.ready=threading.Event() # set when there's something in the buffer, or we're ending
+        self.end_reason:str|None=None # why the stream is ending, once it is
+        self.closed=False
+
+    def put(self,message:str)->bool:
+        # Called by publish, False if this client is too far behind to take any more
+        if len(self.buffer)>=self.max_buffered:
+            self.end(f"fell more than {self.max_buffered} events behind")
+            return False
+        self.buffer.append(message)
+        if not self.ready.is_set(): # set() takes a lock, and the client clears it before draining so this can't miss one
+            self.ready.set()
+        return True
+
+    def end(self,reason:str):
+        # Makes stream() send a "closed" event and finish, from any thread
+        self.end_reason=reason
+        self.ready.set()
+
+    def close(self):
+        if not self.closed:
+            self.closed=True
+            self.hub.unsubscribe(self)
+
+    def stream(self,heartbeat_s:float=settings.EVENTS_HEARTBEAT_S)->Iterator[str]:
+        """
+            The text/event-stream for this client, finishes once end() is called
+            and unsubscribes when the client goes away
+        """
+        try:
+            yield "retry: 5000\n\n"
+            while self.end_reason is None:
+                if not self.ready.wait(heartbeat_s):
+                    yield ": still here\n\n" # fails once the client has gone, which ends us
+                    continue
+                self.ready.clear() # before draining, so anything added meanwhile sets it again
+                while self.buffer:
+                    yield self.buffer.popleft()
+            while self.buffer: # whatever came in before the end, eg the relays going safe
+                yield self.buffer.popleft()
+            yield EventHub.format(0,"closed",{"reason":self.end_reason})
+        finally:
+            self.close()
+
+
+class EventHub:
+    def __init__(self,*,initial:Callable[[],dict]|None=None,max_buffered:int=settings.EVENTS_CLIENT_BUFFER,
+                 sample_interval_s:float|None=settings.EVENTS_SAMPLE_INTERVAL_S):
+        """
+            initial() is sent to each new client as a "status" event, so it starts with the full picture
+        """
+        self.initial=initial
+        self.max_buffered=max_buffered
+        self.sample_interval_s=sample_interval_s
+        self.lock=threading.Lock() # only for (un)subscribing
+        self.publish_lock=threading.Lock() # so ids go out in order, from whichever thread is publishing
+        self.subscriptions:tuple[Subscription,...]=()
+        self.ids=itertools.count(1)
+        self.last_sample_time:float=0.0
+        self.published:int=0
+        self.dropped_clients:int=0
+
+    def __str__(self):
+        return f"Events: {len(self.subscriptions)} clients, {self.published} published, {self.dropped_clients} slow clients dropped"
+
+    @staticmethod
+    def format(event_id:int,event_type:str,data:dict)->str:
+        return f"id: {event_id}\nevent: {event_type}\ndata: {json.dumps(data,separators=(',',':'))}\n\n"
+
+    def subscribe(self)->Subscription:
+        # Registered before the status is made, so nothing that happens in between is missed
+        subscription=Subscription(self,self.max_buffered)
+        with self.lock:
+            self.subscriptions=(*self.subscriptions,subscription)
+        if self.initial is not None:
+            status=self.initial()
+            with self.publish_lock:
+                subscription.put(self.format(next(self.ids),"status",status))
+        logging.info(f"Events client connected, {len(self.subscriptions)} now")
+        return subscription
+
+    def unsubscribe(self,subscription:Subscription):
+        with self.lock:
+            self.subscriptions=tuple(s for s in self.subscriptions if s is not subscription)
+        logging.info(f"Events client gone, {len(self.subscriptions)} left")
+
+    def close_all(self,reason:str="shutting down"):
+        for subscription in self.subscriptions:
+            subscription.end(reason)
+
+    def publish(self,event_type:str,data:dict):
+        if not self.subscriptions:
+            return
+        dropped=[]
+        with self.publish_lock:
+            message=self.format(next(self.ids),event_type,data)
+            self.published+=1
+            for subscription in self.subscriptions:
+                if not subscription.put(message):
+                    dropped.append(subscription)
+                    self.dropped_clients+=1
+        for subscription in dropped: # unsubscribing takes the other lock, so not while we hold this one
+            logging.warning(f"Dropped an events client that fell {self.max_buffered} events behind")
+            subscription.close()
+
+    def state_changed(self,*,name:str,old_state:str,new_state:str,type:str,**kwargs):
+        self.publish("state",{"machine":name,"from":old_state,"to":new_state,"time":time.time()})
+
+    def state_machine_event(self,*,state_machine,type:str,new_state:str|None=None,reason:str="",**kwargs):
+        # No "from", through a dispatcher the machine may have moved on again by the time we get this
+        if type=="STATE_CHANGE":
+            self.publish("state",{"machine":state_machine.name,"to":new_state,"reason":reason,"time":time.time()})
+        else:
+            self.publish("timeout",{"machine":state_machine.name,"state":state_machine.state,"time":time.time()})
+
+    def relay_switched(self,*,relay,is_on:bool,type:str,**kwargs):
+        self.publish("relay",{"relay":relay.name,"on":is_on,"time":time.time()})
+
+    def record(self,timestamp:float,snapshot):
+        if self.sample_interval_s is None or not self.subscriptions or timestamp-self.last_sample_time<self.sample_interval_s:
+            return
+        self.last_sample_time=timestamp
+        self.publish("sample",{"OutHW":reading(snapshot.OutHW),"RetHW":reading(snapshot.RetHW),
+                               "OutRad":reading(snapshot.OutRad),"RetRad":reading(snapshot.RetRad),
+                               "hw_valve_open":snapshot.hw_valve_open,"rad_valve_open":snapshot.rad_valve_open,
+                               "oil_flowing":snapshot.oil_flowing,"time":timestamp})
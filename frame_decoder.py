@@ -0,0 +1,113 @@
+import logging
+if __name__=="__main__":
+    logging.basicConfig(level=logging.DEBUG)
+
+"""
+
+Decodes the JSON frames sent by the sensor board
+
+The board only ever sends a flat object with some or all of these keys:
+    {"OutHW":52.3,"RetHW":44.1,"OutRad":61.5,"RetRad":49.7,
+     "hw_valve_open":true,"rad_valve_open":false,"oil_flowing":true}
+(the flags sometimes come through as 1/0), and any other line is debug
+chatter from the sketch.
+
+The board normally sends the full frame in that order, so that exact layout
+is matched with a single precompiled regex and converted directly. Anything
+else (different order, missing keys, spaces) falls back to json and is
+checked key by key. json takes NaN, Infinity and numbers too big for a
+float, so temperatures have to be finite as well as numbers.
+
+Anything that doesn't fit that shape is counted and dropped rather than
+raised, a bad line must never take the serial thread down with it.
+
+"""
+
+import json
+import math
+import re
+
+FLOAT_FIELDS=("OutHW","RetHW","OutRad","RetRad")
+BOOL_FIELDS=("hw_valve_open","rad_valve_open","oil_flowing")
+KNOWN_FIELDS=frozenset(FLOAT_FIELDS+BOOL_FIELDS)
+
+_decode_json=json.JSONDecoder().decode
+
+_NUMBER=r'(-?\d+(?:\.\d+)?)'
+_FLAG=r'(true|false|1|0)'
+_CANONICAL_FRAME=re.compile(r'\{"OutHW":'+_NUMBER+r',"RetHW":'+_NUMBER+r',"OutRad":'+_NUMBER+r',"RetRad":'+_NUMBER+
+                            r',"hw_valve_open":'+_FLAG+r',"rad_valve_open":'+_FLAG+r',"oil_flowing":'+_FLAG+r'\}$')
+_TRUE_FLAGS=frozenset(("true","1"))
+
+
+class FrameDecoder:
+    def __init__(self):
+        self.parsed:int=0
+        self.rejected:int=0
+        self.debug_lines:int=0
+        self.last_rejected:str=""
+
+    def __str__(self):
+        return f"Frames parsed: {self.parsed} rejected: {self.rejected} debug lines: {self.debug_lines}"
+
+    def decode(self,line:str)->dict|None:
+        """
+            Returns a dict of just the fields in the frame, converted to float/bool
+            or None if the line isn't a usable frame
+        """
+        if not line.startswith("{"):
+            self.debug_lines+=1
+            return None
+
+        match=_CANONICAL_FRAME.match(line)
+        if match:
+            out_hw,ret_hw,out_rad,ret_rad,hw_valve,rad_valve,oil=match.groups()
+            self.parsed+=1
+            return {"OutHW":float(out_hw),
+                    "RetHW":float(ret_hw),
+                    "OutRad":float(out_rad),
+                    "RetRad":float(ret_rad),
+                    "hw_valve_open":hw_valve in _TRUE_FLAGS,
+                    "rad_valve_open":rad_valve in _TRUE_FLAGS,
+                    "oil_flowing":oil in _TRUE_FLAGS}
+
+        try:
+            raw=_decode_json(line)
+        except ValueError:
+            return self._reject(line,"not valid JSON")
+
+        if type(raw) is not dict:
+            return self._reject(line,"not a JSON object")
+        if not raw.keys()<=KNOWN_FIELDS:
+            return self._reject(line,f"unknown keys {sorted(raw.keys()-KNOWN_FIELDS)}")
+
+        frame={}
+        for name in FLOAT_FIELDS:
+            if name in raw:
+                value=raw[name]
+                value_type=type(value)
+                if value_type is int:
+                    value=float(value) if -1e300<value<1e300 else math.inf # float() of a huge int raises
+                elif value_type is not float:
+                    return self._reject(line,f"{name} is not a number")
+                if not math.isfinite(value):
+                    return self._reject(line,f"{name} is not finite")
+                frame[name]=value
+        for name in BOOL_FIELDS:
+            if name in raw:
+                value=raw[name]
+                if value is True or value is False:
+                    frame[name]=value
+                elif type(value) is int and (value==0 or value==1):
+                    frame[name]=value==1
+                else:
+                    return self._reject(line,f"{name} is not a boolean")
+
+        self.parsed+=1
+        return frame
+
+    def _reject(self,line:str,why:str)->None:
+        self.rejected+=1
+        self.last_rejected=line[:80]
+        logging.debug(f"Rejected sensor frame ({why}): {line[:80]}")
+        return None
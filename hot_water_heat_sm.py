@@ -5,6 +5,10 @@ if __name__=="__main__":
 
 
 from state_machine import StateMachine
+from clock import Clock, real_clock
+from dispatch import EventDispatcher
+from timers import TimerService
+from machine_definition import MachineDefinition
 import time
 
 import relays
@@ -13,6 +17,14 @@ import settings
 from typing import Callable
 
 
+HEAT_WATER_MACHINE=MachineDefinition("HeatWaterState",
+                                     initial="Initialising",
+                                     transitions={"Initialising":["Off"],
+                                                  "Off":["Waiting Valve Open"],
+                                                  "Waiting Valve Open":["On","Waiting Valve Closed"],
+                                                  "On":["Waiting Valve Closed"],
+                                                  "Waiting Valve Closed":["Off","Waiting Valve Open"]})
+State=HEAT_WATER_MACHINE.State
 
 
 class HeatWaterSM(StateMachine):
@@ -20,7 +32,10 @@ class HeatWaterSM(StateMachine):
                  pump_relay:relays.Relay,
                  valve_relay:relays.Relay,
                  valve_state_fn:callable,
-                 control_while_on_callback:Callable|None=None):
+                 control_while_on_callback:Callable|None=None,
+                 clock:Clock=real_clock,
+                 timer_service:TimerService|None=None,
+                 dispatcher:EventDispatcher|None=None):
         """
             Theadable class to deal with the management of Hot Water or Heating
             (one for each)
@@ -29,25 +44,48 @@ class HeatWaterSM(StateMachine):
             this will be run every loop if set and the system is on
             and can be used to switch the pump on and off
             to keep temperature within the required bounds
+
+            Valve position changes should be passed on to wake() (eg by subscribing it to the
+            ValveTempState) so we react straight away rather than on the next interval
         
         """
         super().__init__(name=name,
-                         states=["Initialising","Off","Waiting Valve Open","On","Waiting Valve Closed"],
-                         initial_state="Initialising",
-                         subscribers=[])
+                         definition=HEAT_WATER_MACHINE,
+                         subscribers=[],
+                         interval_s=settings.STATE_MACHINE_IDLE_INTERVAL_S,
+                         clock=clock,
+                         timer_service=timer_service,
+                         dispatcher=dispatcher,
+                         phases=("Waiting Valve Open","Waiting Valve Closed"))
         self.name=name
         self.demanding_heat:bool=False
         self.pump_relay=pump_relay
         self.valve_relay=valve_relay
         self.control_while_on_callback=control_while_on_callback
         self.valve_state_fn=valve_state_fn
+        # What step() does in each state, looked up rather than compared against each in turn
+        self.step_handlers:dict[State,Callable[[],None]]={State.INITIALISING:self.step_initialising,
+                                                          State.OFF:self.step_off,
+                                                          State.WAITING_VALVE_OPEN:self.step_waiting_valve_open,
+                                                          State.ON:self.step_on,
+                                                          State.WAITING_VALVE_CLOSED:self.step_waiting_valve_closed}
         
     def __str__(self):
         return f"{self.name} - State: {self.state} Demanding Heat: {self.demanding_heat}"
     
+    def poll_interval_s(self)->float|None:
+        # When hosted on an event loop, only look again unprompted while waiting on a valve
+        # (in case its edge is missed) or to keep the temperature under control while on
+        match self.state:
+            case State.OFF:
+                return None
+            case State.ON:
+                return self.interval_s if self.control_while_on_callback else None
+        return self.interval_s
+
     @property
     def burn_wanted(self)->bool:
-        return self.pump_relay.is_on()
+        return self.pump_relay.is_on
 
     def valve_is_open(self)->bool:
         return self.valve_state_fn()
@@ -74,47 +112,37 @@ class HeatWaterSM(StateMachine):
 
     def step(self):
         # logging.debug("tick:"+self.state)
-        match self.state:
-            case "Initialising":
-                logging.info(f"{self.name} Setting pump and valve to default state, probably a repeat but harmless")
-                self.stop_pump()
-                self.close_valve()
-                logging.info(f"{self.name} Initialising to off as not requiring heat at the moment")
-                self.demanding_heat=False
-                self.set_state(new_state="Off",reason="Initialised",timeout_s=-1)
-                return
-            
-            case "Off":
-                return # Nothing to do here, external code will call the state change
-
-            case "Waiting Valve Open":
-                logging.info(f"{self.name}: Checking if valve has finished opening...")
-                # We don't start the pump until the valve has opened...
-                if self.valve_is_open():
-                    self.start_pump()
-                    self.set_state(new_state="On",reason=f"{self.name} valve now open")
-                    return
-                
-            case "On":
-                if self.control_while_on_callback:
-                    self.control_while_on_callback(self)
-                return 
-            
-            case "Waiting Valve Closed":
-                logging.info(f"{self.name}:Checking if valve has closed")
-
-
-                # We wait until the valve is closed then we stop the pump
-                # not entirely sure why, but it's what the old system does
-                if not self.valve_is_open():
-                    self.stop_pump()
-                    self.set_state(new_state="Off",reason=f"{self.name}: valve now closed")
-                    return
-                
-
-                
-            case _:
-                raise ValueError(f"Somehow the state of {self.name} is {self.state} which isn't one of the valid ones!")
+        self.step_handlers[self.state]()
+
+    def step_initialising(self):
+        logging.info(f"{self.name} Setting pump and valve to default state, probably a repeat but harmless")
+        self.stop_pump()
+        self.close_valve()
+        logging.info(f"{self.name} Initialising to off as not requiring heat at the moment")
+        self.demanding_heat=False
+        self.set_state(new_state=State.OFF,reason="Initialised",timeout_s=-1)
+
+    def step_off(self):
+        return # Nothing to do here, external code will call the state change
+
+    def step_waiting_valve_open(self):
+        logging.info(f"{self.name}: Checking if valve has finished opening...")
+        # We don't start the pump until the valve has opened...
+        if self.valve_is_open():
+            self.start_pump()
+            self.set_state(new_state=State.ON,reason=f"{self.name} valve now open")
+
+    def step_on(self):
+        if self.control_while_on_callback:
+            self.control_while_on_callback(self)
+
+    def step_waiting_valve_closed(self):
+        logging.info(f"{self.name}:Checking if valve has closed")
+        # We wait until the valve is closed then we stop the pump
+        # not entirely sure why, but it's what the old system does
+        if not self.valve_is_open():
+            self.stop_pump()
+            self.set_state(new_state=State.OFF,reason=f"{self.name}: valve now closed")
 
 
     def open_valve(self):
@@ -142,19 +170,19 @@ class HeatWaterSM(StateMachine):
         logging.info(f"{self.name} - heat_please has been requested!")
 
         match self.state:
-            case "Off":
+            case State.OFF:
                 self.open_valve()
-                self.set_state(new_state="Waiting Valve Open",reason=f"{self.name}:heat requested")
+                self.set_state(new_state=State.WAITING_VALVE_OPEN,reason=f"{self.name}:heat requested")
                 return
-            case "Waiting Valve Open":
+            case State.WAITING_VALVE_OPEN:
                 logging.info(f"{self.name}:Ignoring heat please as we're already switching on the heat")
                 return
-            case "On":
+            case State.ON:
                 logging.info(f"{self.name}: Ignoring heat request, it's already on")
                 return
-            case "Waiting Valve Closed":
+            case State.WAITING_VALVE_CLOSED:
                 self.open_valve()
-                self.set_state(new_state="Waiting Valve Open",reason=f"{self.name}:heat requested")
+                self.set_state(new_state=State.WAITING_VALVE_OPEN,reason=f"{self.name}:heat requested")
                 return
 
             case _:
@@ -170,18 +198,18 @@ class HeatWaterSM(StateMachine):
                 # Actions to be done depend on the current state:
 
         match self.state:
-            case "Off":
+            case State.OFF:
                 logging.info(f"{self.name}:Ignoring heat off request as it's already off")
                 return
-            case "Waiting Valve Open":
+            case State.WAITING_VALVE_OPEN:
                 self.close_valve()
-                self.set_state(new_state="Waiting Valve Closed",reason=f"{self.name}:heat request cancelled")
+                self.set_state(new_state=State.WAITING_VALVE_CLOSED,reason=f"{self.name}:heat request cancelled")
                 return
-            case "On":
+            case State.ON:
                 self.close_valve()
-                self.set_state(new_state="Waiting Valve Closed",reason=f"{self.name}:heat request cancelled")
+                self.set_state(new_state=State.WAITING_VALVE_CLOSED,reason=f"{self.name}:heat request cancelled")
                 return
-            case "Waiting Valve Closed":
+            case State.WAITING_VALVE_CLOSED:
                 logging.info(f"{self.name}:Nothing to do, heating is already going off")
                 return
 
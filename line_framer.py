@@ -0,0 +1,83 @@
+import logging
+if __name__=="__main__":
+    logging.basicConfig(level=logging.DEBUG)
+
+"""
+
+Splits the raw byte stream from the sensor board into lines
+
+The board isn't consistent about line endings (we see \r, \n and \r\n)
+so any run of CR/LF characters counts as a single line break.
+
+Bytes are fed in whatever sized chunks the port hands us, partial lines
+are held over until the rest arrives, and a line that grows past
+max_line_length is thrown away rather than growing forever (eg if the
+board starts spewing garbage with no line ends).
+
+"""
+
+DEFAULT_MAX_LINE_LENGTH=512
+READ_CHUNK_SIZE=4096
+
+
+class LineFramer:
+    def __init__(self,max_line_length:int=DEFAULT_MAX_LINE_LENGTH):
+        self.max_line_length=max_line_length
+        self.pending=bytearray() # the partial line carried over between chunks
+        self.discarding=False # True while we're skipping the tail of an over-long line
+        self.lines_framed:int=0
+        self.lines_dropped:int=0
+
+    def feed(self,data)->list[str]:
+        """
+            data is any bytes-like chunk read from the port
+            returns the list of complete lines it finished (without line ends, empty lines skipped)
+        """
+        pending=self.pending
+        pending+=data
+
+        last_end=max(pending.rfind(b"\n"),pending.rfind(b"\r"))
+        if last_end<0:
+            # No line end yet, just check we're not growing without bound
+            if len(pending)>self.max_line_length:
+                logging.warning(f"Serial line longer than {self.max_line_length} bytes, discarding it")
+                self.lines_dropped+=1
+                self.discarding=True
+                pending.clear()
+            return []
+
+        complete=pending[:last_end]
+        del pending[:last_end+1]
+
+        lines=[]
+        for raw in complete.replace(b"\r",b"\n").split(b"\n"):
+            if self.discarding:
+                # This is the tail end of a line we already threw away
+                self.discarding=False
+                continue
+            if not raw:
+                continue # \r\n or blank lines
+            if len(raw)>self.max_line_length:
+                self.lines_dropped+=1
+                continue
+            lines.append(raw.decode("ascii",errors="replace"))
+
+        self.lines_framed+=len(lines)
+        return lines
+
+    def reset(self):
+        self.pending.clear()
+        self.discarding=False
+
+
+def read_lines(ser,framer:LineFramer,read_buffer:bytearray)->list[str]:
+    """
+        Reads whatever the port has waiting (or blocks up to the port timeout for at least one byte)
+        into the reusable read_buffer and returns any lines that completed
+    """
+    wanted=min(max(ser.in_waiting,1),len(read_buffer))
+    view=memoryview(read_buffer)
+    count=ser.readinto(view[:wanted])
+    if not count:
+        return []
+    return framer.feed(view[:count])
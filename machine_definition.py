@@ -0,0 +1,135 @@
+import logging
+if __name__=="__main__":
+    logging.basicConfig(level=logging.WARNING)
+
+"""
+
+Declares a state machine's states and allowed transitions up front
+
+    CIRCUIT=MachineDefinition("CircuitState",
+                              initial="OFF",
+                              transitions={"OFF":["OPENING_VALVE"],
+                                           "OPENING_VALVE":["HEATING","OFF"],
+                                           "HEATING":["OFF"]})
+
+The states become a StrEnum (CIRCUIT.State.OPENING_VALVE), so they still
+compare equal to the plain strings used everywhere, and the transitions
+become a bitmask per state so checking one is a dict lookup and a shift
+rather than a list scan. Anything wrong with the definition (a transition
+to a state that doesn't exist, a state you can't get to from the initial
+one) raises ValueError when it's built, not when the boiler is running.
+
+Export the graph to check it, eg:
+
+    uv run machine_definition.py decision:CIRCUIT_MACHINE --format mermaid
+
+"""
+
+from enum import StrEnum
+import importlib
+import re
+
+
+class MachineDefinition:
+    def __init__(self,name:str,*,initial:str,transitions:dict[str,list[str]],states:list[str]|None=None):
+        """
+            name is the name of the generated StrEnum
+            transitions maps each state to the states it may change to
+            states gives the order of the states, by default the order they appear in transitions
+        """
+        if states is None:
+            states=list(dict.fromkeys([*transitions,*(to for targets in transitions.values() for to in targets)]))
+        if len(set(states))!=len(states):
+            raise ValueError(f"{name} has duplicate states: {states}")
+        if initial not in states:
+            raise ValueError(f"{name} starts in {initial} which isn't one of its states: {states}")
+        for from_state,targets in transitions.items():
+            for state in (from_state,*targets):
+                if state not in states:
+                    raise ValueError(f"{name} has a transition {from_state}->{state} but {state} isn't one of its states: {states}")
+
+        self.name=name
+        self.State=StrEnum(name,{_identifier(state):state for state in states})
+        self.states:tuple=tuple(self.State)
+        self.initial=self.State(initial)
+        self.by_value:dict[str,StrEnum]={member.value:member for member in self.states}
+        self.bit:dict[StrEnum,int]={member:1<<i for i,member in enumerate(self.states)}
+        self.allowed:dict[StrEnum,int]={member:0 for member in self.states}
+        for from_state,targets in transitions.items():
+            for to_state in targets:
+                self.allowed[self.by_value[from_state]]|=self.bit[self.by_value[to_state]]
+
+        reachable=self.reachable()
+        unreachable=[state.value for state in self.states if not reachable&self.bit[state]]
+        if unreachable:
+            raise ValueError(f"{name} can never reach {unreachable} from {initial}")
+
+    @classmethod
+    def permissive(cls,name:str,states:list[str],initial:str):
+        # Any state can change to any other, for machines that don't declare their transitions
+        return cls(name,initial=initial,states=states,transitions={state:list(states) for state in states})
+
+    def __repr__(self):
+        return f"MachineDefinition({self.name}, {len(self.states)} states)"
+
+    def reachable(self)->int:
+        # bitmask of the states that can be reached from the initial one
+        seen=self.bit[self.initial]
+        frontier=[self.initial]
+        while frontier:
+            state=frontier.pop()
+            for target in self.states:
+                if self.allowed[state]&self.bit[target] and not seen&self.bit[target]:
+                    seen|=self.bit[target]
+                    frontier.append(target)
+        return seen
+
+    def state(self,value:str)->StrEnum:
+        """
+            The enum member for a state name, ValueError if it isn't one
+        """
+        try:
+            return self.by_value[value]
+        except KeyError:
+            raise ValueError(f"{value} is not one of the {self.name} states: {[state.value for state in self.states]}") from None
+
+    def can(self,from_state:StrEnum,to_state:StrEnum)->bool:
+        return bool(self.allowed[from_state]&self.bit[to_state])
+
+    def check(self,from_state:StrEnum,to_state:StrEnum,reason:str=""):
+        if not self.allowed[from_state]&self.bit[to_state]:
+            because=f" because {reason}" if reason else ""
+            raise ValueError(f"{self.name} can't go from {from_state} to {to_state}{because}, allowed: {self.targets(from_state)}")
+
+    def targets(self,from_state:StrEnum)->list[str]:
+        return [state.value for state in self.states if self.allowed[from_state]&self.bit[state]]
+
+    def edges(self)->list[tuple[str,str]]:
+        return [(from_state.value,to_state) for from_state in self.states for to_state in self.targets(from_state)]
+
+    def to_dot(self)->str:
+        lines=[f"digraph {self.name} {{",'    "" [shape=none]',f'    "" -> "{self.initial}"']
+        lines+=[f'    "{from_state}" -> "{to_state}"' for from_state,to_state in self.edges()]
+        return "\n".join(lines+["}"])
+
+    def to_mermaid(self)->str:
+        ids={state.value:state.name for state in self.states}
+        lines=["stateDiagram-v2",f"    [*] --> {ids[self.initial]}"]
+        lines+=[f"    {state.name}: {state.value}" for state in self.states if state.name!=state.value]
+        lines+=[f"    {ids[from_state]} --> {ids[to_state]}" for from_state,to_state in self.edges()]
+        return "\n".join(lines)
+
+
+def _identifier(state:str)->str:
+    return re.sub(r"\W+","_",state).strip("_").upper()
+
+
+if __name__=="__main__":
+    import argparse
+    parser=argparse.ArgumentParser(description="Print a state machine definition as a graph")
+    parser.add_argument("definition",help="module:NAME, eg decision:CIRCUIT_MACHINE")
+    parser.add_argument("--format",choices=["dot","mermaid"],default="dot")
+    args=parser.parse_args()
+    module_name,_,attribute=args.definition.partition(":")
+    definition=getattr(importlib.import_module(module_name),attribute)
+    print(definition.to_dot() if args.format=="dot" else definition.to_mermaid())
@@ -4,18 +4,49 @@ if __name__=="__main__":
                         format="%(asctime)s [%(threadName)s] %(levelname)s %(name)s: %(message)s",
                         datefmt="%Y-%m-%d %H:%M:%S")
 
+import time
+import_started=time.perf_counter()
 
-from flask import Flask, request
+from flask import Flask, request, jsonify
+import hmac
+import math
 
+import protocol
+import settings
 import simpler
+from status import StatusCache
 
-main_state=simpler.MainState()
-main_state.start()
+imported=time.perf_counter()
+
+# Nothing touches the hardware until start() makes and starts this
+main_state:simpler.MainState|None=None
+status_cache:StatusCache|None=None
+startup_timings:dict[str,float]={}
 
 
 app=Flask(__name__)
 
 
+def start()->simpler.MainState:
+    """
+        Makes the controller and starts it, claiming the relays and the serial port,
+        and records how long each part of starting up took in startup_timings
+    """
+    global main_state,status_cache
+    created_at=time.perf_counter()
+    main_state=simpler.MainState()
+    status_cache=StatusCache(build=main_state.status,key=main_state.status_key)
+    started_at=time.perf_counter()
+    main_state.start()
+    finished_at=time.perf_counter()
+    startup_timings.update(imports_ms=(imported-import_started)*1000,
+                           create_ms=(started_at-created_at)*1000,
+                           start_ms=(finished_at-started_at)*1000,
+                           total_ms=(finished_at-import_started)*1000)
+    logging.info("Started up in "+", ".join(f"{name} {ms:.0f}" for name,ms in startup_timings.items()))
+    return main_state
+
+
 @app.route("/")
 def index():
     # returns the state string as a text/plain response
@@ -27,16 +58,84 @@ def index():
     return response
 
 
+@app.route("/api/state")
+def api_state():
+    """
+        The circuits, relays, sensors and server state as JSON, only rebuilt when something
+        has changed, and a 304 if it's still the same as the If-None-Match ETag
+    """
+    body,etag=status_cache.get()
+    response=app.response_class(response=body,status=200,mimetype="application/json")
+    response.set_etag(etag)
+    response.headers["Cache-Control"]="no-cache" # always check, but the check is cheap
+    return response.make_conditional(request)
 
 
+@app.route("/events")
+def events():
+    """
+        Server-Sent Events: a "status" event to start with (as /api/state), then "state"
+        for circuit changes, "relay" for relay switches and "sample" for the readings every few seconds
+    """
+    subscription=main_state.events.subscribe()
+    return app.response_class(response=subscription.stream(),
+                              status=200,
+                              mimetype="text/event-stream",
+                              headers={"Cache-Control":"no-cache","X-Accel-Buffering":"no"})
 
 
+@app.route("/history")
+def history():
+    # min/max/mean of the temperatures and valve states over the last ?seconds= (default an hour, at most HISTORY_MAX_S)
+    seconds=request.args.get("seconds",default=3600,type=float)
+    if not math.isfinite(seconds) or seconds<=0:
+        return jsonify({"error":"seconds should be a positive number"}),400
+    seconds=min(seconds,settings.HISTORY_MAX_S)
+    stats=main_state.telemetry.stats(seconds)
+    return jsonify({"seconds":seconds,
+                    "samples":len(main_state.telemetry),
+                    "stats":{name:vars(stat) for name,stat in stats.items()}})
 
 
+@app.route("/api/metrics")
+def metrics():
+    # transition counts, dwell time histograms and recent valve opening times for the circuits
+    return jsonify({**main_state.metrics(),"startup":startup_timings})
+
+
+@app.route("/push/state",methods=["POST"])
+def push_state():
+    """
+        The house server can POST its system state here (same JSON as /systemstate)
+        with an "Authorization: Bearer <HEATINGPI_PUSH_TOKEN>" header, and it's acted on straight away
+        It can be sent in the compact encoding instead, with that Content-Type (see protocol.py)
+    """
+    if not settings.PUSH_TOKEN:
+        return jsonify({"error":"pushes are not enabled, set HEATINGPI_PUSH_TOKEN"}),404
+    supplied=request.headers.get("Authorization","").removeprefix("Bearer ")
+    if not hmac.compare_digest(supplied.encode(),settings.PUSH_TOKEN.encode()):
+        logging.warning(f"Rejected a state push from {request.remote_addr} with a bad token")
+        return jsonify({"error":"bad token"}),401
+    try:
+        state=protocol.parse(request.get_data(),request.content_type)
+    except ValueError as e:
+        return jsonify({"error":f"bad system state: {e}"}),400
+    main_state.server_fetcher.push(state)
+    return "",204
+
 
 
 
-if __name__=="__main__":
 
 
+
+
+
+
+
+if __name__=="__main__":
+    start()
+    # Ctrl-C or a systemd/tmux kill stops everything in order and leaves the relays off before exiting
+    main_state.shutdown_coordinator.install_signal_handlers()
+
     app.run(host="0.0.0.0",port=8181)
\ No newline at end of file
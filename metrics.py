@@ -0,0 +1,112 @@
+import logging
+if __name__=="__main__":
+    logging.basicConfig(level=logging.DEBUG)
+
+"""
+
+Running statistics on a state machine's transitions, in constant memory
+
+For each state it keeps how many times it's been entered, how long it was
+stayed in (as a histogram over fixed buckets plus min/max/total) and how
+many times it timed out, and for each (from, to) pair how many times that
+transition happened. For the phases we want to watch closely, like a valve
+opening, the durations of the last few are kept as well, so a valve that's
+getting slower shows up long before it hits its timeout.
+
+Nothing grows with uptime, only with the number of states, so it's fine
+to leave running for months. Everything is available as plain dicts from
+to_dict() for the web front end.
+
+"""
+
+from collections import deque
+from dataclasses import dataclass, field
+import bisect
+import threading
+
+# Upper bounds (seconds) of the dwell time histogram buckets, anything longer goes in a last one
+DWELL_BUCKETS_S=(1,2,5,10,20,30,60,120,180,300,600,1800,3600,3*3600,6*3600,12*3600,24*3600)
+
+
+@dataclass(slots=True)
+class DwellStats:
+    entered:int=0
+    completed:int=0 # left again, so their dwell time is in the stats below
+    total_s:float=0.0
+    min_s:float=float("inf")
+    max_s:float=0.0
+    timeouts:int=0
+    buckets:list[int]=field(default_factory=lambda:[0]*(len(DWELL_BUCKETS_S)+1))
+
+    def add(self,dwell_s:float):
+        self.completed+=1
+        self.total_s+=dwell_s
+        self.min_s=min(self.min_s,dwell_s)
+        self.max_s=max(self.max_s,dwell_s)
+        self.buckets[bisect.bisect_left(DWELL_BUCKETS_S,dwell_s)]+=1
+
+    def to_dict(self)->dict:
+        labels=[f"<={bound}s" for bound in DWELL_BUCKETS_S]+[f">{DWELL_BUCKETS_S[-1]}s"]
+        return {"entered":self.entered,
+                "completed":self.completed,
+                "mean_s":self.total_s/self.completed if self.completed else None,
+                "min_s":self.min_s if self.completed else None,
+                "max_s":self.max_s if self.completed else None,
+                "timeouts":self.timeouts,
+                "histogram":{label:count for label,count in zip(labels,self.buckets) if count}}
+
+
+class TransitionStats:
+    def __init__(self,initial_state:str,now:float,*,phases:tuple[str,...]=(),recent:int=20):
+        """
+            initial_state is the state we're starting in at time now
+            phases are the states to keep the last `recent` durations of
+        """
+        self.lock=threading.Lock()
+        self.state=initial_state
+        self.entered_at=now
+        self.states:dict[str,DwellStats]={initial_state:DwellStats(entered=1)}
+        self.transitions:dict[tuple[str,str],int]={}
+        self.recent:dict[str,deque[float]]={phase:deque(maxlen=recent) for phase in phases}
+
+    def __str__(self):
+        parts=[]
+        for phase,durations in self.recent.items():
+            if durations:
+                parts.append(f"{phase} last {durations[-1]:.0f}s, mean of last {len(durations)} {sum(durations)/len(durations):.0f}s")
+        transitions=sum(self.transitions.values())
+        return f"{transitions} transitions" + (f", {', '.join(parts)}" if parts else "")
+
+    def transition(self,new_state:str,now:float):
+        with self.lock:
+            if new_state==self.state:
+                return
+            dwell_s=max(0.0,now-self.entered_at)
+            self.states[self.state].add(dwell_s)
+            if self.state in self.recent:
+                self.recent[self.state].append(dwell_s)
+            key=(self.state,new_state)
+            self.transitions[key]=self.transitions.get(key,0)+1
+            stats=self.states.get(new_state)
+            if stats is None:
+                stats=self.states[new_state]=DwellStats()
+            stats.entered+=1
+            self.state=new_state
+            self.entered_at=now
+
+    def timed_out(self,state:str|None=None):
+        with self.lock:
+            state=self.state if state is None else state
+            stats=self.states.get(state)
+            if stats is None:
+                stats=self.states[state]=DwellStats()
+            stats.timeouts+=1
+
+    def to_dict(self,now:float)->dict:
+        with self.lock:
+            return {"state":self.state,
+                    "in_state_s":max(0.0,now-self.entered_at),
+                    "states":{name:stats.to_dict() for name,stats in self.states.items()},
+                    "transitions":[{"from":from_state,"to":to_state,"count":count}
+                                   for (from_state,to_state),count in self.transitions.items()],
+                    "recent":{phase:list(durations) for phase,durations in self.recent.items()}}
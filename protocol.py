@@ -0,0 +1,170 @@
+import logging
+if __name__=="__main__":
+    logging.basicConfig(level=logging.DEBUG)
+
+"""
+
+The system state the house server sends us, and how it's put on the wire
+
+Both controllers (and the simulator and the push endpoint) use the one
+SysHeatState here. It comes in one of two encodings, picked by the
+response's Content-Type:
+
+    application/json                the original, eg
+        {"heating_currently_on": true, "hot_water_currently_on": false,
+         "heating_boost_timeout": "2024-11-02T18:30:00", "hot_water_temperature": 48.5,
+         "hot_water_last_temp_dt": "2024-11-02T17:58:12", "hot_water_boost_requested": "2024-11-01T07:00:00"}
+        with an optional "version" (1 if missing)
+
+    application/vnd.heatingpi.state  36 bytes instead of ~250, COMPACT below:
+        "HS", version, flags (bit 0 heating on, bit 1 hot water on),
+        then doubles for the temperature and the three times as seconds since 1970
+        (wall clock, like the naive datetimes in the JSON)
+
+We always say we accept the compact one, so the server can start sending it
+whenever it likes, and the push endpoint takes either.
+
+The JSON parser is strict: every field must be there with the right type,
+the temperature must be finite (json.loads would take NaN/Infinity), and a
+version we don't know is rejected rather than half understood. Anything
+wrong, in either encoding, raises ValueError and nothing else, so a bad
+body can't take the fetcher thread down.
+
+    uv run --with pytest pytest test_protocol.py
+
+The checks cost a little over the old unchecked parse, the compact
+encoding is what's actually faster:
+
+    uv run bench_protocol.py
+
+"""
+
+from dataclasses import dataclass
+import datetime
+import json
+import math
+import struct
+from typing import ClassVar
+
+PROTOCOL_VERSION=1
+JSON_TYPE="application/json"
+COMPACT_TYPE="application/vnd.heatingpi.state"
+ACCEPT=f"{COMPACT_TYPE}, {JSON_TYPE};q=0.9" # what the fetcher asks the server for
+
+COMPACT=struct.Struct("<2sBBdddd")
+COMPACT_MAGIC=b"HS"
+_EPOCH=datetime.datetime(1970,1,1)
+
+
+@dataclass(slots=True)
+class SysHeatState:
+    heating_currently_on:bool
+    hot_water_currently_on:bool
+    heating_boost_timeout:datetime.datetime
+    hot_water_temperature:float
+    hot_water_last_temp_dt:datetime.datetime
+    hot_water_boost_requested:datetime.datetime
+
+    version:ClassVar[int]=PROTOCOL_VERSION
+
+    @classmethod
+    def from_JSON(cls,jsondict:dict)->"SysHeatState":
+        if type(jsondict) is not dict:
+            raise ValueError(f"System state should be a JSON object, not {type(jsondict).__name__}")
+        version=jsondict.get("version",1)
+        if version!=PROTOCOL_VERSION:
+            raise ValueError(f"System state is version {version}, we only understand {PROTOCOL_VERSION}")
+        try:
+            heating_on=jsondict["heating_currently_on"]
+            hot_water_on=jsondict["hot_water_currently_on"]
+            temperature=jsondict["hot_water_temperature"]
+            boost_timeout=jsondict["heating_boost_timeout"]
+            last_temp=jsondict["hot_water_last_temp_dt"]
+            boost_requested=jsondict["hot_water_boost_requested"]
+        except KeyError as e:
+            raise ValueError(f"System state is missing {e}") from None
+        # One test for the usual case that it's all fine, working out what's wrong only when it isn't
+        temperature_type=type(temperature)
+        if not (type(heating_on) is bool and type(hot_water_on) is bool
+                and (temperature_type is float or temperature_type is int) and math.isfinite(temperature)
+                and type(boost_timeout) is str and type(last_temp) is str and type(boost_requested) is str):
+            if type(heating_on) is not bool or type(hot_water_on) is not bool:
+                raise ValueError(f"System state heating/hot_water_currently_on should be true or false, not {heating_on!r}/{hot_water_on!r}")
+            if temperature_type is not float and temperature_type is not int or not math.isfinite(temperature):
+                raise ValueError(f"System state hot_water_temperature should be a finite number, not {temperature!r}")
+            raise ValueError(f"System state times should be strings, not {boost_timeout!r}/{last_temp!r}/{boost_requested!r}")
+        return cls(heating_on,hot_water_on,_datetime(boost_timeout),temperature,_datetime(last_temp),_datetime(boost_requested))
+
+    def to_JSON(self)->dict:
+        return {"version":self.version,
+                "heating_currently_on":self.heating_currently_on,
+                "hot_water_currently_on":self.hot_water_currently_on,
+                "heating_boost_timeout":self.heating_boost_timeout.isoformat(),
+                "hot_water_temperature":self.hot_water_temperature,
+                "hot_water_last_temp_dt":self.hot_water_last_temp_dt.isoformat(),
+                "hot_water_boost_requested":self.hot_water_boost_requested.isoformat()}
+
+    @classmethod
+    def from_compact(cls,body:bytes)->"SysHeatState":
+        if len(body)!=COMPACT.size:
+            raise ValueError(f"Compact system state should be {COMPACT.size} bytes, not {len(body)}")
+        magic,version,flags,temperature,boost_timeout,last_temp,boost_requested=COMPACT.unpack(body)
+        if magic!=COMPACT_MAGIC:
+            raise ValueError(f"Compact system state starts {magic!r} rather than {COMPACT_MAGIC!r}")
+        if version!=PROTOCOL_VERSION:
+            raise ValueError(f"Compact system state is version {version}, we only understand {PROTOCOL_VERSION}")
+        if not math.isfinite(temperature):
+            raise ValueError(f"Compact system state temperature should be finite, not {temperature}")
+        return cls(bool(flags&1),
+                   bool(flags&2),
+                   _from_seconds(boost_timeout),
+                   temperature,
+                   _from_seconds(last_temp),
+                   _from_seconds(boost_requested))
+
+    def to_compact(self)->bytes:
+        return COMPACT.pack(COMPACT_MAGIC,self.version,
+                            self.heating_currently_on|(self.hot_water_currently_on<<1),
+                            self.hot_water_temperature,
+                            _seconds(self.heating_boost_timeout),
+                            _seconds(self.hot_water_last_temp_dt),
+                            _seconds(self.hot_water_boost_requested))
+
+
+def parse(body:bytes,content_type:str|None=None)->SysHeatState:
+    """
+        A SysHeatState from a response or request body in either encoding,
+        anything that isn't the compact content type is taken to be JSON
+    """
+    if content_type and content_type.split(";",1)[0].strip()==COMPACT_TYPE:
+        return SysHeatState.from_compact(body)
+    try:
+        jsondict=json.loads(body)
+    except (json.JSONDecodeError,UnicodeDecodeError) as e:
+        raise ValueError(f"System state isn't valid JSON: {e}") from None
+    return SysHeatState.from_JSON(jsondict)
+
+
+def offline_state(now:datetime.datetime)->SysHeatState:
+    """
+        What we assume when the server hasn't been reachable for too long, everything off
+        now is the controller's clock.now(), so a simulated outage gets simulated times
+    """
+    hour_ago=now-datetime.timedelta(hours=1)
+    return SysHeatState(False,False,now,-100.0,hour_ago,hour_ago)
+
+
+_datetime=datetime.datetime.fromisoformat # ValueError for anything that isn't an ISO time
+
+
+def _from_seconds(seconds:float)->datetime.datetime:
+    try:
+        return _EPOCH+datetime.timedelta(seconds=seconds)
+    except (OverflowError,ValueError):
+        raise ValueError(f"Compact system state has a time of {seconds}s that isn't a date") from None
+
+
+def _seconds(when:datetime.datetime)->float:
+    if when.tzinfo is not None:
+        when=when.astimezone().replace(tzinfo=None) # the compact encoding is in local wall clock time like the JSON
+    return (when-_EPOCH).total_seconds()
@@ -2,8 +2,9 @@ import logging
 if __name__=="__main__":
     logging.basicConfig(level=logging.DEBUG)
 
-from gpiozero import LED
+from dataclasses import dataclass
 from enum import Enum
+import threading
 import time
 
 
@@ -24,37 +25,48 @@ class Relay:
                  7:21,
                  8:19}
     instances=[]
+    transition_listeners=[] # called as listener(relay=relay,is_on=bool,type="RELAY_SWITCHED") when any relay actually changes
 
     def __init__(self,name:str,relay_number:int,initial_state=RelayIs.OFF):
-
-
-
+        """
+            Doesn't touch the GPIO, the pin is claimed and set to initial_state
+            by attach(), or the first time the relay is switched
+        """
         self.state:RelayIs=initial_state
         self.name=name
+        self.relay_number=relay_number
         self.pin=self.pin_mapping[relay_number]
-        self.output=LED(f"BOARD{self.pin}")
-        self.set_value(initial_state)
+        self.output=None # the gpiozero LED driving the pin, once attached
+        self.is_on:bool=initial_state==RelayIs.ON # interrogated to see if the pump is on, so that burn requirement can be determined
         self.initial_state=initial_state
-        self.is_on:bool=False
 
         
         Relay.instances.append(self)
 
+    def attach(self):
+        """
+            Claims the GPIO pin and drives it to match is_on, does nothing if it's already attached
+        """
+        if self.output is not None:
+            return
+        from gpiozero import LED # here rather than at the top, so importing this doesn't cost a tenth of a second
+        self.output=LED(f"BOARD{self.pin}",initial_value=self.is_on)
+        logging.info(f"Attached {self.name} to pin {self.pin}, {'on' if self.is_on else 'off'}")
+
+    @classmethod
+    def attach_all(cls):
+        for rel in cls.instances:
+            rel.attach()
+
     def on(self):
         self.set_value(RelayIs.ON)
-        self.is_on=True
-        logging.info(f">>>>>>> Switched: {self.name} on")
 
     def off(self):
         self.set_value(RelayIs.OFF)
-        self.is_on=False
-        logging.info(f">>>>>>> Switched: {self.name} off")
-
-    def is_on(self)->bool:
-        # interrogated to see if the pump is on, so that burn requirement can be determined
-        return self.is_on
 
     def set_value(self,value):
+        self.attach()
+        was_on=self.is_on
         if value == RelayIs.OFF:
             self.output.off()
             self.is_on=False
@@ -65,19 +77,113 @@ class Relay:
             self.is_on=True
             logging.info(f">>>>> Switched {self.name} on")
 
+        if self.is_on!=was_on:
+            for listener in Relay.transition_listeners:
+                listener(relay=self,is_on=self.is_on,type="RELAY_SWITCHED")
+
     def __str__(self):
         return f"Relay {self.name} = {self.is_on}"
 
     @classmethod
     def reset_all(cls):
+        # Relays that were never attached haven't been driven, so are left alone
         for rel in cls.instances:
-            rel.set_value(rel.initial_state)
-
-
-
-
+            if rel.output is not None:
+                rel.set_value(rel.initial_state)
 
+    @classmethod
+    def remove_transition_listener(cls,listener):
+        # For shutting down, so a stopped controller isn't still told about (or kept alive by) the relays
+        if listener in cls.transition_listeners:
+            cls.transition_listeners.remove(listener)
+
+
+@dataclass
+class Sequencing:
+    """
+        then may only be switched on once one of the first relays
+        has been on for at least min_interval_s
+    """
+    first:tuple[str,...]
+    then:str
+    min_interval_s:float
+
+
+class RelayBank:
+    def __init__(self,relays:list[Relay],sequencing:list[Sequencing]|None=None):
+        """
+            Drives a set of relays from a desired on/off state for each, only touching
+            the ones that need to change, so the GPIO and logging only happen on real switches
+        """
+        self.relays={relay.name:relay for relay in relays}
+        self.sequencing=sequencing or []
+        for rule in self.sequencing:
+            for name in (*rule.first,rule.then):
+                if name not in self.relays:
+                    raise ValueError(f"Relay sequencing refers to {name} which isn't in the bank: {list(self.relays)}")
+        self.switched_on_at:dict[str,float]={name:(time.time() if relay.is_on else 0.0) for name,relay in self.relays.items()}
+        self.lock=threading.Lock()
+        self.writes:int=0
+        self.no_ops:int=0
+        self.deferrals:int=0
 
+    def __str__(self):
+        return f"Relay bank: {self.writes} switches, {self.no_ops} unchanged, {self.deferrals} deferred"
+
+    def ready_at(self,name:str)->float|None:
+        """
+            When the named relay is allowed to switch on, None if it's waiting on a relay that's off
+        """
+        ready=0.0
+        for rule in self.sequencing:
+            if rule.then!=name:
+                continue
+            on_since=[self.switched_on_at[first] for first in rule.first if self.relays[first].is_on]
+            if not on_since:
+                return None
+            ready=max(ready,min(on_since)+rule.min_interval_s)
+        return ready
+
+    def apply(self,desired:dict[str,bool],now:float|None=None)->float|None:
+        """
+            desired maps relay names to whether they should be on, relays not mentioned are left alone
+            Everything going off is switched first, then things going on in the order given,
+            unless sequencing holds them back.
+            Returns the time to call again to finish off anything held back, or None if it's all done
+        """
+        now=time.time() if now is None else now
+        retry_at:float|None=None
+        with self.lock:
+            for name,want_on in desired.items():
+                relay=self.relays[name]
+                if relay.is_on==want_on:
+                    self.no_ops+=1
+                elif not want_on:
+                    relay.off()
+                    self.writes+=1
+
+            for name,want_on in desired.items():
+                relay=self.relays[name]
+                if not want_on or relay.is_on:
+                    continue
+                ready=self.ready_at(name)
+                if ready is None or ready>now:
+                    self.deferrals+=1
+                    logging.info(f"Holding {name} off until the relays it depends on have been on long enough")
+                    if ready is not None:
+                        retry_at=ready if retry_at is None else min(retry_at,ready)
+                    continue
+                relay.on()
+                self.switched_on_at[name]=now
+                self.writes+=1
+        return retry_at
+
+
+
+
+
+
+# Nothing is driven until they're attached (see Relay.attach_all) or switched
 boiler_heat_req=Relay("boiler_heat_req",1)
 hot_water_valve=Relay("hot_water_valve",2)
 hot_water_pump=Relay("hot_water_pump",3)
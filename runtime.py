@@ -0,0 +1,105 @@
+import logging
+if __name__=="__main__":
+    logging.basicConfig(level=logging.DEBUG)
+
+"""
+
+One asyncio event loop, in one thread, hosting any number of state machines
+
+Each StateMachine normally runs as its own thread, stepping every
+interval_s whether there's anything to do or not. Added to an AsyncRuntime
+they run as coroutines (StateMachine.run_async) instead, which only wake
+for a wake(), a state timeout, or while their state actually needs polling,
+so an idle system costs next to nothing.
+
+    runtime=AsyncRuntime()
+    runtime.add(heating)      # a StateMachine, or anything with run_async() and stop_requested/wake()
+    runtime.start()
+    ...
+    runtime.stop()
+
+Blocking work (the serial port, HTTP fetches) stays in its own threads and
+just calls wake() on the machines, which is safe from any thread.
+
+This is only for sys_state.SystemState and its StateMachines. The
+controller main.py runs, simpler.MainState, doesn't use StateMachines or
+step on an interval: its one thread already sleeps on a scheduler.Wakeup
+until a valve edge, a new server state or its next deadline, so there's
+nothing for it to gain from being hosted here.
+
+"""
+
+import asyncio
+import threading
+
+
+class AsyncRuntime(threading.Thread):
+    def __init__(self,name:str="AsyncRuntime"):
+        super().__init__(daemon=True)
+        self.name=name
+        self.machines:list=[]
+        self.tasks:set[asyncio.Task]=set() # the loop only keeps weak references to them
+        self.loop:asyncio.AbstractEventLoop|None=None
+        self.lock=threading.Lock() # machines can be added from any thread, before or after we start
+        self.ready=threading.Event()
+        self.stop_requested=False
+        self.stopped=False
+
+    def __str__(self):
+        running=sum(1 for machine in self.machines if not machine.stopped)
+        return f"{self.name}: {running} of {len(self.machines)} machines running"
+
+    def add(self,machine):
+        """
+            Runs machine.run_async() on our loop, straight away if we're already running
+        """
+        with self.lock:
+            self.machines.append(machine)
+            if self.loop is not None:
+                asyncio.run_coroutine_threadsafe(self._host(machine),self.loop)
+
+    async def _host(self,machine):
+        task=asyncio.current_task()
+        self.tasks.add(task)
+        try:
+            await machine.run_async()
+        except Exception:
+            logging.exception(f"{machine.name} failed in the async runtime")
+        finally:
+            self.tasks.discard(task)
+
+    async def _main(self):
+        self.stop_async=asyncio.Event()
+        with self.lock:
+            self.loop=asyncio.get_running_loop()
+            for machine in self.machines:
+                asyncio.create_task(self._host(machine))
+        self.ready.set()
+        await self.stop_async.wait()
+        # The machines have all been asked to stop, give them a moment to finish their step
+        if self.tasks:
+            await asyncio.wait(set(self.tasks),timeout=2)
+
+    def run(self):
+        try:
+            asyncio.run(self._main())
+        finally:
+            self.loop=None
+            self.stopped=True
+
+    def stop(self,block_timeout_s:float=5):
+        for machine in self.machines:
+            machine.stop_requested=True
+            machine.wake()
+        self.stop_requested=True
+        loop=self.loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self.stop_async.set)
+        self.join(block_timeout_s)
+        if self.is_alive():
+            raise Exception(f"Failed to stop {self.name} {block_timeout_s} seconds after stop requested")
+        logging.info(f"{self.name} stopped")
+
+    def start(self):
+        super().start()
+        self.ready.wait(5) # so machines added from here on go straight onto the loop
@@ -0,0 +1,55 @@
+import logging
+if __name__=="__main__":
+    logging.basicConfig(level=logging.DEBUG)
+
+"""
+
+Lets a control loop sleep until either something happens or its next deadline
+
+Anything that should make the loop look again (a valve opening, a new
+state from the server) calls notify() with a short reason, from any
+thread. The loop works out its nearest deadline and calls wait_until(),
+which returns the reasons it was woken for, or an empty set if it was
+the deadline.
+
+"""
+
+import threading
+
+from clock import Clock, real_clock
+
+
+class Wakeup:
+    def __init__(self,clock:Clock=real_clock):
+        self.clock=clock
+        self.condition=threading.Condition()
+        self.reasons:set[str]=set()
+
+    def notify(self,reason:str):
+        with self.condition:
+            self.reasons.add(reason)
+            self.condition.notify_all()
+
+    def wait_until(self,deadline:float|None)->set[str]:
+        """
+            deadline is a clock.time() to give up at, or None to wait for a notify
+            anything notified since the last call returns straight away
+        """
+        with self.condition:
+            while not self.reasons:
+                if deadline is None:
+                    self.clock.wait_condition(self.condition)
+                    continue
+                remaining=deadline-self.clock.time()
+                if remaining<=0:
+                    break
+                self.clock.wait_condition(self.condition,remaining)
+            reasons=self.reasons
+            self.reasons=set()
+            return reasons
+
+
+def earliest(*deadlines:float|None)->float|None:
+    # The soonest of the deadlines that are set
+    pending=[deadline for deadline in deadlines if deadline is not None]
+    return min(pending) if pending else None
@@ -0,0 +1,370 @@
+import logging
+if __name__=="__main__":
+    logging.basicConfig(level=logging.INFO)
+
+"""
+
+Long term on-disk log of the sensor readings and relay switching
+
+Records are fixed width (24 bytes) so they can be found by position:
+    timestamp   double, seconds since the epoch
+    kind        byte, KIND_SAMPLE or KIND_RELAY
+    flags       byte, bit 0 hw valve open, bit 1 rad valve open, bit 2 oil flowing
+    OutHW,RetHW,OutRad,RetRad   int16 hundredths of a degree (telemetry.NO_READING if not a number)
+    relay       byte, relay number for KIND_RELAY records
+    relay_on    byte
+    (4 bytes padding)
+
+They go into preallocated segment files which are mmap'd, with a small
+header at the front holding the number of records written so far and the
+first and last timestamps. Records are collected in memory and copied into
+the segment in batches, so the SD card sees one write per flush interval
+rather than one per sample. On starting up we carry on appending to the
+last segment if it has room, so restarting (or a crash loop) doesn't leave
+a trail of nearly empty 16MB files. When a segment is full the next one is
+started, and the oldest are deleted once they all take more than
+max_bytes.
+
+Segments are numbered in the order they were started rather than named
+after the wall clock, which can jump on a Pi with no real time clock, and
+readers skip them using the timestamps in their headers. Timestamps never
+go backwards within the log, across segments and restarts too, so readers
+can binary search.
+
+Dump or export a time window from the command line with:
+    uv run sensor_log.py dump --start 2026-01-01T00:00 --end 2026-01-02T00:00
+    uv run sensor_log.py csv --hours 24 > last_day.csv
+
+"""
+
+from dataclasses import dataclass
+import datetime
+import mmap
+import os
+import struct
+import threading
+import time
+
+import settings
+from telemetry import from_centi, to_centi
+
+RECORD=struct.Struct("<dBBhhhhBB4x")
+HEADER=struct.Struct("<4sHHQdd") # magic, version, record size, record count, first timestamp, last timestamp
+HEADER_BYTES=64 # header is padded out to here
+MAX_BATCH_BYTES=RECORD.size*4096 # flush early if this much is waiting
+MAGIC=b"HPSL"
+VERSION=1
+
+KIND_SAMPLE=1
+KIND_RELAY=2
+
+SEGMENT_PREFIX="sensorlog-"
+SEGMENT_SUFFIX=".seg"
+
+
+@dataclass
+class LogRecord:
+    timestamp:float
+    kind:int
+    hw_valve_open:bool
+    rad_valve_open:bool
+    oil_flowing:bool
+    OutHW:float
+    RetHW:float
+    OutRad:float
+    RetRad:float
+    relay:int
+    relay_on:bool
+
+    @classmethod
+    def unpack(cls,values:tuple):
+        timestamp,kind,flags,out_hw,ret_hw,out_rad,ret_rad,relay,relay_on=values
+        return cls(timestamp,kind,bool(flags&1),bool(flags&2),bool(flags&4),
+                   from_centi(out_hw),from_centi(ret_hw),from_centi(out_rad),from_centi(ret_rad),relay,bool(relay_on))
+
+
+class SensorLogWriter:
+    def __init__(self,directory:str,
+                 segment_bytes:int=settings.SENSOR_LOG_SEGMENT_BYTES,
+                 max_bytes:int=settings.SENSOR_LOG_MAX_BYTES,
+                 flush_interval_s:float=settings.SENSOR_LOG_FLUSH_INTERVAL_S):
+        """
+            directory is created if needed, and the last segment in it appended to if it has room
+            record() and record_relay() can be called from any thread
+        """
+        if segment_bytes<HEADER_BYTES+RECORD.size:
+            raise ValueError(f"Sensor log segments of {segment_bytes} bytes can't hold any records")
+        self.directory=directory
+        self.segment_capacity=(segment_bytes-HEADER_BYTES)//RECORD.size # records in each new segment
+        self.capacity=self.segment_capacity # records in the current one, which may be an older size
+        self.max_bytes=max_bytes
+        self.flush_interval_s=flush_interval_s
+        self.lock=threading.Lock()
+        self.batch=bytearray()
+        self.last_timestamp=0.0
+        self.last_flush=time.time()
+        self.records_written:int=0
+        self.flush_count:int=0
+
+        self.file=None
+        self.map:mmap.mmap|None=None
+        self.count=0 # records in the current segment
+        self.first_timestamp=0.0
+        os.makedirs(directory,exist_ok=True)
+        self._reopen_last_segment()
+
+    def record(self,timestamp:float,state):
+        """
+            Logs a ValveTempSnapshot, matches the recorder interface of ValvesTemps
+        """
+        flags=(1 if state.hw_valve_open else 0)|(2 if state.rad_valve_open else 0)|(4 if state.oil_flowing else 0)
+        self._append(timestamp,KIND_SAMPLE,flags,
+                     to_centi(state.OutHW),to_centi(state.RetHW),to_centi(state.OutRad),to_centi(state.RetRad),0,0)
+
+    def record_relay(self,timestamp:float,relay_number:int,is_on:bool):
+        self._append(timestamp,KIND_RELAY,0,0,0,0,0,relay_number,1 if is_on else 0)
+
+    def relay_changed(self,*,relay,is_on:bool,**kwargs):
+        # Subscriber for relays.Relay.transition_listeners
+        self.record_relay(time.time(),relay.relay_number,is_on)
+
+    def _append(self,timestamp:float,*fields):
+        with self.lock:
+            timestamp=max(timestamp,self.last_timestamp) # keep them in order for the readers
+            self.last_timestamp=timestamp
+            self.batch+=RECORD.pack(timestamp,*fields)
+            if timestamp-self.last_flush>=self.flush_interval_s or len(self.batch)>=MAX_BATCH_BYTES:
+                self._flush_locked()
+
+    def flush(self):
+        with self.lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        self.last_flush=time.time()
+        batch=self.batch
+        position=0
+        while position<len(batch):
+            if self.map is None or self.count>=self.capacity:
+                self._start_segment(RECORD.unpack_from(batch,position)[0])
+            if not self.count:
+                self.first_timestamp=RECORD.unpack_from(batch,position)[0] # a reopened segment with nothing in it yet
+            size=min((self.capacity-self.count)*RECORD.size,len(batch)-position)
+            offset=HEADER_BYTES+self.count*RECORD.size
+            self.map[offset:offset+size]=batch[position:position+size]
+            position+=size
+            self.count+=size//RECORD.size
+            last_timestamp=RECORD.unpack_from(batch,position-RECORD.size)[0]
+            HEADER.pack_into(self.map,0,MAGIC,VERSION,RECORD.size,self.count,self.first_timestamp,last_timestamp)
+            self.map.flush()
+            self.records_written+=size//RECORD.size
+        batch.clear()
+        self.flush_count+=1
+
+    def _reopen_last_segment(self):
+        # Carries on from the newest readable segment's last timestamp, and appends to it if it's the last one and has room
+        segments=list_segments(self.directory)
+        for path in reversed(segments):
+            try:
+                segment=Segment(path)
+            except (OSError,ValueError) as e:
+                logging.error(f"Skipping sensor log segment {path}: {e}")
+                continue
+            count,first_timestamp,self.last_timestamp=segment.count,segment.first_timestamp,segment.last_timestamp
+            capacity=(len(segment.map)-HEADER_BYTES)//RECORD.size
+            segment.close()
+            if path!=segments[-1] or count>=capacity:
+                return # a new one will be started
+            try:
+                self.file=open(path,"r+b")
+                self.map=mmap.mmap(self.file.fileno(),0)
+            except OSError as e:
+                logging.error(f"Can't append to sensor log segment {path}, starting a new one: {e}")
+                if self.file is not None:
+                    self.file.close()
+                self.file=self.map=None
+                return
+            self.capacity=capacity
+            self.count=count
+            self.first_timestamp=first_timestamp
+            logging.info(f"Appending to sensor log segment {path}, {count} of {capacity} records used")
+            return
+
+    def _start_segment(self,first_timestamp:float):
+        self._close_segment()
+        segments=list_segments(self.directory)
+        number=_segment_number(segments[-1])+1 if segments else 0
+        path=os.path.join(self.directory,f"{SEGMENT_PREFIX}{number:013d}{SEGMENT_SUFFIX}")
+        self.file=open(path,"w+b")
+        self.capacity=self.segment_capacity
+        self.file.truncate(HEADER_BYTES+self.capacity*RECORD.size)
+        self.map=mmap.mmap(self.file.fileno(),0)
+        self.count=0
+        self.first_timestamp=first_timestamp
+        HEADER.pack_into(self.map,0,MAGIC,VERSION,RECORD.size,0,first_timestamp,first_timestamp)
+        logging.info(f"Started sensor log segment {path}")
+        self._remove_old_segments()
+
+    def _close_segment(self):
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+            self.file.close()
+            self.map=None
+            self.file=None
+
+    def _remove_old_segments(self):
+        # Oldest first until the rest fit in max_bytes, never the one we've just started
+        segments=list_segments(self.directory)
+        sizes=[os.path.getsize(path) for path in segments]
+        total=sum(sizes)
+        for path,size in zip(segments[:-1],sizes):
+            if total<=self.max_bytes:
+                break
+            logging.info(f"Removing old sensor log segment {path}")
+            os.remove(path)
+            total-=size
+
+    def close(self):
+        with self.lock:
+            if self.batch:
+                self._flush_locked()
+            self._close_segment()
+
+
+def list_segments(directory:str)->list[str]:
+    # Oldest first, by number rather than name so they stay in order past 13 digits
+    paths=[os.path.join(directory,name) for name in os.listdir(directory)
+           if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX) and name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)].isdigit()]
+    return sorted(paths,key=_segment_number)
+
+
+class Segment:
+    """
+        Read only view of one segment file, the record data is used in place from the mmap
+    """
+    def __init__(self,path:str):
+        self.path=path
+        with open(path,"rb") as f:
+            self.map=mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        if len(self.map)<HEADER_BYTES:
+            self.map.close()
+            raise ValueError(f"{path} is too short to be a sensor log segment")
+        magic,version,record_size,self.count,self.first_timestamp,self.last_timestamp=HEADER.unpack_from(self.map,0)
+        if magic!=MAGIC or version!=VERSION or record_size!=RECORD.size:
+            self.map.close()
+            raise ValueError(f"{path} isn't a version {VERSION} sensor log segment")
+
+    def timestamp_at(self,index:int)->float:
+        return RECORD.unpack_from(self.map,HEADER_BYTES+index*RECORD.size)[0]
+
+    def bisect(self,timestamp:float)->int:
+        # index of the first record at or after timestamp
+        lo,hi=0,self.count
+        while lo<hi:
+            mid=(lo+hi)//2
+            if self.timestamp_at(mid)<timestamp:
+                lo=mid+1
+            else:
+                hi=mid
+        return lo
+
+    def records(self,start:float,end:float)->memoryview:
+        """
+            The raw records with start<=timestamp<end, as a memoryview straight onto the file
+            (release it before closing the segment). Unpack with RECORD.iter_unpack
+        """
+        first=self.bisect(start)
+        last=self.bisect(end)
+        return memoryview(self.map)[HEADER_BYTES+first*RECORD.size:HEADER_BYTES+last*RECORD.size]
+
+    def close(self):
+        self.map.close()
+
+
+class SensorLogReader:
+    def __init__(self,directory:str):
+        self.directory=directory
+
+    def ranges(self,start:float,end:float):
+        """
+            Yields a memoryview of the raw records for each segment overlapping [start,end)
+            each view is only valid until the next one is yielded
+        """
+        for path in list_segments(self.directory):
+            # Timestamps carry on increasing from one segment to the next, so the headers say which to skip
+            try:
+                segment=Segment(path)
+            except (OSError,ValueError) as e:
+                logging.warning(f"Skipping sensor log segment {path}: {e}")
+                continue
+            if not segment.count or segment.last_timestamp<start:
+                segment.close()
+                continue
+            if segment.first_timestamp>=end:
+                segment.close()
+                break
+            view=segment.records(start,end)
+            try:
+                if len(view):
+                    yield view
+            finally:
+                view.release()
+                segment.close()
+
+    def records(self,start:float,end:float,kind:int|None=None):
+        """
+            Yields LogRecords in the window, optionally just one kind
+        """
+        for view in self.ranges(start,end):
+            # unpacked to a list so nothing is still using the view if we're abandoned part way through
+            for values in list(RECORD.iter_unpack(view)):
+                if kind is None or values[1]==kind:
+                    yield LogRecord.unpack(values)
+
+
+def _segment_number(path:str)->int:
+    # Segments used to be named after their first timestamp in ms, numbering on from there keeps them in order
+    name=os.path.basename(path)
+    return int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+
+
+def _parse_time(text:str)->float:
+    try:
+        return float(text)
+    except ValueError:
+        return datetime.datetime.fromisoformat(text).timestamp()
+
+
+if __name__=="__main__":
+    import argparse
+    import csv
+    import sys
+
+    parser=argparse.ArgumentParser(description="Dump or export a window of the sensor log")
+    parser.add_argument("command",choices=["dump","csv"])
+    parser.add_argument("--dir",default=settings.SENSOR_LOG_DIR)
+    parser.add_argument("--start",help="ISO datetime or epoch seconds, defaults to --hours before --end")
+    parser.add_argument("--end",help="ISO datetime or epoch seconds, defaults to now")
+    parser.add_argument("--hours",type=float,default=1.0)
+    parser.add_argument("--kind",choices=["sample","relay"])
+    args=parser.parse_args()
+
+    end=_parse_time(args.end) if args.end else time.time()
+    start=_parse_time(args.start) if args.start else end-args.hours*3600
+    kind={"sample":KIND_SAMPLE,"relay":KIND_RELAY,None:None}[args.kind]
+
+    reader=SensorLogReader(args.dir)
+    if args.command=="csv":
+        writer=csv.writer(sys.stdout)
+        writer.writerow(LogRecord.__dataclass_fields__.keys())
+        for record in reader.records(start,end,kind):
+            writer.writerow(vars(record).values())
+    else:
+        for record in reader.records(start,end,kind):
+            when=datetime.datetime.fromtimestamp(record.timestamp).isoformat(sep=" ",timespec="seconds")
+            if record.kind==KIND_RELAY:
+                print(f"{when} relay {record.relay} {'on' if record.relay_on else 'off'}")
+            else:
+                print(f"{when} OutHW {record.OutHW:6.2f} RetHW {record.RetHW:6.2f} OutRad {record.OutRad:6.2f} RetRad {record.RetRad:6.2f} "
+                      f"hw valve {record.hw_valve_open:d} rad valve {record.rad_valve_open:d} oil {record.oil_flowing:d}")
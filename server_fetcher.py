@@ -0,0 +1,264 @@
+import logging
+if __name__=="__main__":
+    logging.basicConfig(level=logging.DEBUG)
+
+"""
+
+Fetches the system state from the house server in its own thread
+
+Keeps one keep-alive session open and always uses connect/read timeouts,
+so a slow or hung server can only ever hold up this thread and never the
+relay control. The latest parsed state is published by replacing a single
+reference, so the control loop just reads fetcher.latest whenever it
+likes, and listeners are told when it changes.
+
+The server can also push states to us (see main.py), which go through
+push() and are treated just like a fetched one, so polling only needs to
+be a slow check that we haven't missed anything.
+
+If the server can't be reached we carry on with the last good state for
+a while rather than reacting to every dropped packet, and only fall back
+to something safe once it's older than the StalenessPolicy allows. That's
+judged whenever latest is read as well as when a fetch fails, so a fetch
+that hangs (eg on DNS, which the timeouts don't cover) or a thread that
+has died can't leave the controller on the last good state for ever;
+stale_at() says when to look again if nothing else happens.
+
+Listeners are called once the lock is released, and one that raises is
+logged rather than taking the thread (or a push) down with it.
+
+"""
+
+from dataclasses import dataclass
+import threading
+from typing import Callable
+
+from clock import Clock, real_clock
+import settings
+
+
+@dataclass
+class StalenessPolicy:
+    """
+        How long we keep running on the last good state when the server can't be reached,
+        and what to switch to after that (None to just carry on with the last good one)
+    """
+    max_age_s:float
+    degraded:Callable|None=None
+
+
+class ServerStateFetcher(threading.Thread):
+    def __init__(self,*,url:str,parse:callable,interval_s:float,policy:StalenessPolicy,name:str="ServerStateFetcher",clock:Clock=real_clock,
+                 accept:str="application/json"):
+        """
+            url is polled every interval_s
+            parse(body,content_type) turns the response body into the state object, eg protocol.parse
+            accept is sent as the Accept header, so the server can pick an encoding parse understands
+            policy says what to publish once the last good state is too old
+            clock times the polling and the staleness, so tests can skip through them
+
+            Requests are conditional on the ETag/Last-Modified of the last good response,
+            so if nothing has changed the server only has to send a 304
+        """
+        super().__init__(daemon=True)
+        self.name=name
+        self.url=url
+        self.parse=parse
+        self.accept_header=accept
+        self.interval_s=interval_s
+        self.policy=policy
+        self.clock=clock
+        self.session=None # made on the first fetch, see fetch_once
+        self.timeout=(settings.SERVER_CONNECT_TIMEOUT_S,settings.SERVER_READ_TIMEOUT_S)
+        self.listeners:list=[]
+        self.lock=threading.Lock() # pushes arrive on the web server's threads
+        self.stop_event=threading.Event()
+        self.first_state=threading.Event()
+
+        self.current=None # the last state published, only ever replaced whole, read through latest
+        self.latest_time:float=0.0 # when latest was last published or confirmed unchanged
+        self.last_good=None # the last state we actually got from the server
+        self.last_good_time:float=0.0
+        self.degraded:bool=False # True while we're publishing the policy's degraded state
+        self.etag:str|None=None
+        self.last_modified:str|None=None
+        self.last_body:bytes=b"" # for servers that don't do conditional requests
+        self.last_push_time:float=0.0
+
+        self.fetch_count:int=0
+        self.push_count:int=0
+        self.not_modified_count:int=0
+        self.failure_count:int=0
+        self.last_error:str=""
+
+    def __str__(self):
+        degraded=" DEGRADED" if self.degraded else ""
+        return (f"Server state{degraded}: age {self.age_s():.0f}s, {self.fetch_count} fetches, {self.push_count} pushes, "
+                f"{self.not_modified_count} not modified, {self.failure_count} failures, last error: {self.last_error or 'none'}")
+
+    def age_s(self,now:float|None=None)->float:
+        """
+            Seconds since we last heard from the server, infinite if we never have
+        """
+        if not self.last_good_time:
+            return float("inf")
+        return (self.clock.time() if now is None else now)-self.last_good_time
+
+    @property
+    def latest(self):
+        """
+            The state to act on, None until we've had one, the policy's degraded state
+            if the last good one is too old (however long it's been since a fetch finished)
+        """
+        if not self.degraded and self.policy.degraded is not None and self.last_good is not None and self.is_stale():
+            self.go_degraded(f"Nothing from {self.url} for {self.age_s():.0f}s, switching to the safe state")
+        return self.current
+
+    def is_stale(self,now:float|None=None)->bool:
+        return self.age_s(now)>=self.policy.max_age_s
+
+    def stale_at(self)->float|None:
+        """
+            The clock.time() the last good state gets too old, if that would change what latest returns
+        """
+        if self.degraded or self.policy.degraded is None or self.last_good is None:
+            return None
+        return self.last_good_time+self.policy.max_age_s
+
+    def go_degraded(self,why:str):
+        with self.lock:
+            if self.degraded or not self.is_stale():
+                return # another thread got here first, or a good state just came in
+            logging.error(why)
+            self.degraded=True
+            state=self.policy.degraded()
+            changed=self.publish_locked(state)
+        if changed:
+            self.notify(state)
+
+    def add_listener(self,callback:callable):
+        """
+            callback gets called when the published state changes:
+                callback(state=new_state,type="SERVER_STATE")
+            from this thread, a push's, or whichever read latest and found it stale
+        """
+        self.listeners.append(callback)
+
+    def publish_locked(self,state)->bool:
+        # Makes state the latest, returns True if it's different so notify() should be called once the lock is released
+        changed=state!=self.current
+        self.current=state
+        self.latest_time=self.clock.time()
+        self.first_state.set()
+        if changed:
+            logging.info(f"Server state now: {state}")
+        return changed
+
+    def notify(self,state):
+        for listener in self.listeners:
+            try:
+                listener(state=state,type="SERVER_STATE")
+            except Exception:
+                logging.exception(f"Server state listener {listener} failed")
+
+    def accept(self,state,requested_at:float|None=None):
+        """
+            A good state from the server, becomes the last known good and is published
+            unless it's from a poll that started before the latest push, which would be older
+        """
+        with self.lock:
+            if requested_at is not None and requested_at<self.last_push_time:
+                logging.debug("Ignoring polled server state that's older than the last push")
+                return
+            self.last_good=state
+            self.last_good_time=self.clock.time()
+            if self.degraded:
+                logging.warning(f"Server state back after {self.url} was unavailable")
+                self.degraded=False
+            changed=self.publish_locked(state)
+        if changed:
+            self.notify(state)
+
+    def push(self,state):
+        """
+            A state pushed to us by the server, takes effect straight away
+        """
+        with self.lock:
+            self.push_count+=1
+            self.last_push_time=self.clock.time()
+            # The next poll should compare against the server afresh, not our last poll
+            self.etag=None
+            self.last_modified=None
+            self.last_body=b""
+        self.accept(state)
+
+    def fetch_once(self)->bool:
+        import requests # here rather than at the top, it takes a tenth of a second to import
+        if self.session is None:
+            self.session=requests.Session()
+        self.fetch_count+=1
+        requested_at=self.clock.time()
+        headers={"Accept":self.accept_header}
+        if self.last_good is not None:
+            if self.etag:
+                headers["If-None-Match"]=self.etag
+            if self.last_modified:
+                headers["If-Modified-Since"]=self.last_modified
+        try:
+            response=self.session.get(self.url,headers=headers,timeout=self.timeout)
+            if response.status_code==304:
+                # Nothing has changed, so no need to parse anything
+                self.not_modified_count+=1
+                self.accept(self.last_good,requested_at)
+                return True
+            response.raise_for_status()
+            if self.last_good is not None and response.content==self.last_body:
+                # Same as last time, skip the parse
+                self.not_modified_count+=1
+                self.accept(self.last_good,requested_at)
+                return True
+            state=self.parse(response.content,response.headers.get("Content-Type"))
+        except (requests.RequestException,ValueError,KeyError,TypeError) as e:
+            self.failure_count+=1
+            self.last_error=str(e)
+            self.fetch_failed(e)
+            return False
+        with self.lock:
+            if requested_at>=self.last_push_time:
+                # Only remember what to check against next time if it isn't already out of date
+                self.etag=response.headers.get("ETag")
+                self.last_modified=response.headers.get("Last-Modified")
+                self.last_body=response.content
+        self.accept(state,requested_at)
+        return True
+
+    def fetch_failed(self,e:Exception):
+        if not self.is_stale():
+            logging.error(f"Failed to fetch system state from {self.url}, keeping the last good one from {self.age_s():.0f}s ago: {e}")
+        elif self.policy.degraded is None:
+            logging.error(f"Failed to fetch system state from {self.url}, still using the last good one: {e}")
+        elif not self.degraded:
+            self.go_degraded(f"Failed to fetch system state from {self.url} for over {self.policy.max_age_s:.0f}s, switching to the safe state: {e}")
+        else:
+            logging.error(f"Failed to fetch system state from {self.url}, staying in the safe state: {e}")
+
+    def wait_for_first(self,timeout_s:float|None=None)->bool:
+        return self.first_state.wait(timeout_s)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.fetch_once()
+            except Exception as e:
+                # Anything fetch_once doesn't expect, we keep polling and latest still goes stale on time
+                self.failure_count+=1
+                self.last_error=str(e)
+                logging.exception(f"Unexpected failure fetching system state from {self.url}")
+            self.clock.wait(self.stop_event,self.interval_s)
+        if self.session is not None:
+            self.session.close()
+
+    def stop(self,block_timeout_s:float=5):
+        self.stop_event.set()
+        if self.is_alive():
+            self.join(block_timeout_s)
@@ -1,3 +1,5 @@
+import os
+
 
 
 URL_TO_FETCH_SYSTEM_STATE="http://192.168.1.125/systemstate"
@@ -13,4 +15,41 @@ if HOT_WATER_OFF_TEMPERATURE-HOT_WATER_ON_TEMPERATURE<1.9:
 
 SERVER_STATE_FETCH_INTERVAL_S=100
 
-FAKE_WAIT_FOR_VALVE_TIME_S=10
\ No newline at end of file
+FAKE_WAIT_FOR_VALVE_TIME_S=10
+
+SERIAL_MAX_LINE_LENGTH=512 # bytes, anything longer from the sensor board is discarded
+
+TELEMETRY_CAPACITY=7*24*60*60 # samples of valve/temperature history kept in memory, a week at 1Hz is ~10MB
+HISTORY_MAX_S=7*24*60*60 # the longest window /history will work out stats over
+
+STATE_MACHINE_IDLE_INTERVAL_S=5 # circuit state machines step at least this often, valve changes wake them straight away
+
+SERVER_POLL_INTERVAL_S=7 # how often simpler.MainState polls the server, in the background
+SERVER_CONNECT_TIMEOUT_S=3.05
+SERVER_READ_TIMEOUT_S=5
+PUSH_TOKEN=os.environ.get("HEATINGPI_PUSH_TOKEN") # shared secret the house server sends with pushed states, None turns pushes off
+SERVER_RECONCILE_INTERVAL_S=120 # polling interval instead of SERVER_POLL_INTERVAL_S once pushes are turned on
+SERVER_STATE_MAX_AGE_S=10*60 # keep running on the last good server state this long if the server goes away, then turn things off
+
+SERIAL_PORT="/dev/ttyACM0" # used if the board can't be found by its USB ids
+SERIAL_BAUD=115200
+SERIAL_USB_IDS=[(0x2341,None), # Arduino (vendor id, product id or None for any)
+                (0x2A03,None), # Arduino.org
+                (0x1A86,0x7523)] # CH340 based clones
+SERIAL_RECONNECT_MIN_S=0.5 # back off between attempts to find/open the board doubles up to the max
+SERIAL_RECONNECT_MAX_S=10
+SERIAL_SILENCE_TIMEOUT_S=15 # reconnect if the board sends no frames for this long
+SENSOR_STALE_AFTER_S=15 # valve/temperature readings older than this are treated as stale
+
+SENSOR_LOG_DIR="sensor_log" # on-disk history of the readings and relay switching, None to turn it off
+SENSOR_LOG_SEGMENT_BYTES=16*1024*1024 # each segment holds about 8 days of 1Hz samples
+SENSOR_LOG_MAX_BYTES=24*SENSOR_LOG_SEGMENT_BYTES # oldest segments are deleted once they all take more than this, so about 6 months
+SENSOR_LOG_FLUSH_INTERVAL_S=60 # batch up writes to spare the SD card
+
+HEATING_VALVE_TIMEOUT_S=3*60 # if the heating valve hasn't reported open by now the pump is started anyway
+
+BOILER_AFTER_PUMP_S=2 # the boiler is only asked to fire once a pump has been running this long
+
+EVENTS_CLIENT_BUFFER=256 # events waiting for each /events client, one that falls this far behind is dropped
+EVENTS_SAMPLE_INTERVAL_S=5 # valve/temperature samples go out on /events at most this often, None for none
+EVENTS_HEARTBEAT_S=15 # comment line sent to idle /events clients, so dead connections get noticed
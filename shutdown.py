@@ -0,0 +1,104 @@
+import logging
+if __name__=="__main__":
+    logging.basicConfig(level=logging.DEBUG)
+
+"""
+
+Stops everything in the right order, quickly, and leaves the relays safe
+
+Components are added in the order they're started, each with a function
+that stops it and waits (up to its own timeout) for it to finish. A
+shutdown stops them in the reverse order, so whatever switches the relays
+goes before the things it depends on, and the first step added (normally
+putting the relays into their safe state) happens last, after nothing is
+left that could switch them back.
+
+All the stops are built on threading.Event and interruptible waits, so
+the whole thing normally takes a few milliseconds. A step that fails or
+overruns is logged and the rest carry on regardless.
+
+    coordinator=ShutdownCoordinator()
+    coordinator.add("relays safe",relays.Relay.reset_all)
+    coordinator.add("sensor board",valve_temp_thread.stop)
+    ...
+    coordinator.install_signal_handlers() # SIGTERM/SIGINT shut down then exit
+    ...
+    coordinator.shutdown("finished")
+
+"""
+
+from dataclasses import dataclass
+import signal
+import sys
+import threading
+import time
+from typing import Callable
+
+
+@dataclass
+class ShutdownStep:
+    name:str
+    stop:Callable[[],object]
+    duration_s:float=0.0
+    error:str=""
+
+
+class ShutdownCoordinator:
+    def __init__(self,name:str="Shutdown"):
+        self.name=name
+        self.steps:list[ShutdownStep]=[]
+        self.lock=threading.Lock()
+        self.requested=threading.Event() # set as soon as a shutdown starts
+        self.finished=threading.Event()
+        self.reason:str=""
+        self.duration_s:float=0.0
+
+    def __str__(self):
+        if not self.finished.is_set():
+            return f"{self.name}: {len(self.steps)} steps{', in progress' if self.requested.is_set() else ''}"
+        timings=", ".join(f"{step.name} {step.duration_s*1000:.0f}ms{' FAILED' if step.error else ''}" for step in reversed(self.steps))
+        return f"{self.name} ({self.reason}) took {self.duration_s*1000:.0f}ms: {timings}"
+
+    def add(self,name:str,stop:Callable[[],object]):
+        """
+            stop() should stop the component and wait for it, it's called in reverse order of adding
+        """
+        self.steps.append(ShutdownStep(name,stop))
+
+    def shutdown(self,reason:str="shutdown requested")->bool:
+        """
+            Runs the steps, only the first call does anything and any others wait for it to finish
+            returns True if every step stopped cleanly
+        """
+        with self.lock:
+            first=not self.requested.is_set()
+            self.requested.set()
+        if not first:
+            self.finished.wait()
+            return not any(step.error for step in self.steps)
+
+        self.reason=reason
+        logging.info(f"{self.name}: stopping {len(self.steps)} components because {reason}")
+        started=time.perf_counter()
+        for step in reversed(self.steps):
+            step_start=time.perf_counter()
+            try:
+                step.stop()
+            except Exception as e:
+                step.error=str(e) or type(e).__name__
+                logging.exception(f"{self.name}: failed to stop {step.name}")
+            step.duration_s=time.perf_counter()-step_start
+        self.duration_s=time.perf_counter()-started
+        self.finished.set()
+        logging.info(str(self))
+        return not any(step.error for step in self.steps)
+
+    def install_signal_handlers(self,signals:tuple=(signal.SIGTERM,signal.SIGINT)):
+        """
+            Shuts down on the signals, then exits. Must be called from the main thread
+        """
+        def handler(signum,frame):
+            self.shutdown(f"received {signal.Signals(signum).name}")
+            sys.exit(0)
+        for signum in signals:
+            signal.signal(signum,handler)
@@ -5,197 +5,282 @@ if __name__=="__main__":
 
 import relays
 import settings
-from dataclasses import dataclass
+import decision
+import protocol
+from protocol import SysHeatState, offline_state
 import valves_and_temps
+import telemetry
+import scheduler
+import sensor_log
+import events
+from server_fetcher import ServerStateFetcher, StalenessPolicy
 import datetime
-import requests
 import time
+from typing import Callable
+from clock import Clock, real_clock
+from shutdown import ShutdownCoordinator
+from metrics import TransitionStats
+from machine_definition import MachineDefinition
 
 import threading
-
-@dataclass
-class SysHeatState:
-    heating_currently_on:bool
-    hot_water_currently_on:bool
-    heating_boost_timeout:datetime.datetime
-    hot_water_temperature:float
-    hot_water_last_temp_dt:datetime.datetime
-    hot_water_boost_requested:datetime.datetime
-
-    @classmethod
-    def from_JSON(cls,jsondict):
-        return cls(jsondict["heating_currently_on"],
-                   jsondict["hot_water_currently_on"],
-                   datetime.datetime.fromisoformat(jsondict["heating_boost_timeout"]),
-                   jsondict["hot_water_temperature"],
-                   datetime.datetime.fromisoformat(jsondict["hot_water_last_temp_dt"]),
-                   datetime.datetime.fromisoformat(jsondict["hot_water_boost_requested"]))
-
-
-
-def get_main_system_state(url)->SysHeatState:
-    try:
-        r=requests.get(url)
-        main_state=r.json()
-        logging.info(f"Found state: {main_state}")
-        shs=SysHeatState.from_JSON(main_state)
-        logging.info(f"""Server says:.....................
-                {shs.heating_currently_on=}
-                {shs.hot_water_temperature=}
-                {shs.hot_water_last_temp_dt=}
-                {shs.hot_water_currently_on=}
-                {shs.heating_currently_on=}""")
-    except Exception as e:
-        logging.error(f"Failed to fetch system state from {url}, assuming everything off: {e}")
-        shs=SysHeatState(False,False,datetime.datetime.now(),-100.0,datetime.datetime.now()-datetime.timedelta(hours=1),datetime.datetime.now()-datetime.timedelta(hours=1))
-    return shs
+import atexit
+from events import reading
 
 class SimpleState:
-    def __init__(self,valid_states,starting_state):
-        self.valid_states=valid_states
-        self.state=starting_state
-        self.last_changed=datetime.datetime.now()
-
-    def change_state(self,new_state):
-        if new_state not in self.valid_states:
-            raise ValueError(f"{new_state} is not one of the valid states ({self.valid_states})")
-        self.last_changed=datetime.datetime.now()
+    def __init__(self,definition:MachineDefinition,clock:Clock=real_clock,phases:tuple[str,...]=(),name:str=""):
+        # starts in the definition's initial state
+        # phases are the states whose recent durations are kept in stats, eg the valve opening
+        self.name=name
+        self.definition=definition
+        self.listeners:list=[] # called as listener(name=name,old_state=..,new_state=..,type="STATE_CHANGE") after a change
+        self.state=definition.initial
+        self.clock=clock
+        self.last_changed=clock.now()
+        self.stats=TransitionStats(self.state,self.last_changed.timestamp(),phases=phases)
+
+    def change_state(self,new_state,now:float|None=None):
+        # now is a clock.time(), defaults to the clock's current time
+        # ValueError if the definition doesn't allow the change
+        new_state=self.definition.state(new_state)
+        if new_state is not self.state:
+            self.definition.check(self.state,new_state)
+        self.last_changed=self.clock.now() if now is None else datetime.datetime.fromtimestamp(now)
+        self.stats.transition(new_state,self.last_changed.timestamp())
+        old_state=self.state
         self.state=new_state
+        if new_state is not old_state:
+            for listener in self.listeners:
+                listener(name=self.name,old_state=old_state,new_state=new_state,type="STATE_CHANGE")
 
-    def mins_since_change(self)->float:
-        delta=datetime.datetime.now()-self.last_changed
+    def mins_since_change(self,now:float|None=None)->float:
+        current=self.clock.now() if now is None else datetime.datetime.fromtimestamp(now)
+        delta=current-self.last_changed
         return delta.total_seconds()/60.0
 
     def __str__(self):
         return self.state
 
     def __eq__(self,other):
-        if str(other) not in self.valid_states:
-            raise ValueError(f"{other} is not one of the valid states ({self.valid_states})")
-        return str(other)==str(self)
+        # Checks other is a state at all, so a typo can't just silently never match
+        if isinstance(other,SimpleState):
+            return self.state is other.state
+        state=self.definition.by_value.get(other)
+        if state is None:
+            raise ValueError(f"{other} is not one of the valid states ({[state.value for state in self.definition.states]})")
+        return state is self.state
 
 class MainState(threading.Thread):
-    def __init__(self):
+    def __init__(self,*,sensor_feed:Callable=valves_and_temps.ValvesTemps,server_fetcher=None,clock:Clock=real_clock):
+        """
+            sensor_feed is called as sensor_feed(shared_state,recorders=recorders) to make the thread
+            that keeps the valve/temperature readings up to date, normally the serial reader
+            server_fetcher is anything with the ServerStateFetcher interface (latest, add_listener, start),
+            by default one polling settings.URL_TO_FETCH_SYSTEM_STATE
+
+            clock is what the circuit states, deadlines and waits are timed on
+
+            These are all swapped out by simulator.py to run this against a model of the house
+
+            Making one doesn't touch the hardware or start anything, start() does
+        """
         super().__init__(daemon=True)
         self.name="HeatingPiMainThread"
         self.daemon=True
-        self.heating=SimpleState(["OFF","OPENING_VALVE","HEATING"],"OFF")
-        self.hot_water=SimpleState(["OFF","OPENING_VALVE","HEATING"],"OFF")   
+        self.clock=clock
+        self.stop_requested=False
+        # Everything we start goes in here, stop() stops them in reverse order
+        self.shutdown_coordinator=ShutdownCoordinator(name="HeatingPi shutdown")
+        self.heating=SimpleState(decision.CIRCUIT_MACHINE,clock,phases=("OPENING_VALVE",),name="heating")
+        self.hot_water=SimpleState(decision.CIRCUIT_MACHINE,clock,phases=("OPENING_VALVE",),name="hot_water")
+        self.relay_bank=relays.RelayBank([getattr(relays,name) for name in decision.RELAY_NAMES],
+                                         [relays.Sequencing(("hot_water_pump","heating_pump"),"boiler_heat_req",settings.BOILER_AFTER_PUMP_S)])
+        self.relay_retry_at:float|None=None # when the bank can finish switching something it held back
         self.valve_temp_states=valves_and_temps.ValveTempState.new_blank() # Continuously updates by the thread below by serial monitoring
-        self.valve_temp_thread=valves_and_temps.ValvesTemps(self.valve_temp_states)
+        self.telemetry=telemetry.TelemetryRing(settings.TELEMETRY_CAPACITY) # history of the above
+        # Changes pushed out to /events clients
+        self.events=events.EventHub(initial=self.status)
+        self.heating.listeners.append(self.events.state_changed)
+        self.hot_water.listeners.append(self.events.state_changed)
+        relays.Relay.transition_listeners.append(self.events.relay_switched)
+        self.shutdown_coordinator.add("events clients",self.events.close_all) # last, so they see the relays go safe
+        self.shutdown_coordinator.add("events relay listener",lambda:relays.Relay.remove_transition_listener(self.events.relay_switched))
+        recorders=[self.telemetry,self.events]
+        self.sensor_log:sensor_log.SensorLogWriter|None=None
+        if settings.SENSOR_LOG_DIR:
+            # Long term history on disk, relay switching goes in there too
+            self.sensor_log=sensor_log.SensorLogWriter(settings.SENSOR_LOG_DIR)
+            recorders.append(self.sensor_log)
+            relays.Relay.transition_listeners.append(self.sensor_log.relay_changed)
+            atexit.register(self.sensor_log.close)
+            self.shutdown_coordinator.add("sensor log",self.sensor_log.close) # after the relays, so it has their last switches
+            self.shutdown_coordinator.add("sensor log relay listener",lambda:relays.Relay.remove_transition_listener(self.sensor_log.relay_changed))
+        self.shutdown_coordinator.add("relays safe",relays.Relay.reset_all)
+        self.valve_temp_thread=sensor_feed(self.valve_temp_states,recorders=recorders)
+        self.wakeup=scheduler.Wakeup(clock) # notified to re-evaluate straight away, eg when a valve opens
+        self.valve_temp_states.add_subscriber(self.valve_edge)
+        self.shutdown_coordinator.add("sensor board",self.valve_temp_thread.stop)
+
+        # Demand from the house server is polled in the background so it can never hold up the relays
+        # if the server pushes changes to us (main.py) polling is just a slow check we've not missed any
+        if server_fetcher is None:
+            server_fetcher=ServerStateFetcher(url=settings.URL_TO_FETCH_SYSTEM_STATE,
+                                              parse=protocol.parse,
+                                              accept=protocol.ACCEPT,
+                                              interval_s=settings.SERVER_RECONCILE_INTERVAL_S if settings.PUSH_TOKEN else settings.SERVER_POLL_INTERVAL_S,
+                                              policy=StalenessPolicy(settings.SERVER_STATE_MAX_AGE_S,degraded=lambda:offline_state(clock.now())),
+                                              clock=clock)
+        self.server_fetcher=server_fetcher
+        self.server_fetcher.add_listener(self.server_state_changed)
+        self.shutdown_coordinator.add("server fetcher",lambda:self.server_fetcher.stop(block_timeout_s=0.2)) # a daemon, so an in-flight request needn't hold us up
+        self.shutdown_coordinator.add("control loop",self.stop_loop)
+
+    def start(self):
+        """
+            Puts the relays into their safe state, then starts reading the sensor board,
+            polling the server and the control loop, in that order
+        """
+        relays.Relay.attach_all()
         self.valve_temp_thread.start()
+        self.server_fetcher.start()
+        super().start()
+
+    def valve_edge(self,*,field:str,type:str,**kwargs):
+        # Called from the serial thread when a valve or the oil flow changes, or the readings go stale or come back
+        self.wakeup.notify(f"{field} {type}")
+
+    def server_state_changed(self,**kwargs):
+        # Called from the fetcher thread with a different state from the server
+        self.wakeup.notify("server state")
 
     def run(self):
 
-        while True:
-            # Fetch requirements from server
-            server_state:SysHeatState=get_main_system_state(settings.URL_TO_FETCH_SYSTEM_STATE)
-
-            # Calculate if we want to heat water
-            heat_water= server_state.hot_water_temperature<settings.HOT_WATER_OFF_TEMPERATURE and server_state.hot_water_currently_on
-
-            # Calculate if we want to heat radiators
-            heat_radiators=server_state.heating_currently_on
-
-            logging.info(f"Heating wanted: {heat_radiators}, Hotter water wanted: {heat_water}")
-
-            logging.info(f"Valves and temps: {self.valve_temp_states}")
-
-            # Update the hw_state
-            if heat_water:
-                match self.hot_water:
-                    case "OFF":
-                        # open the valve
-                        relays.hot_water_valve.on()
-                        logging.info("Hotter water demanded, starting to open valve")
-                        self.hot_water.change_state("OPENING_VALVE")
-                        
-
-                    case "OPENING_VALVE":
-                        # is the valve open
-                        if self.valve_temp_states.hw_valve_open:
-                            relays.hot_water_pump.on()
-                            self.hot_water.change_state("HEATING")
-                        
-
-            else:
-                match self.hot_water:
-                    case "HEATING":
-                        # We need to switch off the heating
-                        relays.hot_water_valve.off()
-                        relays.hot_water_pump.off()
-                        self.hot_water.change_state("OFF")
-                        
-
-                    case "OPENING_VALVE":
-                        # We want the heating to stop, so kill it
-                        relays.hot_water_valve.off()
-                        relays.hot_water_pump.off()
-                        self.hot_water.change_state("OFF")
-                        
-
-            # Update the heating state
-            if heat_radiators:
-                match self.heating:
-                    case "OFF":
-                        # open the valve
-                        relays.heating_valve.on()
-                        self.heating.change_state("OPENING_VALVE")
-                        logging.info(f"started opening heating valve\n\t because:\n\t\t{heat_radiators=}, {self.heating=}" )
-                        
-
-                    case "OPENING_VALVE":
-                        # is the valve open
-                        if self.valve_temp_states.rad_valve_open:
-                            relays.heating_pump.on()
-                            self.heating.change_state("HEATING")
-
-                        if self.heating.mins_since_change()>3.0:
-                            # Been opening for 3 minutes, something is wrong, turn it off
-                            logging.error(f"\n{'='*60}\nHeating valve failed to open in 3 minutes, turning pump on anyway!\n{'='*60}\n")
-                            relays.heating_pump.on()
-                            self.heating.change_state("HEATING")
-                        
-
-            else:
-                match self.heating:
-                    case "HEATING":
-                        # We need to switch off the heating
-                        relays.heating_valve.off()
-                        relays.heating_pump.off()
-                        self.heating.change_state("OFF")
-                        logging.info("heating stopped")
-                        
-
-                    case "OPENING_VALVE":
-                        # We want the heating to stop, so kill it
-                        relays.heating_valve.off()
-                        relays.heating_pump.off()
-                        self.heating.change_state("OFF")
-                        logging.info("Heating stopped early")
-                        
-            # Calculate if boiler should be burning
-
-            boiler_required= (heat_water and self.hot_water=="HEATING") or (heat_radiators and self.heating=="HEATING")
-            if boiler_required:
-                relays.boiler_heat_req.on()
-            else:
-                relays.boiler_heat_req.off()
-
-            logging.info("\n\n")
-            time.sleep(7)
+        while not self.stop_requested:
+            # The latest requirements from the server, nothing to do until we've had some
+            server_state:SysHeatState|None=self.server_fetcher.latest
+            if server_state is not None:
+                self.evaluate(server_state)
+
+            # Sleep until something changes or the next thing we need to check on
+            reasons=self.wakeup.wait_until(self.next_deadline())
+            if reasons:
+                logging.info(f"Woken up by: {', '.join(sorted(reasons))}")
+        logging.info(f"{self.name} stopped")
+
+    def stop_loop(self,block_timeout_s:float=1):
+        # Stops us switching relays, the first thing to go in a shutdown
+        self.stop_requested=True
+        self.wakeup.notify("stop")
+        if self.is_alive():
+            self.join(block_timeout_s)
+            if self.is_alive():
+                raise Exception(f"Failed to stop {self.name} {block_timeout_s} seconds after stop requested")
+
+    def stop(self,reason:str="stop requested")->bool:
+        """
+            Stops the control loop, the server fetcher and the sensor board, then puts the relays
+            into their safe state and closes the sensor log. Returns True if it all went cleanly
+        """
+        return self.shutdown_coordinator.shutdown(reason)
+
+    def next_deadline(self)->float|None:
+        """
+            The clock.time() at which something will need doing even if nothing changes,
+            or None if we're just waiting on events
+        """
+        valve_timeout=None
+        if self.heating=="OPENING_VALVE":
+            valve_timeout=self.heating.last_changed.timestamp()+settings.HEATING_VALVE_TIMEOUT_S
+        # stale_at so a server that's gone quiet (or a fetch that's hung) still gets us to the safe state on time
+        return scheduler.earliest(valve_timeout,self.relay_retry_at,self.server_fetcher.stale_at())
+
+    def evaluate(self,server_state:SysHeatState,now:float|None=None):
+        """
+            Works out what the circuits and boiler should be doing now (see decision.py) and switches the relays to match
+        """
+        now=self.clock.time() if now is None else now
+        sensors=self.valve_temp_states.snapshot() # one consistent frame for this pass
+        result=decision.decide(server_state,sensors,self.hot_water,self.heating,self.heating.last_changed.timestamp(),now)
+        heat_water,heat_radiators=decision.demand(server_state)
+        logging.info(f"Heating wanted: {heat_radiators}, Hotter water wanted: {heat_water}")
+        logging.info(f"Valves and temps: {sensors}")
+
+        # The valve timeout is only logged by its note, as an error so it stands out
+        level=logging.ERROR if result.heating_valve_timed_out else logging.INFO
+        for note in result.notes:
+            logging.log(level,note)
+        if result.heating_valve_timed_out:
+            self.heating.stats.timed_out("OPENING_VALVE")
+        if result.hot_water!=self.hot_water:
+            self.hot_water.change_state(result.hot_water,now)
+        if result.heating!=self.heating:
+            self.heating.change_state(result.heating,now)
+
+        # The bank only switches the relays that differ, off first then in RELAY_NAMES order
+        self.relay_retry_at=self.relay_bank.apply(result.relay_states(),now)
+
+        logging.info("\n\n")
+
+    def status_key(self)->tuple:
+        """
+            Cheap to make and only different when status() would be, for status.StatusCache
+        """
+        # The server state itself rather than its id(), which a new one can reuse once the old one's gone.
+        # Temperatures go through reading() as NaN never equals itself, and would rebuild every time
+        sensors=self.valve_temp_states.snapshot()
+        return (self.heating.state,self.heating.last_changed,
+                self.hot_water.state,self.hot_water.last_changed,
+                tuple(relay.is_on for relay in self.relay_bank.relays.values()),
+                (reading(sensors.OutHW),reading(sensors.RetHW),reading(sensors.OutRad),reading(sensors.RetRad),
+                 sensors.hw_valve_open,sensors.rad_valve_open,sensors.oil_flowing,sensors.connected,sensors.is_stale()),
+                self.server_fetcher.latest,getattr(self.server_fetcher,"degraded",False))
+
+    def status(self)->dict:
+        """
+            What the circuits, relays and sensors are doing, and what the server last asked for,
+            all from snapshots so it's safe to call from any thread
+        """
+        sensors=self.valve_temp_states.snapshot()
+        server_state=self.server_fetcher.latest
+        return {"heating":{"state":self.heating.state,"since":self.heating.last_changed.isoformat()},
+                "hot_water":{"state":self.hot_water.state,"since":self.hot_water.last_changed.isoformat()},
+                "relays":{name:relay.is_on for name,relay in self.relay_bank.relays.items()},
+                "sensors":{"OutHW":reading(sensors.OutHW),"RetHW":reading(sensors.RetHW),
+                           "OutRad":reading(sensors.OutRad),"RetRad":reading(sensors.RetRad),
+                           "hw_valve_open":sensors.hw_valve_open,"rad_valve_open":sensors.rad_valve_open,
+                           "oil_flowing":sensors.oil_flowing,"connected":sensors.connected,"stale":sensors.is_stale()},
+                "server":server_state.to_JSON() if server_state is not None else None,
+                "server_degraded":getattr(self.server_fetcher,"degraded",False)}
+
+    def metrics(self)->dict:
+        """
+            Transition counts and dwell times of the circuits, and how much the relays are switched
+        """
+        now=self.clock.time()
+        return {"heating":self.heating.stats.to_dict(now),
+                "hot_water":self.hot_water.stats.to_dict(now),
+                "relay_bank":{"writes":self.relay_bank.writes,
+                              "no_ops":self.relay_bank.no_ops,
+                              "deferrals":self.relay_bank.deferrals},
+                "events":{"clients":len(self.events.subscriptions),
+                          "published":self.events.published,
+                          "dropped_clients":self.events.dropped_clients}}
 
     def __str__(self):
+        sensors=self.valve_temp_states.snapshot()
         return f"""Heating: 
-        Radiators demand: {self.heating}
-        Hotter water damand: {self.hot_water}
-        Valve temps: {self.valve_temp_states}
+        Radiators demand: {self.heating} ({self.heating.stats})
+        Hotter water damand: {self.hot_water} ({self.hot_water.stats})
+        Valve temps: {sensors}{" (STALE)" if sensors.is_stale() else ""} age {sensors.age_s():.1f}s
+        {self.valve_temp_thread.health()}
+        {self.server_fetcher}
+        {self.events}
         Relays: 
             HW valve {relays.hot_water_valve}
             HW pump {relays.hot_water_pump}
             Heating valve {relays.heating_valve}
             Heating pump {relays.heating_pump}
-            Boiler heat req {relays.boiler_heat_req}"""
+            Boiler heat req {relays.boiler_heat_req}
+        {self.relay_bank}"""
 
 
 
@@ -0,0 +1,366 @@
+import logging
+if __name__=="__main__":
+    logging.basicConfig(level=logging.WARNING)
+
+"""
+
+Runs the real controllers against a simple model of the house, faster than real time
+
+The relays get gpiozero's mock pin factory instead of the GPIO, the serial
+sensor board is replaced by a SimulatedSensorFeed reading a HouseModel, and
+the house server by a StubServer with a heating/hot water timetable and a
+room thermostat. The controller (simpler.MainState or sys_state.SystemState)
+is given a clock.ManualClock and driven step by step rather than running
+its threads, so a day takes a few seconds.
+
+The model is deliberately crude:
+    a boiler loop that the burner heats (cycling on its own thermostat)
+    a hot water tank heated through its coil, with draw-offs for baths/showers
+    the house heated by the radiators and losing heat to a daily outside temperature
+    motorised valves that take valve_travel_s to open or close, with their
+    end switches only reporting open once fully open
+
+At the end it reports boiler heat requests, burner starts, relay switches
+and the temperature excursions, eg:
+
+    uv run simulator.py --hours 24 --controller both
+
+"""
+
+import os
+os.environ.setdefault("GPIOZERO_PIN_FACTORY","mock") # before any relay is attached and claims its pin
+
+from dataclasses import dataclass, field
+import argparse
+import datetime
+import math
+import time
+
+from clock import ManualClock
+import relays
+import settings
+import simpler
+import sys_state
+from valves_and_temps import ValveTempSnapshot
+
+WATER_J_PER_KG_K=4186
+
+
+@dataclass
+class HouseModel:
+    boiler_power_w:float=24000
+    burner_on_at:float=72.0 # the boiler's own thermostat on the flow temperature
+    burner_off_at:float=82.0
+    loop_j_per_k:float=60*WATER_J_PER_KG_K
+    loop_loss_w_per_k:float=15
+    tank_j_per_k:float=150*WATER_J_PER_KG_K
+    coil_w_per_k:float=450
+    tank_loss_w_per_k:float=2.5
+    mains_temperature:float=10.0
+    draw_litres_per_s:float=0.15
+    house_j_per_k:float=12e6
+    house_loss_w_per_k:float=200
+    radiator_w_per_k:float=350
+    outside_mean:float=5.0
+    outside_swing:float=4.0 # +/- through the day, warmest at 3pm
+    valve_travel_s:float=30.0
+    pipe_time_constant_s:float=300.0
+
+    # The state of the model
+    flow_temperature:float=20.0
+    tank_temperature:float=50.0
+    house_temperature:float=19.0
+    hw_valve_position:float=0.0 # 0 shut to 1 fully open
+    rad_valve_position:float=0.0
+    burner_on:bool=False
+    OutHW:float=20.0
+    RetHW:float=20.0
+    OutRad:float=20.0
+    RetRad:float=20.0
+    draw_off_remaining_l:float=0.0
+
+    def outside_temperature(self,hour:float)->float:
+        return self.outside_mean+self.outside_swing*math.cos(2*math.pi*(hour-15)/24)
+
+    def step(self,dt:float,hour:float):
+        """
+            Moves the model on dt seconds with the relays as they are now
+        """
+        self.hw_valve_position=_travel(self.hw_valve_position,relays.hot_water_valve.is_on,dt/self.valve_travel_s)
+        self.rad_valve_position=_travel(self.rad_valve_position,relays.heating_valve.is_on,dt/self.valve_travel_s)
+        hw_flow=self.hw_valve_position if relays.hot_water_pump.is_on else 0.0
+        rad_flow=self.rad_valve_position if relays.heating_pump.is_on else 0.0
+
+        # The burner cycles on its own thermostat while asked for heat, as long as something's circulating
+        if not relays.boiler_heat_req.is_on or hw_flow+rad_flow==0.0:
+            self.burner_on=False
+        elif self.flow_temperature<self.burner_on_at:
+            self.burner_on=True
+        elif self.flow_temperature>self.burner_off_at:
+            self.burner_on=False
+
+        to_tank_w=self.coil_w_per_k*hw_flow*(self.flow_temperature-self.tank_temperature)
+        to_house_w=self.radiator_w_per_k*rad_flow*(self.flow_temperature-self.house_temperature)
+        loop_loss_w=self.loop_loss_w_per_k*(self.flow_temperature-self.house_temperature)
+        burner_w=self.boiler_power_w if self.burner_on else 0.0
+        self.flow_temperature+=dt*(burner_w-to_tank_w-to_house_w-loop_loss_w)/self.loop_j_per_k
+
+        drawn_l=min(self.draw_off_remaining_l,self.draw_litres_per_s*dt)
+        self.draw_off_remaining_l-=drawn_l
+        draw_w=drawn_l/dt*WATER_J_PER_KG_K*(self.tank_temperature-self.mains_temperature)
+        tank_loss_w=self.tank_loss_w_per_k*(self.tank_temperature-self.house_temperature)
+        self.tank_temperature+=dt*(to_tank_w-tank_loss_w-draw_w)/self.tank_j_per_k
+
+        house_loss_w=self.house_loss_w_per_k*(self.house_temperature-self.outside_temperature(hour))
+        self.house_temperature+=dt*(to_house_w+tank_loss_w+loop_loss_w-house_loss_w)/self.house_j_per_k
+
+        # Pipe sensors follow the flow when it's moving, otherwise drift back to room temperature
+        blend=min(1.0,dt/self.pipe_time_constant_s)
+        out_hw,ret_hw=(self.flow_temperature,self.tank_temperature+(self.flow_temperature-self.tank_temperature)*0.4) if hw_flow else (self.house_temperature,self.house_temperature)
+        out_rad,ret_rad=(self.flow_temperature,self.house_temperature+(self.flow_temperature-self.house_temperature)*0.7) if rad_flow else (self.house_temperature,self.house_temperature)
+        self.OutHW+=(out_hw-self.OutHW)*blend
+        self.RetHW+=(ret_hw-self.RetHW)*blend
+        self.OutRad+=(out_rad-self.OutRad)*blend
+        self.RetRad+=(ret_rad-self.RetRad)*blend
+
+    def draw_off(self,litres:float):
+        self.draw_off_remaining_l+=litres
+
+    def snapshot(self,now:float)->ValveTempSnapshot:
+        return ValveTempSnapshot(round(self.OutHW,2),round(self.RetHW,2),round(self.OutRad,2),round(self.RetRad,2),
+                                 self.hw_valve_position>=1.0,self.rad_valve_position>=1.0,self.burner_on,
+                                 timestamp=now,connected=True)
+
+
+def _travel(position:float,opening:bool,fraction:float)->float:
+    return min(1.0,position+fraction) if opening else max(0.0,position-fraction)
+
+
+class SimulatedSensorFeed:
+    """
+        Stands in for valves_and_temps.ValvesTemps, the simulator calls publish() each step
+    """
+    def __init__(self,shared_state,recorders:list|None=None):
+        self.state=shared_state
+        self.recorders=recorders or []
+        self.frames:int=0
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def health(self)->str:
+        return f"Simulated sensor board, {self.frames} frames"
+
+    def publish(self,model:HouseModel,now:float):
+        snapshot=model.snapshot(now)
+        self.state.publish(snapshot)
+        for recorder in self.recorders:
+            recorder.record(now,snapshot)
+        self.frames+=1
+
+
+@dataclass
+class Timetable:
+    heating:list[tuple[float,float]]=field(default_factory=lambda:[(6.0,9.0),(16.5,22.5)]) # (from hour, to hour)
+    hot_water:list[tuple[float,float]]=field(default_factory=lambda:[(5.0,7.0),(16.0,18.0)])
+    draw_offs:list[tuple[float,float]]=field(default_factory=lambda:[(7.0,50),(7.5,40),(12.5,10),(19.0,80),(21.5,20)]) # (hour, litres)
+    room_setpoint:float=20.0
+    room_hysteresis:float=0.5
+
+    @staticmethod
+    def active(periods:list[tuple[float,float]],hour:float)->bool:
+        return any(start<=hour<end for start,end in periods)
+
+
+class StubServer:
+    """
+        Stands in for the house server and the ServerStateFetcher, with a room thermostat
+        on the heating periods and the tank temperature reported every report_interval_s
+    """
+    def __init__(self,timetable:Timetable,report_interval_s:float=60):
+        self.timetable=timetable
+        self.report_interval_s=report_interval_s
+        self.listeners:list=[]
+        self.latest:simpler.SysHeatState|None=None
+        self.latest_time:float=0.0
+        self.calling_for_heat=False
+        self.reports:int=0
+
+    def start(self):
+        pass
+
+    def stop(self,block_timeout_s:float=5):
+        pass
+
+    def add_listener(self,callback:callable):
+        self.listeners.append(callback)
+
+    def stale_at(self)->float|None:
+        return None # we never go quiet
+
+    def __str__(self):
+        return f"Stub server, {self.reports} reports"
+
+    def update(self,model:HouseModel,now:float,hour:float):
+        if self.latest is not None and now-self.latest_time<self.report_interval_s:
+            return
+        if model.house_temperature<self.timetable.room_setpoint-self.timetable.room_hysteresis:
+            self.calling_for_heat=True
+        elif model.house_temperature>self.timetable.room_setpoint+self.timetable.room_hysteresis:
+            self.calling_for_heat=False
+        when=datetime.datetime.fromtimestamp(now)
+        state=simpler.SysHeatState(self.calling_for_heat and self.timetable.active(self.timetable.heating,hour),
+                                   self.timetable.active(self.timetable.hot_water,hour),
+                                   when,
+                                   round(model.tank_temperature,1),
+                                   when,
+                                   when-datetime.timedelta(hours=1))
+        changed=state.heating_currently_on!=getattr(self.latest,"heating_currently_on",None) or \
+                state.hot_water_currently_on!=getattr(self.latest,"hot_water_currently_on",None) or \
+                state.hot_water_temperature!=getattr(self.latest,"hot_water_temperature",None)
+        self.latest=state
+        self.latest_time=now
+        self.reports+=1
+        if changed:
+            for listener in self.listeners:
+                listener(state=state,type="SERVER_STATE")
+
+
+@dataclass
+class SimulationReport:
+    controller:str
+    hours:float
+    wall_s:float=0.0
+    steps:int=0
+    evaluations:int=0
+    heat_requests:int=0 # boiler_heat_req switched on
+    burner_starts:int=0
+    burner_hours:float=0.0
+    relay_switches:dict[str,int]=field(default_factory=dict)
+    pump_against_shut_valve_s:float=0.0 # a pump running with its valve not fully open
+    tank_min:float=float("inf")
+    tank_max:float=float("-inf")
+    tank_cold_minutes:float=0.0 # below HOT_WATER_ON_TEMPERATURE in a hot water period
+    tank_overheat_minutes:float=0.0 # above HOT_WATER_SHUTDOWN_TEMPERATURE
+    house_min:float=float("inf")
+    house_max:float=float("-inf")
+    house_cold_minutes:float=0.0 # over a degree below the setpoint in a heating period
+    flow_max:float=float("-inf")
+
+    def relay_switched(self,*,relay,is_on:bool,**kwargs):
+        self.relay_switches[relay.name]=self.relay_switches.get(relay.name,0)+1
+        if relay is relays.boiler_heat_req and is_on:
+            self.heat_requests+=1
+
+    def observe(self,model:HouseModel,timetable:Timetable,hour:float,dt:float,burner_was_on:bool):
+        if model.burner_on and not burner_was_on:
+            self.burner_starts+=1
+        if model.burner_on:
+            self.burner_hours+=dt/3600
+        if (relays.hot_water_pump.is_on and model.hw_valve_position<1.0) or (relays.heating_pump.is_on and model.rad_valve_position<1.0):
+            self.pump_against_shut_valve_s+=dt
+        self.tank_min=min(self.tank_min,model.tank_temperature)
+        self.tank_max=max(self.tank_max,model.tank_temperature)
+        if model.tank_temperature<settings.HOT_WATER_ON_TEMPERATURE and timetable.active(timetable.hot_water,hour):
+            self.tank_cold_minutes+=dt/60
+        if model.tank_temperature>settings.HOT_WATER_SHUTDOWN_TEMPERATURE:
+            self.tank_overheat_minutes+=dt/60
+        self.house_min=min(self.house_min,model.house_temperature)
+        self.house_max=max(self.house_max,model.house_temperature)
+        if model.house_temperature<timetable.room_setpoint-1.0 and timetable.active(timetable.heating,hour):
+            self.house_cold_minutes+=dt/60
+        self.flow_max=max(self.flow_max,model.flow_temperature)
+
+    def __str__(self):
+        switches=", ".join(f"{name} {count}" for name,count in sorted(self.relay_switches.items())) or "none"
+        return f"""{self.controller}: {self.hours:g} simulated hours in {self.wall_s:.2f}s ({self.steps} steps, {self.evaluations} evaluations)
+    Boiler: {self.heat_requests} heat requests, {self.burner_starts} burner starts, {self.burner_hours:.2f} burner hours, flow max {self.flow_max:.1f}C
+    Relay switches: {switches}
+    Pumps running against a valve that isn't fully open: {self.pump_against_shut_valve_s/60:.1f} minutes
+    Tank {self.tank_min:.1f}C to {self.tank_max:.1f}C, {self.tank_cold_minutes:.0f} minutes cold in hot water periods, {self.tank_overheat_minutes:.0f} minutes over {settings.HOT_WATER_SHUTDOWN_TEMPERATURE}C
+    House {self.house_min:.1f}C to {self.house_max:.1f}C, {self.house_cold_minutes:.0f} minutes over a degree cold in heating periods"""
+
+
+def simulate(controller:str="simpler",hours:float=24,step_s:float=2.0,
+             model:HouseModel|None=None,timetable:Timetable|None=None,start:float|None=None)->SimulationReport:
+    """
+        controller is "simpler" for simpler.MainState or "sys_state" for sys_state.SystemState
+        start is the simulated time.time() to begin at, by default the last midnight
+    """
+    model=model or HouseModel()
+    timetable=timetable or Timetable()
+    if start is None:
+        start=datetime.datetime.combine(datetime.date.today(),datetime.time()).timestamp()
+    clock=ManualClock(start)
+    report=SimulationReport(controller,hours)
+    server=StubServer(timetable)
+    relays.Relay.reset_all()
+    relays.Relay.transition_listeners.append(report.relay_switched)
+    sensor_log_dir=settings.SENSOR_LOG_DIR
+    settings.SENSOR_LOG_DIR=None # keep the simulated readings out of the real log
+    try:
+        if controller=="simpler":
+            system=simpler.MainState(sensor_feed=SimulatedSensorFeed,server_fetcher=server,clock=clock)
+        elif controller=="sys_state":
+            system=sys_state.SystemState(sensor_feed=SimulatedSensorFeed,server_fetcher=server,threaded=False,clock=clock)
+            system.start_components()
+        else:
+            raise ValueError(f"Unknown controller {controller}, should be simpler or sys_state")
+        feed:SimulatedSensorFeed=system.valve_temp_thread
+
+        wall_start=time.perf_counter()
+        draw_offs=sorted(timetable.draw_offs)
+        end=start+hours*3600
+        while clock.time()<end:
+            now=clock.time()
+            day_hour=(now-start)/3600
+            hour=day_hour%24
+            for draw_hour,litres in draw_offs:
+                if hour<=draw_hour<hour+step_s/3600:
+                    model.draw_off(litres)
+
+            burner_was_on=model.burner_on
+            model.step(step_s,hour)
+            feed.publish(model,now)
+            server.update(model,now,hour)
+
+            if controller=="simpler":
+                # Same as MainState.run, only look again when woken or at the next deadline
+                reasons=system.wakeup.wait_until(now) # already due, so just collects the reasons
+                deadline=system.next_deadline()
+                if server.latest is not None and (reasons or (deadline is not None and now>=deadline)):
+                    system.evaluate(server.latest)
+                    report.evaluations+=1
+            else:
+                if system.tick():
+                    report.evaluations+=1
+                system.heating.step()
+                system.hot_water.step()
+
+            report.observe(model,timetable,hour,step_s,burner_was_on)
+            report.steps+=1
+            clock.advance(step_s)
+        report.wall_s=time.perf_counter()-wall_start
+    finally:
+        relays.Relay.transition_listeners.remove(report.relay_switched)
+        settings.SENSOR_LOG_DIR=sensor_log_dir
+        relays.Relay.reset_all()
+    return report
+
+
+if __name__=="__main__":
+    parser=argparse.ArgumentParser(description="Run the heating controller against a simulated house")
+    parser.add_argument("--controller",choices=["simpler","sys_state","both"],default="simpler")
+    parser.add_argument("--hours",type=float,default=24)
+    parser.add_argument("--step",type=float,default=2.0,help="simulated seconds per step")
+    parser.add_argument("--valve-travel",type=float,default=30.0,help="seconds for a valve to open or close")
+    parser.add_argument("--verbose",action="store_true",help="show the controllers' logging")
+    args=parser.parse_args()
+    if args.verbose:
+        logging.getLogger().setLevel(logging.INFO)
+
+    for controller in (["simpler","sys_state"] if args.controller=="both" else [args.controller]):
+        print(simulate(controller,args.hours,args.step,HouseModel(valve_travel_s=args.valve_travel)))
@@ -1,39 +1,71 @@
 import logging
 if __name__=="__main__":
     logging.basicConfig(level=logging.DEBUG)
+import asyncio
 import threading
 import time
 
+from clock import Clock, real_clock
+from dispatch import EventDispatcher
+from machine_definition import MachineDefinition
+from metrics import TransitionStats
+import timers
+
 
 class StateMachine(threading.Thread):
-    def __init__(self,*,name:str,states:list[str],initial_state:str,subscribers:list[callable],interval_s=0.4):
+    def __init__(self,*,name:str,subscribers:list[callable],definition:MachineDefinition|None=None,
+                 states:list[str]|None=None,initial_state:str|None=None,interval_s=0.4,clock:Clock=real_clock,
+                 timer_service:timers.TimerService|None=None,dispatcher:EventDispatcher|None=None,
+                 phases:tuple[str,...]=()):
         """
             name is the name of the statemachine thread - very useful for debugging
-            states is a list of strings representing all the valid state names
-            initial_state must be a valid string state name from the list
+            definition is a MachineDefinition of the states and the transitions allowed between them,
+            set_state raises ValueError for any other
+            or without one, states is a list of strings representing all the valid state names
+            and initial_state must be a valid string state name from the list, any transition is allowed
             subscribers is a list of callables, these receive three parameters:
                 subscriber(state_machine=self,new_state=new_state,reason=reason,type="STATE_CHANGE")
                 or type="TIMEOUT" if it's called because the state exceeded its timeout
+                (TIMEOUT events come from the timer service's thread)
+                normally they're called in the middle of set_state, but given a dispatcher
+                the events are queued to it and the subscribers are called from its thread
+            clock is where the state change times, timeouts and the interval come from,
+            swap in a clock.ManualClock to skip through timeouts in tests
+            timer_service fires the state timeouts and can be shared between machines, by default
+            the machine makes its own the first time a timeout is set, and stops it in stop()
+            phases are states whose recent durations are kept in stats, as well as the overall dwell times
 
 
         
         """
         super().__init__()
         self.name=name
-        self.valid_states=states
-        self._state=initial_state
+        if definition is None:
+            definition=MachineDefinition.permissive(name.title().replace(" ","")+"State",states,initial_state)
+        self.definition=definition
+        self._state=definition.initial if initial_state is None else definition.state(initial_state)
         self.subscribers=subscribers
-        self.initial_state:str=initial_state
+        self.initial_state:str=self._state
         self.last_change_reason:str=""
         self.last_change_time:int=0
         self.stop_requested=False
         self.stopped=False
+        self.stopped_event=threading.Event() # set as run() or run_async() finishes
         self.interval_s=interval_s
+        self.clock=clock
+        self.timer_service=timer_service
+        self.owns_timer_service=False # True if we made timer_service, so we stop it too
+        self.timeout_handle:timers.TimerHandle|None=None
+        self.dispatcher=dispatcher
+        self.stats=TransitionStats(self._state,clock.time(),phases=phases)
         self.timeout_set=False
         self.timeout_time=0
         self.previous_state="undefined"
+        self.wake_event=threading.Event() # set to run the next step straight away rather than waiting for the interval
+        self.loop:asyncio.AbstractEventLoop|None=None # set when run by run_async() rather than as a thread
+        self.async_wake:asyncio.Event|None=None
 
-        self.set_state(new_state=initial_state,reason="")
+        self.set_state(new_state=self._state,reason="")
 
         
     @property
@@ -42,10 +74,30 @@ class StateMachine(threading.Thread):
 
     def add_subscriber(self,callback:callable):
         self.subscribers.append(callback)
+
+    def notify(self,**kwargs):
+        # Tells the subscribers about an event, through the dispatcher if we have one
+        if self.dispatcher is not None:
+            self.dispatcher.post(self.name,self.subscribers,state_machine=self,**kwargs)
+            return
+        for subscriber in self.subscribers:
+            subscriber(state_machine=self,**kwargs)
+
+    def wake(self,**kwargs):
+        """
+            Makes the thread (or coroutine) run its next step now instead of at the end of the interval
+            Takes (and ignores) keyword arguments so it can be used directly as a subscriber
+            Safe to call from any thread
+        """
+        self.wake_event.set()
+        loop=self.loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self.async_wake.set)
     
     def set_state(self,*,new_state:str,reason:str="",timeout_s:float=-1):
         """
-            new_state must be a valid state name string
+            new_state must be a valid state name string (or member of definition.State)
+            that the definition allows a change to from the current state
             reason, just a string that's available to see why the last state change happened, useful for debugging
             timeout_s if this is set to 1s or more, then, if the state hasn't changed again and
             that timeout is reached all the subscribers will get called with a "timeout" event
@@ -54,56 +106,112 @@ class StateMachine(threading.Thread):
 
 
         
-        if new_state not in self.valid_states:
-            raise ValueError(f"New state of {new_state} for {self.name} because of {reason} is not one of the allowed states: {self.valid_states}")
+        new_state=self.definition.state(new_state)
+        if new_state is not self._state:
+            self.definition.check(self._state,new_state,reason)
         
-        # Deal with the timeouts
+        # Deal with the timeouts, any earlier one is replaced
+        if self.timeout_handle is not None:
+            self.timeout_handle.cancel()
+            self.timeout_handle=None
         if timeout_s>0.99: # timeouts must be greater than 1 to count!
-            self.timeout_time=time.time()+timeout_s
+            self.timeout_time=self.clock.time()+timeout_s
             self.timeout_set=True
+            if self.timer_service is None:
+                self.timer_service=timers.TimerService(self.clock,name=f"{self.name} timeouts")
+                self.owns_timer_service=True
+            handle=self.timer_service.call_at(self.timeout_time,lambda:self.timed_out(handle))
+            self.timeout_handle=handle
         else:
             self.timeout_set=False
 
         # We don't need to do anything if the new state is the same as before
-        if self.state==new_state:
+        if self._state is new_state:
             return
         
         self.previous_state=self.state
         self._state=new_state
         self.last_change_reason=reason
-        for subscriber in self.subscribers:
-            subscriber(state_machine=self,new_state=new_state,reason=reason,type="STATE_CHANGE")
-        self.last_change_time=time.time()
+        self.notify(new_state=new_state,reason=reason,type="STATE_CHANGE")
+        self.last_change_time=self.clock.time()
+        self.stats.transition(new_state,self.last_change_time)
         logging.info(f"{self.name} from >>>>> {self.previous_state} >>>>>> {self.state} because {reason}")
+        self.wake() # the new state may have work to do in step
 
 
         
     def stop(self,block_timeout_s:float=10):
         self.stop_requested=True
+        if self.timeout_handle is not None:
+            self.timeout_handle.cancel()
+        if self.owns_timer_service:
+            self.timer_service.stop()
+        self.wake()
         logging.debug(f"{self.name}->stop requested")
-        end_time=time.time()+10 # Wait 10 seconds
-        while time.time()<end_time:
-            time.sleep(1)
-            if self.stopped:
-                logging.debug(f"{self.name}->stopped cleanly")
-                return # stopped cleanly
+        if not (self.is_alive() or self.loop is not None):
+            self.stopped=True # never started, or stepped by hand, so nothing to wait for
+            return
+        if self.stopped_event.wait(block_timeout_s):
+            logging.debug(f"{self.name}->stopped cleanly")
+            return # stopped cleanly
 
-        raise Exception(f"Failed to stop {self.name} 10 seconds after stop requested")
+        raise Exception(f"Failed to stop {self.name} {block_timeout_s} seconds after stop requested")
 
     def step(self):
         logging.error(f"State machine {self.name} failed to implement a 'step' method, so nothing happens each loop!")
 
 
+    def poll_interval_s(self)->float|None:
+        """
+            How long run_async() waits for a wake() before stepping anyway, None to only step when woken.
+            Override to stop idle states waking the CPU for nothing
+        """
+        return self.interval_s
+
+    def timed_out(self,handle:timers.TimerHandle):
+        # Called by the timer service when a state timeout is reached
+        if handle is not self.timeout_handle:
+            return # the state has been set again since, so this timeout no longer applies
+        self.timeout_handle=None
+        self.timeout_set=False
+        self.stats.timed_out()
+        self.notify(new_state=self.state,reason="timeout",type="TIMEOUT")
+        self.wake()
+
     def run(self):
         while not self.stop_requested:
+            self.wake_event.clear() # cleared before the step so a wake during it isn't lost
             self.step() # This is the overridden method called every interval
-            if self.timeout_set and time.time()>self.timeout_time:
-                for subscriber in self.subscribers:
-                    subscriber(state_machine=self,new_state=self.state,reason="timeout",type="TIMEOUT")
-                self.timeout_set=False
 
-            time.sleep(self.interval_s)
+            self.clock.wait(self.wake_event,self.interval_s)
         self.stopped=True
+        self.stopped_event.set()
+
+    async def run_async(self):
+        """
+            The same as run() but as a coroutine, for running lots of machines on one
+            event loop (see runtime.AsyncRuntime) instead of a thread each
+            Between steps it only waits for a wake() (which a timeout also does) or poll_interval_s()
+            Waits are on the event loop's real time, whatever the clock
+        """
+        self.async_wake=asyncio.Event()
+        self.loop=asyncio.get_running_loop()
+        try:
+            while not self.stop_requested:
+                self.async_wake.clear()
+                self.wake_event.clear()
+                self.step()
+                if self.stop_requested:
+                    break
+
+                try:
+                    await asyncio.wait_for(self.async_wake.wait(),self.poll_interval_s())
+                except TimeoutError:
+                    pass
+        finally:
+            self.loop=None
+            self.stopped=True
+            self.stopped_event.set()
 
 
 if __name__=="__main__":
@@ -0,0 +1,66 @@
+import logging
+if __name__=="__main__":
+    logging.basicConfig(level=logging.DEBUG)
+
+"""
+
+Serves the controller's status as JSON that's only rebuilt when it changes
+
+    cache=StatusCache(build=main_state.status,key=main_state.status_key)
+    body,etag=cache.get()
+
+key() is called on every request and has to be cheap, it just gathers up
+the things the status depends on (circuit states, relays, sensor readings
+without their timestamp...) from references the control thread only ever
+replaces whole. While it returns the same thing the same body and ETag
+are handed out again, so a dashboard polling every second costs a tuple
+comparison and, with If-None-Match, a 304 with no body. Only when the key
+changes is build() called and the JSON encoded, once, however many
+clients are asking.
+
+The ETag is a hash of the body, so a rebuild that comes out the same
+doesn't make the clients download it again.
+
+"""
+
+import hashlib
+import json
+import threading
+from typing import Callable, Hashable
+
+
+class StatusCache:
+    def __init__(self,*,build:Callable[[],dict],key:Callable[[],Hashable]):
+        """
+            build makes the status as a dict for json.dumps
+            key returns something that's equal for as long as the status is the same
+        """
+        self.build=build
+        self.key=key
+        self.lock=threading.Lock() # only held by requests while rebuilding, never by the control loop
+        # (key, body, etag) swapped whole so a request can never see one body with another's ETag
+        # the first key matches nothing, so the first get() builds
+        self.current:tuple[Hashable,bytes,str]=(object(),b"","")
+        self.requests:int=0
+        self.rebuilds:int=0
+
+    def __str__(self):
+        return f"Status cache: {self.requests} requests, {self.rebuilds} rebuilds"
+
+    def get(self)->tuple[bytes,str]:
+        """
+            The status as JSON and its ETag (unquoted), rebuilt first if the key has changed
+        """
+        self.requests+=1
+        key=self.key() # taken before building, so a change part way through just means another rebuild next time
+        current_key,body,etag=self.current
+        if key==current_key:
+            return body,etag
+        with self.lock:
+            current_key,body,etag=self.current
+            if key!=current_key: # another request may have just rebuilt it
+                body=json.dumps(self.build(),separators=(",",":"),allow_nan=False).encode() # NaN isn't JSON, browsers can't parse it
+                etag=hashlib.blake2b(body,digest_size=8).hexdigest()
+                self.current=(key,body,etag)
+                self.rebuilds+=1
+            return body,etag
@@ -15,53 +15,25 @@ all the state machines and state variables live here!
 
 """
 
+import asyncio
 import hot_water_heat_sm
 import threading
 import relays
-import requests
+from server_fetcher import ServerStateFetcher, StalenessPolicy
 import settings
 import datetime
 import json
 import time
-from dataclasses import dataclass
+from typing import Callable
+from clock import Clock, real_clock
+from runtime import AsyncRuntime
+from timers import TimerService
+from dispatch import EventDispatcher
+from shutdown import ShutdownCoordinator
+import events
 import valves_and_temps
-
-@dataclass
-class SysHeatState:
-    heating_currently_on:bool
-    hot_water_currently_on:bool
-    heating_boost_timeout:datetime.datetime
-    hot_water_temperature:float
-    hot_water_last_temp_dt:datetime.datetime
-    hot_water_boost_requested:datetime.datetime
-
-    @classmethod
-    def from_JSON(cls,jsondict):
-        return cls(jsondict["heating_currently_on"],
-                   jsondict["hot_water_currently_on"],
-                   datetime.datetime.fromisoformat(jsondict["heating_boost_timeout"]),
-                   jsondict["hot_water_temperature"],
-                   datetime.datetime.fromisoformat(jsondict["hot_water_last_temp_dt"]),
-                   datetime.datetime.fromisoformat(jsondict["hot_water_boost_requested"]))
-
-
-
-def get_main_system_state(url)->SysHeatState:
-    r=requests.get(url)
-    main_state=r.json()
-    # logging.info(f"Found state: {main_state}")
-    shs=SysHeatState.from_JSON(main_state)
-    logging.info(f"""Server says:.....................
-            {shs.heating_currently_on=}
-            {shs.hot_water_temperature=}
-            {shs.hot_water_last_temp_dt=}
-            {shs.hot_water_currently_on=}
-            {shs.heating_currently_on=}""")
-    return shs
-
-
-
-
+import protocol
+from protocol import SysHeatState
 
 
 class SystemState(threading.Thread):
@@ -70,7 +42,22 @@ class SystemState(threading.Thread):
     instance_count:int=0
 
 
-    def __init__(self):
+    def __init__(self,*,sensor_feed:Callable=valves_and_temps.ValvesTemps,server_fetcher=None,threaded:bool=True,clock:Clock=real_clock,
+                 runtime:AsyncRuntime|None=None):
+        """
+            sensor_feed and server_fetcher can be swapped out as for simpler.MainState
+            threaded=False doesn't start the state machine threads, whoever made us
+            then has to call tick() and each circuit's step() (see simulator.py)
+            clock is passed on to the state machines and times our own loop
+            runtime hosts us and the two circuits as coroutines on its event loop instead of
+            a thread each, start the runtime rather than calling start() on us
+
+            When the circuits are running on their own, their state changes reach fire_boiler_if_required
+            through an EventDispatcher, so the boiler logic never runs in the middle of a transition
+            (stepped with threaded=False they're delivered straight away, so the caller sees the result)
+
+            Nothing touches the hardware or starts until start() (or the runtime starting us)
+        """
         if self.instance_count>0:
             raise Exception("Attempt to set up a duplicate SystemState- which must be a singleton!")
         
@@ -79,46 +66,117 @@ class SystemState(threading.Thread):
         
         self.instance_count+=1
         self.name="MainSystemStateThread"
+        self.clock=clock
         self.burn_relay=relays.boiler_heat_req
         self.burning_now=False
-        self.burn_relay.off()
+        self.threaded=threaded
+        self.runtime=runtime
+        self.components_started=False
+
+        # Everything we start goes in here, to be stopped in reverse order by stop()
+        self.shutdown_coordinator=ShutdownCoordinator(name=f"{self.name} shutdown")
+        # Transitions, timeouts and relay switches for anyone streaming them (see events.py)
+        self.events=events.EventHub()
+        relays.Relay.transition_listeners.append(self.events.relay_switched)
+        self.shutdown_coordinator.add("events clients",self.events.close_all) # last, so they see the relays go safe
+        self.shutdown_coordinator.add("events relay listener",lambda:relays.Relay.remove_transition_listener(self.events.relay_switched))
+        self.shutdown_coordinator.add("relays safe",relays.Relay.reset_all)
         self.burn_callback = lambda *args, **kwargs: self.fire_boiler_if_required(*args, **kwargs)
         self.manage_temperature_callback = lambda hot_water_state : self.manage_temperature(hw_state=hot_water_state)
 
         # Start monitoring the temperatures and valve states:
         self.valve_temp_states=valves_and_temps.ValveTempState.new_blank() # Continuously updates by the thread below by serial monitoring
-        self.valve_temp_thread=valves_and_temps.ValvesTemps(self.valve_temp_states)
-        self.valve_temp_thread.start()
+        self.valve_temp_thread=sensor_feed(self.valve_temp_states)
+        self.shutdown_coordinator.add("sensor board",self.valve_temp_thread.stop)
 
 
 
         # These are the two threaded state machines that handle the two circuits
+        self.dispatcher=EventDispatcher(name="SystemStateEvents") if threaded or runtime is not None else None
+        self.timer_service=TimerService(clock,name="SystemStateTimeouts") # shared by both, its thread only starts with the first timeout
         self.heating=hot_water_heat_sm.HeatWaterSM(name="heating",
                                                    pump_relay=relays.heating_pump,
                                                    valve_relay=relays.heating_valve,
-                                                   valve_state_fn=self.valve_temp_states.get_rad_valve_open)
+                                                   valve_state_fn=self.valve_temp_states.get_rad_valve_open,
+                                                   clock=clock,
+                                                   timer_service=self.timer_service,
+                                                   dispatcher=self.dispatcher)
         self.hot_water=hot_water_heat_sm.HeatWaterSM(name="hot water",
                                                      pump_relay=relays.hot_water_pump,
                                                      valve_relay=relays.hot_water_valve,
                                                      valve_state_fn=self.valve_temp_states.get_hw_valve_open,
-                                                     control_while_on_callback=self.manage_temperature_callback)
+                                                     control_while_on_callback=self.manage_temperature_callback,
+                                                     clock=clock,
+                                                     timer_service=self.timer_service,
+                                                     dispatcher=self.dispatcher)
         
         
         self.stop_requested=False
         self.stopped=False
+        self.stop_event=threading.Event() # interrupts the wait between ticks
+        self.stopped_event=threading.Event()
         self.server_state:SysHeatState|None=None
+        self.server_state_time:float=0.0 # when the fetcher last got (or confirmed) server_state
         self.hot_water_overheat_condition=False
         self.old_hw_state:bool=False
         self.old_heat_state:bool=False
 
-        # Start the two circuit state machines
-        self.heating.start()
-        self.hot_water.start() #
+        # Polls the server in the background, we just pick up whatever it last got
+        if server_fetcher is None:
+            server_fetcher=ServerStateFetcher(url=settings.URL_TO_FETCH_SYSTEM_STATE,
+                                              parse=protocol.parse,
+                                              accept=protocol.ACCEPT,
+                                              interval_s=settings.SERVER_STATE_FETCH_INTERVAL_S,
+                                              policy=StalenessPolicy(settings.SERVER_STATE_MAX_AGE_S,degraded=lambda:protocol.offline_state(clock.now())),
+                                              clock=clock)
+        self.server_fetcher=server_fetcher
+        self.shutdown_coordinator.add("server fetcher",lambda:self.server_fetcher.stop(block_timeout_s=0.2)) # a daemon, so an in-flight request needn't hold us up
+        if self.dispatcher is not None:
+            self.shutdown_coordinator.add("event dispatcher",self.dispatcher.stop)
+        self.shutdown_coordinator.add("timeouts",self.timer_service.stop) # after the circuits, so none is left waiting on it
+        self.shutdown_coordinator.add("heating",lambda:self.heating.stop(block_timeout_s=1))
+        self.shutdown_coordinator.add("hot water",lambda:self.hot_water.stop(block_timeout_s=1))
+        self.shutdown_coordinator.add("system state loop",self.stop_loop)
+
+        # Host the two circuit state machines and us on the runtime, they start when it does
+        self.loop:asyncio.AbstractEventLoop|None=None
+        self.async_wake:asyncio.Event|None=None
+        if runtime is not None:
+            runtime.add(self.heating)
+            runtime.add(self.hot_water)
+            runtime.add(self)
         
         
         self.heating.add_subscriber(self.burn_callback)
         self.hot_water.add_subscriber(self.burn_callback)
 
+        self.heating.add_subscriber(self.events.state_machine_event)
+        self.hot_water.add_subscriber(self.events.state_machine_event)
+
+        # Wake the circuit straight away when its valve reports open/closed
+        self.valve_temp_states.add_subscriber(self.valve_edge)
+
+    def start_components(self):
+        """
+            Puts the relays into their safe state, then starts reading the sensor board,
+            polling the server and (if threaded) the two circuit threads. Only does it once
+            Called by start() and run_async(), call it directly when stepping with threaded=False
+        """
+        if self.components_started:
+            return
+        self.components_started=True
+        relays.Relay.attach_all()
+        self.burn_relay.off()
+        self.valve_temp_thread.start()
+        self.server_fetcher.start()
+        if self.threaded and self.runtime is None:
+            self.heating.start()
+            self.hot_water.start()
+
+    def start(self):
+        self.start_components()
+        super().start()
+
     def __str__(self):
         return f"""
         Heating: {self.heating}
@@ -148,6 +206,16 @@ class SystemState(threading.Thread):
 
 
 
+    def valve_edge(self,*,field:str,**kwargs):
+        # Called from the serial thread, so just nudge the right state machine
+        if field=="rad_valve_open":
+            self.heating.wake()
+        elif field=="hw_valve_open":
+            self.hot_water.wake()
+        elif field=="connected": # the readings have gone stale or come back, both care
+            self.heating.wake()
+            self.hot_water.wake()
+
     def update_demands(self):
         """
             Takes all the state stuff and decides whether 
@@ -216,47 +284,96 @@ class SystemState(threading.Thread):
 
 
 
+    def tick(self,now:datetime.datetime|None=None)->bool:
+        """
+            Picks up any new server state and updates the demands from it
+            returns False if there's been nothing from the server yet, so we don't know what's wanted
+
+            The overheat checks run every tick, not just on a new state, so a server that's gone
+            quiet still trips the too-old reading check. After SERVER_STATE_MAX_AGE_S the fetcher
+            publishes protocol.offline_state instead, which turns everything off anyway and whose
+            made up reading time isn't checked. The condition clears once a real reading is fresh
+            and in range again, so the hot water doesn't stay off until a restart
+        """
+        latest=self.server_fetcher.latest
+        if latest is None:
+            return False
+        latest_time=self.server_fetcher.latest_time
+        if latest_time!=self.server_state_time: # a fetch since we last looked
+            self.server_state_time=latest_time
+            self.server_state=latest
+
+        if not getattr(self.server_fetcher,"degraded",False):
+            now=self.clock.now() if now is None else now
+            too_hot=self.server_state.hot_water_temperature>settings.HOT_WATER_SHUTDOWN_TEMPERATURE
+            too_old=self.server_state.hot_water_last_temp_dt<now-datetime.timedelta(minutes=10)
+            if too_hot or too_old:
+                if not self.hot_water_overheat_condition:
+                    if too_hot:
+                        logging.error(f"Forced to enter overheat condition due to high temperature")
+                    else:
+                        logging.error(f"Forced to enter overheat condition because our temperature reading is too old")
+                self.hot_water_overheat_condition=True
+            elif self.hot_water_overheat_condition:
+                logging.warning(f"Leaving overheat condition, the hot water temperature reading is fresh and in range")
+                self.hot_water_overheat_condition=False
+
+        self.update_demands() # Calculates if the burn relay should be set, 
+        return True
+
     def run(self):
-        next_get_hw=time.time()
         while not self.stop_requested:
-            if time.time()>next_get_hw:
-                next_get_hw+=settings.SERVER_STATE_FETCH_INTERVAL_S
-                self.server_state=get_main_system_state(settings.URL_TO_FETCH_SYSTEM_STATE)
-                if self.server_state.hot_water_temperature>settings.HOT_WATER_SHUTDOWN_TEMPERATURE:
-                    logging.error(f"Forced to enter overheat condition due to high temperature")
-                    self.hot_water_overheat_condition=True
-
-                if self.server_state.hot_water_last_temp_dt<datetime.datetime.now()-datetime.timedelta(minutes=10):
-                    logging.error(f"Forced to enter overheat condition because our temperature reading is too old")
-                    self.hot_water_overheat_condition=True
-
-            
-            self.update_demands() # Calculates if the burn relay should be set, 
-
-
-            time.sleep(2.02)
+            self.tick()
+            self.clock.wait(self.stop_event,2.02)
 
         self.stopped=True
+        self.stopped_event.set()
 
+    def wake(self,**kwargs):
+        # Used as a server fetcher listener when we're on an AsyncRuntime, so a new state is acted on at once
+        loop=self.loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self.async_wake.set)
 
-    def stop(self):
-        
-
-        # stop the two state machines
-        self.heating.stop(block_timeout_s=4)
-        self.hot_water.stop(block_timeout_s=4)
-        
-
+    async def run_async(self):
+        """
+            run() for an AsyncRuntime, only ticks when the server state changes
+            or at the fetch interval, rather than every couple of seconds
+        """
+        self.start_components()
+        self.async_wake=asyncio.Event()
+        self.loop=asyncio.get_running_loop()
+        self.server_fetcher.add_listener(self.wake)
+        try:
+            while not self.stop_requested:
+                self.async_wake.clear()
+                self.tick()
+                try:
+                    await asyncio.wait_for(self.async_wake.wait(),settings.SERVER_STATE_FETCH_INTERVAL_S)
+                except TimeoutError:
+                    pass
+        finally:
+            self.loop=None
+            self.stopped=True
+            self.stopped_event.set()
+
+
+    def stop_loop(self,block_timeout_s:float=1):
         self.stop_requested=True
+        self.stop_event.set()
+        self.wake()
+        if not (self.is_alive() or self.loop is not None):
+            return
+        if not self.stopped_event.wait(block_timeout_s):
+            raise Exception(f"Failed to stop {self.name} {block_timeout_s} seconds after stop requested")
 
-        timeout=time.time()+20
-        while time.time()<timeout:
-            if self.stopped and self.heating.stopped and self.hot_water.stopped:
-                logging.info(f"{self.name} now stopped gracefully")
-                return
-            time.sleep(0.93)
-
-        raise Exception(f"Failed to stop {self.name} gracefully in 20 seconds")
+    def stop(self,reason:str="stop requested"):
+        """
+            Stops our loop, the circuits, the dispatcher, the fetcher and the sensor board in that order,
+            then puts the relays back to their safe state
+        """
+        if self.shutdown_coordinator.shutdown(reason):
+            logging.info(f"{self.name} now stopped gracefully")
     
     
 def pause_timeout(timeout_s:float):
@@ -264,10 +381,6 @@ def pause_timeout(timeout_s:float):
     while time.time()<endtime:
         time.sleep(1)
 
-heating=SystemState() # The singular instance
-heating.start()
-
-
 if __name__=="__main__":
     testsys=SystemState()
     testsys.start()
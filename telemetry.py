@@ -0,0 +1,229 @@
+import logging
+if __name__=="__main__":
+    logging.basicConfig(level=logging.DEBUG)
+
+"""
+
+In-memory history of the valve and temperature readings
+
+A fixed size ring buffer stored column-wise in arrays rather than as a
+list of objects, so a week of 1 second samples is about 10MB:
+    timestamp   - double, time.monotonic() when it was recorded
+    temperatures - int16 hundredths of a degree
+    valves/oil  - one byte of flags
+
+The window queries bisect on the timestamps, so they're monotonic ones:
+a Pi has no real time clock and its wall clock jumps when NTP catches up
+after boot, which would leave the ring out of order. They're turned into
+time.time() ones when they're handed out.
+
+Appending is O(1) and is done by the serial thread. The queries only hold
+the lock while they bisect for the part of the ring they're asked about,
+then read it in place through memoryviews, with C loops (min/max/sum, map
+over a bound method, bytes.translate) rather than Python ones, so a week
+long window neither copies the ring nor keeps the serial thread waiting.
+A sample recorded meanwhile can replace one of the oldest in a full
+window, which for history like this doesn't matter.
+
+A reading that isn't a number (which FrameDecoder shouldn't let through)
+is stored as NO_READING and left out of the stats, to_centi never raises.
+
+"""
+
+from array import array
+from bisect import bisect_left
+from dataclasses import dataclass
+import math
+import threading
+import time
+from typing import Callable
+
+TEMPERATURE_COLUMNS=("OutHW","RetHW","OutRad","RetRad")
+FLAG_COLUMNS=("hw_valve_open","rad_valve_open","oil_flowing")
+
+ONE_WEEK_AT_1HZ=7*24*60*60
+
+NO_READING=-32768 # int16 minimum, real readings are clamped above it
+_DEGREES=(100.0).__rtruediv__ # hundredths to degrees, as v/100.0 but callable from map() without any bytecode
+# bytes.translate tables picking out each flag bit as 0/1
+_FLAG_BITS=tuple(bytes((value>>bit)&1 for value in range(256)) for bit in range(len(FLAG_COLUMNS)))
+
+
+@dataclass
+class WindowStats:
+    column:str
+    count:int
+    min:float|None
+    max:float|None
+    mean:float|None
+
+
+class TelemetryRing:
+    def __init__(self,capacity:int=ONE_WEEK_AT_1HZ,*,monotonic:Callable[[],float]=time.monotonic,wall:Callable[[],float]=time.time):
+        """
+            monotonic stamps the samples and wall is what they're shown as, swappable for testing
+        """
+        if capacity<1:
+            raise ValueError(f"Telemetry capacity must be at least 1, not {capacity}")
+        self.capacity=capacity
+        self.timestamps=array("d",bytes(8*capacity))
+        self.temperatures={name:array("h",bytes(2*capacity)) for name in TEMPERATURE_COLUMNS}
+        self.flags=array("B",bytes(capacity))
+        self.next_index=0 # where the next sample goes
+        self.count=0
+        self.lock=threading.Lock()
+        self.monotonic=monotonic
+        self.wall=wall
+
+    def __len__(self):
+        return self.count
+
+    def nbytes(self)->int:
+        return self.capacity*(self.timestamps.itemsize+len(TEMPERATURE_COLUMNS)*2+self.flags.itemsize)
+
+    def record(self,timestamp:float,state):
+        """
+            Adds one sample, state is a ValveTempSnapshot (or anything with the same attributes)
+            timestamp is the frame's time.time(), as for every recorder, but the sample is
+            stamped with monotonic() instead as the window queries bisect on them
+        """
+        flags=(1 if state.hw_valve_open else 0)|(2 if state.rad_valve_open else 0)|(4 if state.oil_flowing else 0)
+        with self.lock:
+            i=self.next_index
+            self.timestamps[i]=self.monotonic()
+            for name,column in self.temperatures.items():
+                column[i]=to_centi(getattr(state,name))
+            self.flags[i]=flags
+            self.next_index=(i+1)%self.capacity
+            if self.count<self.capacity:
+                self.count+=1
+
+    def _segments(self,since:float)->list[tuple[int,int]]:
+        """
+            Returns up to two (start,stop) index ranges into the columns, oldest first,
+            covering the samples at or after since. Must be called with the lock held
+        """
+        if self.count<self.capacity:
+            ranges=[(0,self.count)]
+        else:
+            ranges=[(self.next_index,self.capacity),(0,self.next_index)]
+
+        result=[]
+        for start,stop in ranges:
+            if start==stop:
+                continue
+            if self.timestamps[stop-1]<since:
+                continue # all of this segment is too old
+            first=bisect_left(self.timestamps,since,start,stop)
+            result.append((first,stop))
+        return result
+
+    def _views(self,seconds:float,now:float|None)->list[tuple[int,int]]:
+        # The (start,stop) ranges of the last seconds of samples, only the bisecting needs the lock
+        since=(self.monotonic() if now is None else now)-seconds
+        with self.lock:
+            return self._segments(since)
+
+    def window(self,seconds:float,now:float|None=None)->dict[str,array]:
+        """
+            Returns the columns for the last seconds of samples, now is a monotonic() time
+            timestamps are converted to time.time() ones and temperatures back to degrees (nan for NO_READING)
+        """
+        segments=self._views(seconds,now)
+        offset=float(self.wall()-self.monotonic()) # an int's __add__ won't take the floats
+        timestamps=memoryview(self.timestamps)
+        result={"timestamp":array("d")}
+        for start,stop in segments:
+            result["timestamp"].extend(map(offset.__add__,timestamps[start:stop]))
+        for name,column in self.temperatures.items():
+            view=memoryview(column)
+            result[name]=array("d")
+            for start,stop in segments:
+                part=view[start:stop]
+                result[name].extend(map(_DEGREES if min(part)!=NO_READING else from_centi,part))
+        flags=b"".join(memoryview(self.flags)[start:stop] for start,stop in segments)
+        for bit,name in enumerate(FLAG_COLUMNS):
+            result[name]=array("B",flags.translate(_FLAG_BITS[bit]))
+        return result
+
+    def stats(self,seconds:float,now:float|None=None)->dict[str,WindowStats]:
+        """
+            min, max and mean of each temperature over the last seconds of samples, now is a monotonic() time
+            flags report the fraction of the time they were set as the mean
+        """
+        segments=self._views(seconds,now)
+        count=sum(stop-start for start,stop in segments)
+        result={}
+        for name,column in self.temperatures.items():
+            view=memoryview(column)
+            parts=[view[start:stop] for start,stop in segments]
+            lows=[min(part) for part in parts]
+            if NO_READING in lows: # only when a bad reading got in, so it can be slow
+                parts=[array("h",(v for v in part if v!=NO_READING)) for part in parts]
+                parts=[part for part in parts if part]
+                lows=[min(part) for part in parts]
+            valid=sum(len(part) for part in parts)
+            if not valid:
+                result[name]=WindowStats(name,0,None,None,None)
+                continue
+            result[name]=WindowStats(name,valid,min(lows)/100.0,
+                                     max(max(part) for part in parts)/100.0,
+                                     sum(sum(part) for part in parts)/valid/100.0)
+        flags=b"".join(memoryview(self.flags)[start:stop] for start,stop in segments)
+        for bit,name in enumerate(FLAG_COLUMNS):
+            if not count:
+                result[name]=WindowStats(name,0,None,None,None)
+                continue
+            set_count=flags.translate(_FLAG_BITS[bit]).count(1)
+            result[name]=WindowStats(name,count,0.0 if set_count<count else 1.0,1.0 if set_count else 0.0,set_count/count)
+        return result
+
+    def latest_timestamp(self)->float|None:
+        # As a time.time()
+        with self.lock:
+            if not self.count:
+                return None
+            latest=self.timestamps[self.next_index-1]
+        return latest+self.wall()-self.monotonic()
+
+
+def to_centi(value:float)->int:
+    """
+        A temperature as int16 hundredths of a degree, for here and sensor_log
+        clamped rather than blowing up on a silly reading, NO_READING if it isn't a number at all
+    """
+    if not math.isfinite(value):
+        return NO_READING
+    return max(NO_READING+1,min(32767,round(value*100)))
+
+
+def from_centi(centi:int)->float:
+    # Back to degrees, nan for NO_READING
+    return math.nan if centi==NO_READING else centi/100.0
+
+
+if __name__=="__main__":
+    ring=TelemetryRing()
+    print(f"A week of samples takes {ring.nbytes()/1e6:.1f}MB")
+
+    class Fake:
+        OutHW=50.0;RetHW=40.0;OutRad=60.0;RetRad=45.5
+        hw_valve_open=True;rad_valve_open=False;oil_flowing=True
+
+    start=time.perf_counter()
+    now=time.monotonic()
+    stamps=iter(range(ONE_WEEK_AT_1HZ+1000))
+    ring.monotonic=lambda:now-ONE_WEEK_AT_1HZ-1000+next(stamps) # a week of samples in a few seconds
+    for i in range(ONE_WEEK_AT_1HZ+1000):
+        ring.record(time.time(),Fake)
+    ring.monotonic=time.monotonic
+    print(f"Appended {ONE_WEEK_AT_1HZ+1000} samples in {time.perf_counter()-start:.2f}s")
+    start=time.perf_counter()
+    print(ring.stats(3600,now=now))
+    print(f"Last hour stats took {(time.perf_counter()-start)*1000:.1f}ms")
+    start=time.perf_counter()
+    ring.stats(ONE_WEEK_AT_1HZ,now=now)
+    print(f"Last week stats took {(time.perf_counter()-start)*1000:.1f}ms")
+    start=time.perf_counter()
+    ring.window(ONE_WEEK_AT_1HZ,now=now)
+    print(f"Last week window took {(time.perf_counter()-start)*1000:.1f}ms")
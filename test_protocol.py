@@ -0,0 +1,98 @@
+"""
+
+Malformed system states must all come out as ValueError, which is all
+ServerStateFetcher.fetch_once and /push/state catch
+
+    uv run --with pytest pytest test_protocol.py
+
+"""
+
+import datetime
+import json
+
+import pytest
+
+import protocol
+from protocol import COMPACT, COMPACT_MAGIC, COMPACT_TYPE, JSON_TYPE, SysHeatState
+
+
+def good_json()->dict:
+    return {"heating_currently_on":True,
+            "hot_water_currently_on":False,
+            "heating_boost_timeout":"2024-11-02T18:30:00",
+            "hot_water_temperature":48.5,
+            "hot_water_last_temp_dt":"2024-11-02T17:58:12",
+            "hot_water_boost_requested":"2024-11-01T07:00:00"}
+
+
+def test_round_trips():
+    state=protocol.parse(json.dumps(good_json()).encode(),JSON_TYPE)
+    assert protocol.parse(json.dumps(state.to_JSON()).encode(),JSON_TYPE)==state
+    assert protocol.parse(state.to_compact(),COMPACT_TYPE)==state
+    assert protocol.parse(state.to_compact(),f"{COMPACT_TYPE}; charset=binary")==state
+
+
+@pytest.mark.parametrize("body",[b"",b"not json",b"[1,2]",b"\xff\xfe",b'"a string"'])
+def test_json_not_an_object(body):
+    with pytest.raises(ValueError):
+        protocol.parse(body,JSON_TYPE)
+
+
+@pytest.mark.parametrize("field,value",[("heating_currently_on",1),
+                                        ("hot_water_currently_on","yes"),
+                                        ("hot_water_temperature","48"),
+                                        ("hot_water_temperature",True),
+                                        ("hot_water_temperature",None),
+                                        ("heating_boost_timeout",5),
+                                        ("heating_boost_timeout","yesterday"),
+                                        ("hot_water_last_temp_dt",["2024-11-02"]),
+                                        ("version",2)])
+def test_json_bad_field(field,value):
+    jsondict=good_json()
+    jsondict[field]=value
+    with pytest.raises(ValueError):
+        SysHeatState.from_JSON(jsondict)
+
+
+@pytest.mark.parametrize("literal",["NaN","Infinity","-Infinity"])
+def test_json_non_finite_temperature(literal):
+    body=json.dumps(good_json()).replace("48.5",literal).encode()
+    with pytest.raises(ValueError):
+        protocol.parse(body,JSON_TYPE)
+
+
+@pytest.mark.parametrize("field",list(good_json()))
+def test_json_missing_field(field):
+    jsondict=good_json()
+    del jsondict[field]
+    with pytest.raises(ValueError):
+        SysHeatState.from_JSON(jsondict)
+
+
+@pytest.mark.parametrize("body",[b"",b"HS",COMPACT.pack(COMPACT_MAGIC,1,0,20.0,0,0,0)+b"x",
+                                 COMPACT.pack(b"XX",1,0,20.0,0,0,0),
+                                 COMPACT.pack(COMPACT_MAGIC,2,0,20.0,0,0,0)])
+def test_compact_bad_framing(body):
+    with pytest.raises(ValueError):
+        protocol.parse(body,COMPACT_TYPE)
+
+
+@pytest.mark.parametrize("values",[(20.0,1e20,0,0),
+                                   (20.0,float("inf"),0,0),
+                                   (20.0,0,float("-inf"),0),
+                                   (20.0,0,0,float("nan")),
+                                   (20.0,0,-1e12,0),
+                                   (float("nan"),0,0,0),
+                                   (float("inf"),0,0,0)])
+def test_compact_out_of_range(values):
+    with pytest.raises(ValueError):
+        protocol.parse(COMPACT.pack(COMPACT_MAGIC,1,0,*values),COMPACT_TYPE)
+
+
+
+def test_offline_state_is_everything_off():
+    now=datetime.datetime(2024,11,2,18,0)
+    state=protocol.offline_state(now)
+    assert not state.heating_currently_on and not state.hot_water_currently_on
+    assert state.heating_boost_timeout==now
+    assert state.hot_water_last_temp_dt<now-datetime.timedelta(minutes=10)
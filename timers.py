@@ -0,0 +1,125 @@
+import logging
+if __name__=="__main__":
+    logging.basicConfig(level=logging.DEBUG)
+
+"""
+
+One thread firing any number of timers, at the right time
+
+Timers are kept in a min-heap on their deadline, and the thread sleeps
+until the earliest one (or until an earlier one is added), so a timer
+fires as soon as it's due however many there are and however idle the
+rest of the system is. Cancelling a timer just marks its handle, and it's
+thrown away when it reaches the top of the heap.
+
+StateMachine uses this for its state timeouts. SystemState makes one and
+gives it to both its circuits; a machine given none makes its own the
+first time it actually sets a timeout, and stops it with itself:
+
+    timeouts=TimerService(clock)
+    handle=timeouts.call_later(180,callback)
+    ...
+    handle.cancel()
+    timeouts.stop()
+
+Callbacks run in the timer thread, so they should be quick and hand any
+real work off (eg by calling a state machine's wake()).
+
+"""
+
+import heapq
+import itertools
+import threading
+from typing import Callable
+
+from clock import Clock, real_clock
+
+
+class TimerHandle:
+    __slots__=("deadline","callback","cancelled","fired")
+
+    def __init__(self,deadline:float,callback:Callable):
+        self.deadline=deadline
+        self.callback=callback
+        self.cancelled=False
+        self.fired=False
+
+    def cancel(self):
+        self.cancelled=True
+
+    @property
+    def pending(self)->bool:
+        return not (self.cancelled or self.fired)
+
+
+class TimerService(threading.Thread):
+    def __init__(self,clock:Clock=real_clock,name:str="TimerService"):
+        """
+            clock is what the deadlines are on, the thread starts with the first timer
+        """
+        super().__init__(daemon=True)
+        self.name=name
+        self.clock=clock
+        self.condition=threading.Condition()
+        self.heap:list[tuple[float,int,TimerHandle]]=[]
+        self.sequence=itertools.count() # keeps timers with the same deadline in the order they were set
+        self.stop_requested=False
+
+        self.fired:int=0
+        self.cancelled:int=0
+        self.max_late_s:float=0.0 # worst time past its deadline that a timer has fired
+
+    def __str__(self):
+        return f"{self.name}: {len(self)} pending, {self.fired} fired, {self.cancelled} cancelled, worst {self.max_late_s*1000:.1f}ms late"
+
+    def __len__(self):
+        with self.condition:
+            return sum(1 for _,_,handle in self.heap if handle.pending)
+
+    def call_at(self,deadline:float,callback:Callable)->TimerHandle:
+        """
+            callback() is called from the timer thread once the clock reaches deadline, unless cancelled first
+        """
+        handle=TimerHandle(deadline,callback)
+        with self.condition:
+            heapq.heappush(self.heap,(deadline,next(self.sequence),handle))
+            if not self.is_alive() and not self.stop_requested:
+                self.start()
+            if self.heap[0][2] is handle:
+                self.condition.notify() # it's sooner than whatever we were waiting for
+        return handle
+
+    def call_later(self,delay_s:float,callback:Callable)->TimerHandle:
+        return self.call_at(self.clock.time()+delay_s,callback)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stop_requested:
+                    while self.heap and not self.heap[0][2].pending:
+                        heapq.heappop(self.heap)
+                        self.cancelled+=1
+                    if not self.heap:
+                        self.clock.wait_condition(self.condition)
+                        continue
+                    remaining=self.heap[0][0]-self.clock.time()
+                    if remaining<=0:
+                        break
+                    self.clock.wait_condition(self.condition,remaining)
+                if self.stop_requested:
+                    return
+                deadline,_,handle=heapq.heappop(self.heap)
+                handle.fired=True
+                self.fired+=1
+                self.max_late_s=max(self.max_late_s,self.clock.time()-deadline)
+            try:
+                handle.callback()
+            except Exception:
+                logging.exception(f"Timer callback {handle.callback} failed")
+
+    def stop(self,block_timeout_s:float=2):
+        with self.condition:
+            self.stop_requested=True
+            self.condition.notify()
+        if self.is_alive():
+            self.join(block_timeout_s)
@@ -3,18 +3,30 @@ if __name__=="__main__":
     logging.basicConfig(level=logging.DEBUG)
 
 import serial
+from serial.tools import list_ports
+import os
 import time
 
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 
 import threading
-import json
 
-PORT='/dev/ttyACM0'
+import settings
+from line_framer import LineFramer, read_lines, READ_CHUNK_SIZE
+from frame_decoder import FrameDecoder
 
+# Flags that subscribers get told about when they change, with the event type for each direction
+EDGE_EVENTS={"hw_valve_open":("VALVE_OPENED","VALVE_CLOSED"),
+             "rad_valve_open":("VALVE_OPENED","VALVE_CLOSED"),
+             "oil_flowing":("OIL_FLOW_STARTED","OIL_FLOW_STOPPED"),
+             "connected":("SENSORS_RECOVERED","SENSORS_STALE")}
 
-@dataclass
-class ValveTempState:
+@dataclass(frozen=True,slots=True)
+class ValveTempSnapshot:
+    """
+        One consistent set of readings from the sensor board, never changed once made
+        so it can be handed between threads freely
+    """
     OutHW:float
     RetHW:float
     OutRad:float
@@ -22,68 +34,267 @@ class ValveTempState:
     hw_valve_open:bool
     rad_valve_open:bool
     oil_flowing:bool
+    timestamp:float=0.0 # time.time() of the frame, 0 if we've never had one
+    connected:bool=False # False once the serial port has gone down
 
     @classmethod
     def new_blank(cls):
         return cls(-10,-10,-10,-10,False,False,False)
-    
+
+    def age_s(self,now:float|None=None)->float:
+        """
+            Seconds since the frame, infinite if we've never had one
+        """
+        if not self.timestamp:
+            return float("inf")
+        return (time.time() if now is None else now)-self.timestamp
+
+    def is_stale(self,max_age_s:float|None=None,now:float|None=None)->bool:
+        if not self.connected:
+            return True
+        return self.age_s(now)>(settings.SENSOR_STALE_AFTER_S if max_age_s is None else max_age_s)
+
+
+class ValveTempState:
+    """
+        Shares the latest ValveTempSnapshot from the serial thread with everything else
+
+        The serial thread is the only writer, it builds a new snapshot for each frame
+        and publishes it by swapping the current reference, so readers just take
+        snapshot() once and read a consistent frame from it with no locking
+    """
+    def __init__(self,snapshot:ValveTempSnapshot|None=None):
+        self.current:ValveTempSnapshot=snapshot or ValveTempSnapshot.new_blank()
+        self.subscribers:list=[]
+        self.edge_condition=threading.Condition()
+        self.edge_count:int=0
+
+    @classmethod
+    def new_blank(cls):
+        return cls()
+
+    def __str__(self):
+        return str(self.current)
+
+    def snapshot(self)->ValveTempSnapshot:
+        return self.current
+
+    def publish(self,snapshot:ValveTempSnapshot):
+        old=self.current
+        self.current=snapshot # the one and only write readers can see
+        if ((old.hw_valve_open,old.rad_valve_open,old.oil_flowing,old.connected)
+                !=(snapshot.hw_valve_open,snapshot.rad_valve_open,snapshot.oil_flowing,snapshot.connected)):
+            for name in EDGE_EVENTS:
+                new_value=getattr(snapshot,name)
+                if new_value!=getattr(old,name):
+                    self.publish_edge(name,new_value)
+
     def update(self,**new_vals):
-        for key,val in new_vals.items():
-            setattr(self,key,val)
+        self.publish(replace(self.current,**new_vals))
+
+    def apply_frame(self,frame:dict,timestamp:float|None=None)->ValveTempSnapshot:
+        """
+            frame is a dict from FrameDecoder.decode, which only has known keys
+            with the right types, so we can just copy across what's there
+            returns the newly published snapshot
+        """
+        get=frame.get
+        old=self.current
+        snapshot=ValveTempSnapshot(get("OutHW",old.OutHW),
+                                   get("RetHW",old.RetHW),
+                                   get("OutRad",old.OutRad),
+                                   get("RetRad",old.RetRad),
+                                   get("hw_valve_open",old.hw_valve_open),
+                                   get("rad_valve_open",old.rad_valve_open),
+                                   get("oil_flowing",old.oil_flowing),
+                                   time.time() if timestamp is None else timestamp,
+                                   True)
+        self.publish(snapshot)
+        return snapshot
+
+    def add_subscriber(self,callback:callable):
+        """
+            callback gets called from the serial thread whenever a valve or the oil flow changes:
+                callback(valve_temp_state=self,field="hw_valve_open",value=True,type="VALVE_OPENED")
+            and when the readings go stale or come back, as field="connected" (SENSORS_STALE/SENSORS_RECOVERED)
+            so it should be quick, eg just wake up whichever thread cares
+        """
+        self.subscribers.append(callback)
+
+    def publish_edge(self,name:str,value:bool):
+        event_type=EDGE_EVENTS[name][0 if value else 1]
+        logging.info(f"Sensor board: {name} now {value} ({event_type})")
+        with self.edge_condition:
+            self.edge_count+=1
+            self.edge_condition.notify_all()
+        for subscriber in self.subscribers:
+            try:
+                subscriber(valve_temp_state=self,field=name,value=value,type=event_type)
+            except Exception as e:
+                logging.exception(f"Valve edge subscriber {subscriber} failed on {event_type} for {name}: {e}")
+
+    def wait_for_edge(self,last_edge_count:int,timeout_s:float|None=None)->int:
+        """
+            Blocks until there's been an edge since last_edge_count (or the timeout)
+            returns the current edge count to pass in next time
+        """
+        with self.edge_condition:
+            self.edge_condition.wait_for(lambda:self.edge_count!=last_edge_count,timeout=timeout_s)
+            return self.edge_count
+
+    def age_s(self,now:float|None=None)->float:
+        return self.current.age_s(now)
+
+    def is_stale(self,max_age_s:float|None=None)->bool:
+        return self.current.is_stale(max_age_s)
+
+    def mark_stale(self,reason:str):
+        current=self.current
+        if current.connected:
+            logging.warning(f"Valve and temperature readings now stale ({reason}), last good frame {current.age_s():.1f}s ago")
+            self.publish(replace(current,connected=False)) # the next frame publishes connected again
 
     def get_hw_valve_open(self):
-        return self.hw_valve_open
+        return self.current.hw_valve_open
     
     def get_rad_valve_open(self):
-        return self.rad_valve_open
+        return self.current.rad_valve_open
+
+def find_sensor_port()->str|None:
+    """
+        Looks for the sensor board by its USB vendor/product id, as it can come back
+        as ttyACM1 etc after a reset, falling back to settings.SERIAL_PORT if that exists
+    """
+    for info in list_ports.comports():
+        for vid,pid in settings.SERIAL_USB_IDS:
+            if info.vid==vid and (pid is None or info.pid==pid):
+                return info.device
+    if os.path.exists(settings.SERIAL_PORT):
+        return settings.SERIAL_PORT
+    return None
+
 
 class ValvesTemps(threading.Thread):
-    def __init__(self,shared_state:ValveTempState):
+    def __init__(self,shared_state:ValveTempState,recorders:list|None=None):
+        """
+            shared_state gets a new snapshot published as each frame arrives
+            recorders is an optional list of objects with a record(timestamp,snapshot) method
+            that get every new ValveTempSnapshot, eg a telemetry.TelemetryRing for history
+
+            If the port goes away, or goes quiet, it's closed, the state marked stale,
+            and we keep looking for the board again with an increasing back off
+        """
         super().__init__()
         self.name="ValvesTempsDaaemon"
         self.state:ValveTempState=shared_state
+        self.recorders=recorders or []
+        self.decoder=FrameDecoder()
         self.last_reading_time=time.time()
         self.stopped=False
         self.stop_requested=False
+        self.stop_event=threading.Event() # lets the reconnect back off be interrupted by stop()
+        self.serial:serial.Serial|None=None # the open port, so stop() can interrupt a read
+
+        # Port health, for display
+        self.port_name:str|None=None
+        self.connect_count:int=0
+        self.failure_count:int=0
+        self.last_error:str=""
+        self.recorder_errors:int=0
 
 
 
     def get_live_state(self):
         return self.state
+
+    def health(self)->str:
+        connected=f"connected to {self.port_name}" if self.state.current.connected else "disconnected"
+        return (f"Sensor board {connected}, {self.connect_count} connects, {self.failure_count} failures, last error: {self.last_error or 'none'}, "
+                f"{self.recorder_errors} recorder errors, {self.decoder}")
+
+    def record(self,timestamp:float,snapshot:ValveTempSnapshot):
+        # Hands the snapshot to each recorder, one that raises mustn't stop the others or this thread
+        for recorder in self.recorders:
+            try:
+                recorder.record(timestamp,snapshot)
+            except Exception:
+                self.recorder_errors+=1
+                if self.recorder_errors==1 or self.recorder_errors%1000==0: # not every frame, it'd fill the log
+                    logging.exception(f"Recorder {recorder} failed ({self.recorder_errors} recorder errors so far)")
     
-    def stop(self):
+    def stop(self,block_timeout_s:float=2):
         self.stop_requested=True
-        timeout=time.time()+10 # 10 second timeout on blocking shutdown
-        while True:
-            if time.time()>timeout:
-                logging.error("ValvesTemps failed to stop properly :-(")
-                return
-            if self.stopped:
-                logging.info("ValvesTemps closed properly")
-                return
-            time.sleep(0.5)
+        self.stop_event.set()
+        ser=self.serial
+        if ser is not None:
+            try:
+                ser.cancel_read() # wakes a read that's waiting on the port timeout
+            except (AttributeError,OSError,serial.SerialException) as e:
+                logging.debug(f"Couldn't cancel the serial read, it'll stop at the port timeout: {e}")
+        if not self.is_alive():
+            return
+        self.join(block_timeout_s)
+        if self.is_alive():
+            logging.error("ValvesTemps failed to stop properly :-(")
+        else:
+            logging.info("ValvesTemps closed properly")
 
 
 
 
     def run(self):
-        with serial.Serial(PORT,115200,timeout=1) as ser:
+        backoff_s=settings.SERIAL_RECONNECT_MIN_S
+        while not self.stop_requested:
+            port=find_sensor_port()
+            if port is None:
+                self.last_error="sensor board not found"
+                self.state.mark_stale(self.last_error)
+            else:
+                frames_before=self.decoder.parsed
+                try:
+                    self.read_port(port)
+                except (serial.SerialException,OSError) as e:
+                    self.failure_count+=1
+                    self.last_error=f"{port}: {e}"
+                    logging.error(f"Lost sensor board on {port}: {e}")
+                self.state.mark_stale("stopping" if self.stop_requested else self.last_error)
+                if self.decoder.parsed>frames_before:
+                    backoff_s=settings.SERIAL_RECONNECT_MIN_S # it was working, so try again quickly
+
+            if self.stop_event.wait(backoff_s):
+                break
+            backoff_s=min(backoff_s*2,settings.SERIAL_RECONNECT_MAX_S)
+        self.stopped=True
+
+    def read_port(self,port:str):
+        """
+            Reads frames until stop is requested or the board stops sending them
+            serial errors are left for run to deal with
+        """
+        framer=LineFramer(max_line_length=settings.SERIAL_MAX_LINE_LENGTH)
+        read_buffer=bytearray(READ_CHUNK_SIZE)
+        with serial.Serial(port,settings.SERIAL_BAUD,timeout=1) as ser:
+            self.serial=ser
+            self.port_name=port
+            self.connect_count+=1
+            logging.info(f"Opened sensor board on {port}")
             ser.flush()
-            nl:str=""
+            last_frame_time=time.time() # opening resets the board so give it the full silence timeout
             while not self.stop_requested:
-                x=ser.read(1) # reading single bytes at a time to overcome line end inconsistencies!
-                if x==b'\r' or  x==b'\n': # we finished a line 
-                    
-                    if nl.startswith("{"):
-                        # Assume this is a valid line with the json state:
-                        # logging.info(f"{nl}\n")
-                        self.state.update(**json.loads(nl))
-                    else:
-                        # logging.debug(f"F>>>>>>>>>>>>DEBUG >>>>>>>>\n\t{nl[:20]}\n\n")
-                        ...
-                    nl=""
-                else:
-                    nl+=x.decode("ascii")
+                for nl in read_lines(ser,framer,read_buffer):
+                    frame=self.decoder.decode(nl) # None for debug lines and anything malformed
+                    if frame is None:
+                        continue
+                    last_frame_time=self.last_reading_time=time.time()
+                    snapshot=self.state.apply_frame(frame,last_frame_time)
+                    self.record(last_frame_time,snapshot)
+
+                if time.time()-last_frame_time>settings.SERIAL_SILENCE_TIMEOUT_S:
+                    self.failure_count+=1
+                    self.last_error=f"{port}: no frames for {settings.SERIAL_SILENCE_TIMEOUT_S}s"
+                    logging.error(f"Sensor board on {port} has gone quiet, reconnecting")
+                    break
+        self.serial=None
 
 
 